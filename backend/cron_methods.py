@@ -1,102 +1,347 @@
+import asyncio
+import time
 import uuid
 import logging
 
-from backend.potlam_backend import PotlamBackend
-from backend.schemas import CloudPrintOrderStatus
+from backend.fetch_cursor import FetchCursor, is_incremental_fetch
+from backend.job_leases import JobLeases
+from backend.logo_cache import LogoCache
+from backend.potlam_backend import AsyncPotlamBackend
+from backend.schemas import BodyItem, CloudPrintOrderStatus, IngestAck, INGEST_DUPLICATE, INGEST_ERROR, \
+    INGEST_QUEUED, INGEST_REJECTED
 from backend.services import PotlamOrdersListService
 from libs.constants import get_constant
-from database.cloudprint_db import is_order_in_db, delete_order_from_db, add_orders_to_db
-from backend.order_queue import OrderQueue
+from database.cloudprint_db import serialize_order, load_order, load_pending_orders
+from database.db_writer import DatabaseWriter
+from backend.order_queue import OrderQueue, order_key
+from backend.render_pipeline import RenderPipeline
+from backend.shard_ring import ShardRing
+from backend.status_updater import StatusUpdater
 
-queue = OrderQueue()
+render_pipeline = RenderPipeline()
+
+fetch_cursor = FetchCursor()
 
 # Create a logger
 logger = logging.getLogger(__name__)
 
 
-async def cloudprint_orders():
+async def restore_orders():
+    # Rebuild the print queues from the orders pending in the database, e.g. after a deploy or a crash,
+    # so printers do not have to wait for the next fetch from the POTLAM backend. The shared queues are the
+    # pending orders of the database, their orders are only rendered ahead of time again.
+
+    start = time.perf_counter()
+
+    orders = await asyncio.to_thread(load_pending_orders)
+
+    local_orders = []
+    for order in orders:
+
+        # The restaurant moved to another shard node while this node was down.
+        if not ShardRing().is_local(order.restaurant_code):
+            DatabaseWriter().delete_order(order.restaurant_code, order.order_id)
+            continue
+
+        local_orders.append(order)
+
+    # Download the logos of the restaurants with pending orders once, before their orders are rendered.
+    await LogoCache().warm_up(order.restaurant_details.logo_url for order in local_orders)
+
+    queue = OrderQueue()
+    added = await queued_call(queue, add_orders, queue, local_orders)
+
+    restored = 0
+    for order, is_added in zip(local_orders, added):
+        if is_added:
+            render_pipeline.submit(order)
+            restored += 1
+
+    logger.info(f"Restored [{restored}] pending orders from the database into the queues "
+                f"in [{(time.perf_counter() - start) * 1000:.1f} ms].")
+
+    return restored
+
+
+async def queued_call(queue: OrderQueue, function, *args):
+    # The shared queues read and write the database, their methods are called off the event loop.
+    if queue.blocking:
+        return await asyncio.to_thread(function, *args)
+
+    return function(*args)
+
+
+def add_orders(queue: OrderQueue, orders: list[BodyItem]) -> list[bool]:
+    return [queue.add_order(order) for order in orders]
+
+
+def orders_in_queue(queue: OrderQueue, orders: list[BodyItem]) -> list[bool]:
+    return [queue.is_order_in_queue(restaurant_code=order.restaurant_code, order=order) for order in orders]
+
+
+def claimed_orders(db_orders: list[CloudPrintOrderStatus]) -> set[str]:
+    # Uuids of the orders that are no longer pending in the database, or have a live job lease. Reads the lease
+    # files, called off the event loop.
+    pending = str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))
+    claimed = set()
+
+    for db_order in db_orders:
+        if db_order.status != pending:
+            claimed.add(db_order.uuid)
+            continue
+
+        lease = JobLeases().load(db_order.uuid)
+        if lease is not None and lease.expires > time.time():
+            claimed.add(db_order.uuid)
+
+    return claimed
+
+
+async def requeue_orders(uuids: list[str]) -> int:
+    # Put the orders of expired job leases back in the queues, the printer did not confirm them with a DELETE.
+    # Their payload was taken by the GET that leased the job, they are rendered ahead of time again.
+    # Returns the number of orders requeued.
+
+    queue = OrderQueue()
+    requeued = 0
+
+    for uuid in uuids:
+        leased = await asyncio.to_thread(load_order, uuid, str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
+
+        if leased is None:
+            continue
+
+        # The restaurant moved to another shard node while its job was leased. The order is handed off: it is
+        # deleted here and reported pending again, the new node fetches it from the POTLAM backend.
+        if not ShardRing().is_local(leased.restaurant_code):
+            DatabaseWriter().delete_order(leased.restaurant_code, leased.order_id)
+            StatusUpdater().record(leased.cloud_print_id, str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
+
+            logger.info(f"Order of a job lease expired after its restaurant moved to shard node "
+                        f"[{ShardRing().owner(leased.restaurant_code)}], handed off [{leased.restaurant_code}] "
+                        f"[order_id:{leased.order_id}] [cloudprint_id:{leased.cloud_print_id}]")
+            continue
+
+        order = await asyncio.to_thread(queue.requeue_order, uuid)
+
+        if order is None:
+            continue
+
+        render_pipeline.submit(order)
+
+        StatusUpdater().record(order.cloud_print_id, str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
+        requeued += 1
+
+        logger.info(f"Order requeued after its job lease expired [{order.restaurant_code}] "
+                    f"[order_id:{order.order_id}] [cloudprint_id:{order.cloud_print_id}]")
+
+    return requeued
+
+
+def release_moved_restaurants() -> int:
+    # Called when the shard membership changed. The orders of the restaurants that moved to another node are
+    # removed from the queues and the database, the new node fetches them from the POTLAM backend.
+    # Returns the number of restaurants released.
+
+    queue = OrderQueue()
+    moved = [restaurant_code for restaurant_code in queue.restaurants() if not ShardRing().is_local(restaurant_code)]
+
+    for restaurant_code in moved:
+        for order in queue.get_orders(restaurant_code) or []:
+            if queue.remove_order(restaurant_code, order.order_id, order.cloud_print_id) is not None:
+                DatabaseWriter().delete_order(restaurant_code, order.order_id)
+
+        logger.info(f"Restaurant [{restaurant_code}] moved to shard node [{ShardRing().owner(restaurant_code)}], "
+                    f"its orders were released.")
+
+    # Orders of the restaurants that moved to this node may be behind the incremental fetch cursor.
+    fetch_cursor.request_full_resync()
+
+    return len(moved)
+
+
+async def cloudprint_orders() -> int:
+    # Returns the number of new orders added to the queues.
+
+    if is_incremental_fetch():
+        await fetch_cursor.load()
+
+        if not fetch_cursor.is_full_resync_due():
+            return await fetch_incremental_orders()
 
     # Fetch Cloud Print Orders from the POTLAM Backend
     orders_list = PotlamOrdersListService()
     orders_list.public_key = get_constant("POTLAM_BACKEND_PUBLIC_KEY")
 
-    potlam_backend = PotlamBackend(params=orders_list)
-    orders = potlam_backend.fetch_cloudprint_orders()
+    potlam_backend = AsyncPotlamBackend(params=orders_list)
+    orders = await potlam_backend.fetch_cloudprint_orders()
+
+    if orders is None:
+        logger.info("No new orders received from the POTLAM backend service.")
+
+        # An empty full fetch is complete too, no order is pending in the POTLAM backend.
+        if is_incremental_fetch() and not potlam_backend.failed:
+            fetch_cursor.full_resync_done()
+
+        return 0
+
+    logger.info(f"Received [{len(orders.cloud_print_ids)}] orders from POTLAM backend, [{orders.duplicates}] already "
+                f"in queue, [{orders.quarantined}] quarantined, [{orders.foreign}] of other shard nodes. "
+                f"Adding [{len(orders.orders)}] new orders to queues.")
+
+    acks = await ingest_orders(orders.orders)
+
+    if is_incremental_fetch() and not any(ack.status == INGEST_ERROR for ack in acks):
+        fetch_cursor.advance(orders.cloud_print_ids)
+        fetch_cursor.full_resync_done()
+
+    return sum(1 for ack in acks if ack.status == INGEST_QUEUED)
+
+
+async def fetch_incremental_orders() -> int:
+    # Fetch the orders after the cursor, page by page. Returns the number of new orders added to the queues.
+
+    queued = 0
+    page_size = int(get_constant("FETCH_PAGE_SIZE", 200))
+
+    for _ in range(int(get_constant("FETCH_MAX_PAGES", 50))):
+
+        orders_list = PotlamOrdersListService()
+        orders_list.public_key = get_constant("POTLAM_BACKEND_PUBLIC_KEY")
+        orders_list.since_cloud_print_id = fetch_cursor.cursor
+        orders_list.page_size = page_size
+
+        page = await AsyncPotlamBackend(params=orders_list).fetch_cloudprint_orders()
+
+        if page is None or len(page.cloud_print_ids) == 0:
+            break
+
+        logger.info(f"Received [{len(page.cloud_print_ids)}] orders after [cloudprint_id:{fetch_cursor.cursor}] "
+                    f"from POTLAM backend, Adding [{len(page.orders)}] new orders to queues.")
+
+        acks = await ingest_orders(page.orders)
+        queued += sum(1 for ack in acks if ack.status == INGEST_QUEUED)
+
+        # Fetch this page again next time if its orders could not be saved.
+        if any(ack.status == INGEST_ERROR for ack in acks):
+            break
+
+        # Stop if the POTLAM backend does not move past the cursor, rather than fetching the same page again.
+        if not fetch_cursor.advance(page.cloud_print_ids, page.cursor) or not page.has_more:
+            break
+
+    return queued
+
+
+async def ingest_orders(orders: list[BodyItem]) -> list[IngestAck]:
+    # Add orders fetched from, or pushed by, the POTLAM backend to the database and the queues.
+    # Returns an acknowledgement for each order, in the same order.
 
     # TODO: Potentially, we can look into removing storing the order in the memory queue.
     #  this is probably not needed, and use only the database.
 
-    # in_progress_orders = []
+    queue = OrderQueue()
+    in_queue = await queued_call(queue, orders_in_queue, queue, orders)
+
+    acks = []
+    new_orders = []
     print_pending_orders = []
+    seen = set()
 
-    if orders is not None:
+    for order, is_in_queue in zip(orders, in_queue):
 
-        logger.info(f"Received [{len(orders.body)}] new orders from POTLAM backend, Adding them to queues.")
+        ack = IngestAck(restaurant_code=order.restaurant_code, order_id=order.order_id,
+                        cloud_print_id=order.cloud_print_id, status=INGEST_QUEUED)
+        acks.append(ack)
 
-        for order in orders.body:
+        # Check whether PrintOrderItem object exists for this order, that is a print_order
+        # object exists in the json response from the POTLAM backend for this order.
+        # A valid order must contain PrintOrderItem object.
 
-            # Check whether PrintOrderItem object exists for this order, that is a print_order
-            # object exists in the json response from the POTLAM backend for this order.
-            # A valid order must contain PrintOrderItem object.
+        if type(order.print_order).__name__ != "PrintOrderItem":
+            logger.info(f"Order contains empty print_order element for "
+                        f"[{order.restaurant_code}] [order_id:{order.order_id}] "
+                        f"[cloudprint_id:{order.cloud_print_id}], skipped.")
 
-            if type(order.print_order).__name__ == "PrintOrderItem":
+            ack.status, ack.detail = INGEST_REJECTED, "Order contains empty print_order element."
+            continue
 
-                order_exists_in_queue: bool = queue.is_order_in_queue(restaurant_code=order.restaurant_code,
-                                                                      order=order)
+        # Add this order to queue only if this order does not already exist in the queue, or earlier in this batch.
+        key = order_key(order.restaurant_code, order.order_id, order.cloud_print_id)
 
-                # Add this order to queue only if this order does not already exist in the queue.
-                if not order_exists_in_queue:
+        if key in seen or is_in_queue:
+            logger.info(f"Order [{order.restaurant_code}] [order_id:{order.order_id}] "
+                        f"[cloudprint_id:{order.cloud_print_id}] already in queue, skipped.")
 
-                    # UUID is created, added to an order here, UUID is not available from the POTLAM backend.
-                    #  In this case, re-use the existing UUID from the database for this order.
-                    #  DO THIS UUID AFTER MAKING THE CHECK WHETHER ORDER EXISTS, AND DO IT ONLY IF IT DOESN'T
-                    order.uuid = str(uuid.uuid4())
+            ack.status = INGEST_DUPLICATE
+            continue
 
-                    # Add this order to the queues for further processing including printing
-                    queue.add_order(order)
+        seen.add(key)
 
-                    # If this order already exists in the database, Delete it.
-                    # This will be freshly added (with the new UUID) later.
-                    if is_order_in_db(restaurant_code=order.restaurant_code, order_id=order.order_id):
-                        delete_order_from_db(restaurant_code=order.restaurant_code, order_id=order.order_id)
+        # UUID is created here, UUID is not available from the POTLAM backend. If this order
+        # already exists in the database, the existing UUID is re-used when reconciling below.
+        order.uuid = str(uuid.uuid4())
+        new_orders.append((order, ack))
 
-                    # Update cloudprint status for this order, set it to in progress.
-                    # status = PotlamOrderPrintStatus(
-                    #    cloud_print_id=str(order.cloud_print_id),
-                    #    status=str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
+        # Add this order to the SQLite database table, that will be checked before sending
+        # the order to printer.
+        # TODO: Potentially also include order_date and order_time fields to the DB, to decide the sequence
+        #  in which the order to be printed - until then rely on order_id.
+        #  lowest order_id # to be printed first.
+        print_pending_orders.append(
+            CloudPrintOrderStatus(uuid=order.uuid,
+                                  restaurant_code=order.restaurant_code.lower(),
+                                  cloud_print_id=order.cloud_print_id,
+                                  order_id=order.order_id,
+                                  status=str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")),
+                                  payload=serialize_order(order))
+        )
 
-                    # add the status to list that will be used to update the status in the backend
-                    # in_progress_orders.append(status)
+    if len(print_pending_orders) == 0:
+        return acks
 
-                    # Add this order to the SQLite database table, that will be checked before sending
-                    # the order to printer.
-                    # TODO: Potentially also include order_date and order_time fields to the DB, to decide the sequence
-                    #  in which the order to be printed - until then rely on order_id.
-                    #  lowest order_id # to be printed first.
-                    print_pending_orders.append(
-                        CloudPrintOrderStatus(uuid=order.uuid,
-                                              restaurant_code=order.restaurant_code.lower(),
-                                              cloud_print_id=order.cloud_print_id,
-                                              order_id=order.order_id,
-                                              status=str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
-                    )
+    try:
+        # Reconcile all new orders with the database in one transaction, set their status to:
+        # CLOUDPRINT_STATUS_PRINT_PENDING. Orders already in the database keep their UUID.
+        print_pending_orders = await asyncio.wrap_future(DatabaseWriter().upsert_orders(print_pending_orders))
 
-                else:
-                    logger.info(f"Order [{order.restaurant_code}] [order_id:{order.order_id}] "
-                                f"[cloudprint_id:{order.cloud_print_id}] already in queue, skipped.")
+    except Exception as e:
+        logger.error(f"Error adding [{len(print_pending_orders)}] orders to the database: {e!r}")
 
-            else:
-                logger.info(f"Order contains empty print_order element for "
-                            f"[{order.restaurant_code}] [order_id:{order.order_id}] "
-                            f"[cloudprint_id:{order.cloud_print_id}], skipped.")
+        for order, ack in new_orders:
+            ack.status, ack.detail = INGEST_ERROR, "Order could not be saved."
 
-    else:
-        logger.info("No new orders received from the POTLAM backend service.")
+        return acks
+
+    existing = []
+    for (order, ack), db_order in zip(new_orders, print_pending_orders):
+        if order.uuid != db_order.uuid:
+            existing.append(db_order)
+
+        order.uuid = db_order.uuid
+
+    # An order claimed by a printer is fetched again until its status reaches the POTLAM backend with the next
+    # status update. It is no longer in the queue, but still in progress in the database or leased.
+    claimed = await asyncio.to_thread(claimed_orders, existing) if len(existing) > 0 else set()
+
+    for order, ack in new_orders:
+        if order.uuid in claimed:
+            logger.info(f"Order [{order.restaurant_code}] [order_id:{order.order_id}] "
+                        f"[cloudprint_id:{order.cloud_print_id}] claimed by a printer, skipped.")
+
+            ack.status = INGEST_DUPLICATE
+
+    new_orders = [(order, ack) for order, ack in new_orders if order.uuid not in claimed]
+
+    added = await queued_call(queue, add_orders, queue, [order for order, _ in new_orders])
+
+    for (order, ack), is_added in zip(new_orders, added):
 
-    # if len(in_progress_orders) > 0:
-        # Update status to: CLOUDPRINT_STATUS_PRINT_IN_PROGRESS for any valid orders.
-        # bulk_update_status(in_progress_orders)
+        # Add this order to the queues for further processing including printing, and render the
+        # print job ahead of time, the order is marked ready once rendered.
+        if is_added:
+            render_pipeline.submit(order)
+        else:
+            ack.status = INGEST_DUPLICATE
 
-    if len(print_pending_orders) > 0:
-        # Update status of orders in the database to: CLOUDPRINT_STATUS_PRINT_PENDING.
-        add_orders_to_db(print_pending_orders)
+    return acks
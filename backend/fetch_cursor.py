@@ -0,0 +1,100 @@
+from typing import Optional
+import asyncio
+import logging
+import time
+
+from database.cloudprint_db import load_state
+from database.db_writer import DatabaseWriter
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+CURSOR_KEY = "fetch_cursor"
+FULL_RESYNC_KEY = "fetch_full_resync_at"
+
+
+def cloud_print_id_order(cloud_print_id: str) -> tuple:
+    # cloud_print_ids are numeric, compared as numbers; any other id sorts after them.
+    return (0, int(cloud_print_id), "") if cloud_print_id.isdigit() else (1, 0, cloud_print_id)
+
+
+def is_incremental_fetch() -> bool:
+    return str(get_constant("POTLAM_FETCH_MODE", "full")).lower() == "incremental"
+
+
+class FetchCursor:
+    # High-water mark of the incremental fetch: the highest cloud_print_id received from the POTLAM backend.
+    # An incremental fetch only asks for the orders after the cursor. Orders whose cloud_print_id is below
+    # the cursor, e.g. re-opened in the POTLAM backend, are picked up by a full fetch, done every
+    # FETCH_FULL_RESYNC_INTERVAL seconds and whenever there is no cursor yet.
+    #
+    # The cursor and the time of the last full fetch are kept in the ServiceState table, so a restart
+    # continues where it left off.
+
+    _self = None
+
+    loaded = False
+    cursor: Optional[str] = None
+
+    # Epoch seconds, persisted across restarts.
+    full_resync_at = 0.0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    async def load(self):
+        if FetchCursor.loaded:
+            return
+
+        FetchCursor.cursor = await asyncio.to_thread(load_state, CURSOR_KEY)
+        FetchCursor.full_resync_at = float(await asyncio.to_thread(load_state, FULL_RESYNC_KEY) or 0)
+        FetchCursor.loaded = True
+
+        logger.info(f"Loaded incremental fetch cursor [cloudprint_id:{FetchCursor.cursor}].")
+
+    def is_full_resync_due(self) -> bool:
+        interval = float(get_constant("FETCH_FULL_RESYNC_INTERVAL", 3600))
+
+        return FetchCursor.cursor is None or time.time() - FetchCursor.full_resync_at >= interval
+
+    def advance(self, cloud_print_ids: list[str], cursor: Optional[str] = None) -> bool:
+        # Move the cursor to the given cursor, or to the highest of the cloud_print_ids received.
+        # Returns False if the cursor did not move.
+
+        candidates = list(cloud_print_ids)
+        if cursor is not None:
+            candidates = [cursor]
+        if FetchCursor.cursor is not None:
+            candidates.append(FetchCursor.cursor)
+
+        if len(candidates) == 0:
+            return False
+
+        highest = max(candidates, key=cloud_print_id_order)
+        if highest == FetchCursor.cursor:
+            return False
+
+        FetchCursor.cursor = highest
+
+        # Committed after the orders fetched with this cursor.
+        DatabaseWriter().save_state(CURSOR_KEY, highest)
+
+        return True
+
+    def request_full_resync(self):
+        # The next fetch is a full fetch.
+        FetchCursor.full_resync_at = 0.0
+
+    def full_resync_done(self):
+        FetchCursor.full_resync_at = time.time()
+        DatabaseWriter().save_state(FULL_RESYNC_KEY, str(FetchCursor.full_resync_at))
+
+    def stats(self) -> dict:
+        return {
+            "mode": "incremental" if is_incremental_fetch() else "full",
+            "cursor": FetchCursor.cursor,
+            "full_resync_age": round(time.time() - FetchCursor.full_resync_at, 1) if FetchCursor.full_resync_at else None,
+        }
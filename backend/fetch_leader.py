@@ -0,0 +1,95 @@
+from typing import Awaitable, Callable, Optional
+import asyncio
+import fcntl
+import logging
+import os
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+
+class FetchLeader:
+    # Elects the one worker process of a host that fetches orders from the POTLAM backend and renders them
+    # ahead of time when the queues are shared (CLOUDPRINT_QUEUE_BACKEND=sqlite); the other workers only
+    # answer the printers. The leader holds an exclusive lock on the CLOUDPRINT_LEADER_LOCK file, released
+    # by the operating system when the process exits. The other workers try to take the lock every
+    # CLOUDPRINT_LEADER_RETRY seconds and take over the fetching when the leader is gone.
+
+    _self = None
+    _task: Optional[asyncio.Task] = None
+
+    lock_file = None
+    elections = 0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @property
+    def is_leader(self) -> bool:
+        return FetchLeader.lock_file is not None
+
+    def try_acquire(self) -> bool:
+        if self.is_leader:
+            return True
+
+        lock_file = open(get_constant("CLOUDPRINT_LEADER_LOCK", "cloudprint.leader.lock"), "a+")
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except OSError:
+            lock_file.close()
+            return False
+
+        # The pid of the leader, for operators.
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+
+        FetchLeader.lock_file = lock_file
+        FetchLeader.elections += 1
+
+        return True
+
+    def start(self, on_elected: Callable[[], Awaitable]):
+        # Must be called from the event loop, on application startup. on_elected is awaited once,
+        # when this worker becomes the leader.
+        FetchLeader._task = asyncio.get_running_loop().create_task(self.run(on_elected))
+
+    async def run(self, on_elected: Callable[[], Awaitable]):
+        retry = float(get_constant("CLOUDPRINT_LEADER_RETRY", 5))
+
+        while not self.try_acquire():
+            await asyncio.sleep(retry)
+
+        logger.info(f"Worker [pid:{os.getpid()}] elected to fetch orders from the POTLAM backend.")
+
+        await on_elected()
+
+    async def stop(self):
+        # Called on application shutdown, another worker takes over the fetching.
+        if FetchLeader._task is not None:
+            FetchLeader._task.cancel()
+
+            try:
+                await FetchLeader._task
+            except asyncio.CancelledError:
+                pass
+
+            FetchLeader._task = None
+
+        if FetchLeader.lock_file is not None:
+            fcntl.flock(FetchLeader.lock_file, fcntl.LOCK_UN)
+            FetchLeader.lock_file.close()
+            FetchLeader.lock_file = None
+
+    def stats(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "leader": self.is_leader,
+            "elections": FetchLeader.elections,
+        }
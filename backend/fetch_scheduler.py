@@ -0,0 +1,150 @@
+from collections import deque
+from typing import Optional
+import asyncio
+import logging
+import random
+import time
+
+from backend.cron_methods import cloudprint_orders
+from backend.fetch_cursor import FetchCursor
+from libs.auth import PrinterSessions
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+
+class FetchScheduler:
+    # Fetches orders from the POTLAM backend at an interval adapted to the activity:
+    #   - orders received: next fetch after FETCH_MIN_INTERVAL seconds.
+    #   - no orders, printers polling: the interval doubles, up to FETCH_INTERVAL seconds.
+    #   - no orders, no printer polling: the interval doubles, up to FETCH_MAX_INTERVAL seconds.
+    # Once the POTLAM backend pushes orders (POTLAM_INGEST_KEY is set), fetching is a reconciliation fallback
+    # that runs every FETCH_RECONCILE_INTERVAL seconds or less often.
+    # Every wait is randomized by +/- FETCH_JITTER. Fetches run one at a time, a printer coming online
+    # wakes the scheduler up so that it does not wait for the end of a long idle interval.
+
+    _self = None
+    _task: Optional[asyncio.Task] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _wakeup: Optional[asyncio.Event] = None
+
+    lock = asyncio.Lock()
+
+    # Exposed for tuning.
+    interval = 0.0
+    fetches = 0
+    failures = 0
+    last_orders = 0
+    durations_ms = deque(maxlen=20)
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @staticmethod
+    def bounds() -> tuple:
+        min_interval = float(get_constant("FETCH_MIN_INTERVAL", 5))
+        idle_interval = max(float(get_constant("FETCH_INTERVAL", 30)), min_interval)
+        max_interval = max(float(get_constant("FETCH_MAX_INTERVAL", 300)), idle_interval)
+
+        if get_constant("POTLAM_INGEST_KEY"):
+            # Orders are pushed by the POTLAM backend, fetching only picks up orders whose push failed.
+            min_interval = idle_interval = max(float(get_constant("FETCH_RECONCILE_INTERVAL", 300)), min_interval)
+            max_interval = max(max_interval, idle_interval)
+
+        return min_interval, idle_interval, max_interval
+
+    def start(self):
+        # Must be called from the event loop, on application startup. The first fetch runs immediately.
+        FetchScheduler._loop = asyncio.get_running_loop()
+        FetchScheduler._wakeup = asyncio.Event()
+        FetchScheduler.lock = asyncio.Lock()
+        FetchScheduler.interval = self.bounds()[0]
+        FetchScheduler._task = FetchScheduler._loop.create_task(self.run())
+
+    def printer_online(self):
+        # A printer started polling. If the scheduler backed off beyond the idle interval because no printer
+        # was polling, fetch now. Safe to call from route handlers running in the thread pool.
+        if FetchScheduler._loop is not None and FetchScheduler.interval > self.bounds()[1]:
+            FetchScheduler._loop.call_soon_threadsafe(FetchScheduler._wakeup.set)
+
+    def fetch_now(self):
+        # Fetch without waiting for the end of the current interval. Safe to call from any thread.
+        if FetchScheduler._loop is not None:
+            FetchScheduler._loop.call_soon_threadsafe(FetchScheduler._wakeup.set)
+
+    async def run(self):
+        while True:
+            queued = await self.fetch()
+
+            FetchScheduler.interval = self.next_interval(queued)
+
+            jitter = float(get_constant("FETCH_JITTER", 0.1))
+            delay = FetchScheduler.interval * random.uniform(1 - jitter, 1 + jitter)
+
+            try:
+                await asyncio.wait_for(FetchScheduler._wakeup.wait(), timeout=delay)
+                logger.info("Fetch scheduler woken up, fetching orders now.")
+            except asyncio.TimeoutError:
+                pass
+
+            FetchScheduler._wakeup.clear()
+
+    def next_interval(self, queued: Optional[int]) -> float:
+        min_interval, idle_interval, max_interval = self.bounds()
+
+        if queued:
+            return min_interval
+
+        if PrinterSessions().active_printers(idle_interval) > 0:
+            # Printers are waiting for orders, keep fetching at least every idle interval.
+            return min(max(FetchScheduler.interval * 2, min_interval), idle_interval)
+
+        return min(max(FetchScheduler.interval * 2, min_interval), max_interval)
+
+    async def fetch(self) -> Optional[int]:
+        # Returns the number of new orders queued, None if the fetch failed.
+
+        async with FetchScheduler.lock:
+            start = time.perf_counter()
+
+            try:
+                queued = await cloudprint_orders()
+
+            except Exception as e:
+                FetchScheduler.failures += 1
+                logger.error(f"Error fetching orders from the POTLAM backend: {e!r}")
+                queued = None
+
+            FetchScheduler.fetches += 1
+            FetchScheduler.last_orders = queued or 0
+            FetchScheduler.durations_ms.append(round((time.perf_counter() - start) * 1000, 1))
+
+        return queued
+
+    async def stop(self):
+        # Called on application shutdown.
+        if FetchScheduler._task is not None:
+            FetchScheduler._task.cancel()
+
+            try:
+                await FetchScheduler._task
+            except asyncio.CancelledError:
+                pass
+
+            FetchScheduler._task = None
+
+        FetchScheduler._loop = None
+
+    def stats(self) -> dict:
+        return {
+            "interval": round(FetchScheduler.interval, 2),
+            "fetches": FetchScheduler.fetches,
+            "failures": FetchScheduler.failures,
+            "last_orders": FetchScheduler.last_orders,
+            "fetch_running": FetchScheduler.lock.locked(),
+            "recent_durations_ms": list(FetchScheduler.durations_ms),
+            **FetchCursor().stats(),
+        }
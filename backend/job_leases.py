@@ -0,0 +1,194 @@
+from dataclasses import asdict, dataclass
+from typing import Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class JobLease:
+    token: str
+    uuid: str
+    mac: str
+    etag: str
+    size: int
+
+    # Epoch seconds.
+    expires: float
+
+    media_type: str = "application/vnd.star.starprnt"
+
+
+class JobLeases:
+    # Print jobs claimed by a printer, addressed by their job token. The first GET of a token claims the order
+    # and writes its rendered bytes to <uuid>.job in the CLOUDPRINT_JOB_FOLDER; every GET of the same token,
+    # e.g. a retry after a lost response, serves that same file until the printer confirms the job with a DELETE
+    # or the lease expires, CLOUDPRINT_JOB_LEASE seconds after the claim. The lease itself is <uuid>.lease, next
+    # to the job, so all the worker processes of a host see it.
+    #
+    # Expired leases are swept every CLOUDPRINT_JOB_LEASE_SWEEP_INTERVAL seconds, their orders are put back in
+    # the queues to be printed again.
+
+    _self = None
+    _task: Optional[asyncio.Task] = None
+
+    # Counters exposed for tuning.
+    claimed = 0
+    replayed = 0
+    released = 0
+    expired = 0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @staticmethod
+    def folder() -> str:
+        return get_constant("CLOUDPRINT_JOB_FOLDER", "jobs")
+
+    def job_path(self, uuid: str) -> str:
+        return os.path.join(self.folder(), uuid + ".job")
+
+    def lease_path(self, uuid: str) -> str:
+        return os.path.join(self.folder(), uuid + ".lease")
+
+    @staticmethod
+    def write(path: str, content: bytes):
+        # Written to a temporary file and renamed, a reader never sees a partially written file.
+        temporary = f"{path}.{os.getpid()}.tmp"
+
+        with open(temporary, "wb") as f:
+            f.write(content)
+
+        os.replace(temporary, path)
+
+    def load(self, uuid: str) -> Optional[JobLease]:
+        # The lease of this order, None if the order is not leased.
+        try:
+            with open(self.lease_path(uuid), "rb") as f:
+                return JobLease(**json.loads(f.read()))
+
+        except FileNotFoundError:
+            return None
+
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"Error reading the job lease [uuid:{uuid}]: {e!r}")
+            return None
+
+    def create(self, token: str, uuid: str, mac: Optional[str], payload: bytes, media_type: str) -> JobLease:
+        # Raises OSError if the job cannot be written.
+        lease = JobLease(token=token, uuid=uuid, mac=mac.lower() if mac else "",
+                         etag='"' + hashlib.md5(payload).hexdigest() + '"', size=len(payload),
+                         expires=time.time() + float(get_constant("CLOUDPRINT_JOB_LEASE", 600)),
+                         media_type=media_type)
+
+        # The job is written first, a lease always has its job.
+        self.write(self.job_path(uuid), payload)
+        self.write(self.lease_path(uuid), json.dumps(asdict(lease)).encode())
+
+        JobLeases.claimed += 1
+
+        return lease
+
+    def release(self, uuid: str) -> bool:
+        # Called when the printer confirmed the job. Returns False if the order was not leased.
+        try:
+            os.remove(self.lease_path(uuid))
+
+        except FileNotFoundError:
+            return False
+
+        self.remove_job(uuid)
+        JobLeases.released += 1
+
+        return True
+
+    def remove_job(self, uuid: str):
+        try:
+            os.remove(self.job_path(uuid))
+        except OSError:
+            pass
+
+    def sweep(self) -> list[str]:
+        # Remove the expired leases, returns the uuids of their orders. A lease removed by another worker
+        # process in the meantime is skipped, each expired lease is returned by one process only.
+        now = time.time()
+        expired = []
+
+        try:
+            entries = [entry.name for entry in os.scandir(self.folder()) if entry.name.endswith(".lease")]
+        except OSError:
+            return expired
+
+        for name in entries:
+            uuid = name[:-len(".lease")]
+            lease = self.load(uuid)
+
+            if lease is not None and lease.expires > now:
+                continue
+
+            try:
+                os.remove(self.lease_path(uuid))
+            except FileNotFoundError:
+                continue
+
+            self.remove_job(uuid)
+            expired.append(uuid)
+
+        JobLeases.expired += len(expired)
+
+        return expired
+
+    def start(self, on_expired):
+        # Must be called from the event loop, on application startup. on_expired(uuids) is awaited with the
+        # orders of the expired leases.
+        JobLeases._task = asyncio.get_running_loop().create_task(self.run(on_expired))
+
+    async def run(self, on_expired):
+        while True:
+            await asyncio.sleep(float(get_constant("CLOUDPRINT_JOB_LEASE_SWEEP_INTERVAL", 30)))
+
+            try:
+                expired = await asyncio.to_thread(self.sweep)
+
+                if len(expired) > 0:
+                    logger.info(f"[{len(expired)}] job leases expired without a DELETE from the printer.")
+                    await on_expired(expired)
+
+            except Exception as e:
+                logger.error(f"Error sweeping expired job leases: {e!r}")
+
+    async def stop(self):
+        # Called on application shutdown.
+        if JobLeases._task is not None:
+            JobLeases._task.cancel()
+
+            try:
+                await JobLeases._task
+            except asyncio.CancelledError:
+                pass
+
+            JobLeases._task = None
+
+    def stats(self) -> dict:
+        try:
+            leased = sum(1 for entry in os.scandir(self.folder()) if entry.name.endswith(".lease"))
+        except OSError:
+            leased = 0
+
+        return {
+            "leased": leased,
+            "claimed": JobLeases.claimed,
+            "replayed": JobLeases.replayed,
+            "released": JobLeases.released,
+            "expired": JobLeases.expired,
+        }
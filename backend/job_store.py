@@ -0,0 +1,220 @@
+from collections import OrderedDict
+from typing import Optional
+import logging
+import os
+import threading
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+# Marker kept in memory for orders that could not be rendered ahead of time.
+RENDER_FAILED = b""
+
+
+class JobStore:
+    # Rendered print job payloads keyed by order uuid. Payloads are kept in memory up to
+    # CLOUDPRINT_JOB_STORE_MEMORY_BYTES, beyond that the oldest payloads are spilled to
+    # <uuid>.cp files in the CLOUDPRINT_ORDER_TEMP_FOLDER and read back when the order is printed.
+    # The media type of each payload is kept with it, a payload is only served in its media type.
+
+    def __init__(self, memory_limit: int = None):
+        self.lock = threading.Lock()
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self._memory_limit = memory_limit
+
+        # uuids of payloads spilled to disk
+        self.spilled = set()
+
+        # uuid -> media type of the payload
+        self.media_types = {}
+
+    @property
+    def memory_limit(self) -> int:
+        # Read on use, the store is created before the environment constants are loaded.
+        if self._memory_limit is not None:
+            return self._memory_limit
+
+        return int(get_constant("CLOUDPRINT_JOB_STORE_MEMORY_BYTES", 64 * 1024 * 1024))
+
+    def __contains__(self, uuid: str) -> bool:
+        return uuid in self.memory or uuid in self.spilled
+
+    def __len__(self) -> int:
+        return len(self.memory) + len(self.spilled)
+
+    def _path(self, uuid: str) -> str:
+        return os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".cp")
+
+    def put(self, uuid: str, payload: Optional[bytes], media_type: str):
+
+        if payload is None:
+            payload = RENDER_FAILED
+
+        with self.lock:
+            self.memory[uuid] = payload
+            self.media_types[uuid] = media_type
+            self.memory_bytes += len(payload)
+
+            # Spill the oldest payloads to disk until the memory tier is within its limit. Spilling
+            # happens under the lock so that a concurrent take() never sees a partially written file.
+            for old_uuid in list(self.memory):
+                if self.memory_bytes <= self.memory_limit:
+                    break
+
+                old_payload = self.memory[old_uuid]
+
+                # Nothing to spill for orders that failed to render.
+                if len(old_payload) == 0:
+                    continue
+
+                try:
+                    with open(self._path(old_uuid), "wb") as f:
+                        f.write(old_payload)
+
+                except OSError as e:
+                    logger.error(f"Error spilling print job [uuid:{old_uuid}] to disk, keeping it in memory: {e!r}")
+                    break
+
+                del self.memory[old_uuid]
+                self.memory_bytes -= len(old_payload)
+                self.spilled.add(old_uuid)
+
+    def take(self, uuid: str, media_type: str) -> Optional[bytes]:
+        # Remove and return the payload of this order, None if it is not available, failed to render or
+        # was rendered in another media type.
+
+        with self.lock:
+            matches = self.media_types.pop(uuid, None) == media_type
+            payload = self.memory.pop(uuid, None)
+
+            if payload is not None:
+                self.memory_bytes -= len(payload)
+                return payload if len(payload) > 0 and matches else None
+
+            if uuid not in self.spilled:
+                return None
+
+            self.spilled.discard(uuid)
+
+        if not matches:
+            self.remove_spilled(uuid)
+            return None
+
+        try:
+            with open(self._path(uuid), "rb") as f:
+                payload = f.read()
+
+            os.remove(self._path(uuid))
+            return payload
+
+        except OSError as e:
+            logger.error(f"Error reading spilled print job [uuid:{uuid}]: {e!r}")
+            return None
+
+    def discard(self, uuid: str):
+        # Drop the payload of this order, if any, including a spilled copy on disk.
+
+        with self.lock:
+            self.media_types.pop(uuid, None)
+
+            payload = self.memory.pop(uuid, None)
+            if payload is not None:
+                self.memory_bytes -= len(payload)
+
+            if uuid not in self.spilled:
+                return
+
+            self.spilled.discard(uuid)
+
+        self.remove_spilled(uuid)
+
+    def remove_spilled(self, uuid: str):
+        try:
+            os.remove(self._path(uuid))
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "memory_limit": self.memory_limit,
+                "spilled_entries": len(self.spilled),
+            }
+
+
+class SharedJobStore:
+    # Rendered print job payloads shared by all the worker processes of a host (CLOUDPRINT_QUEUE_BACKEND=sqlite),
+    # as <uuid>.cp files in the CLOUDPRINT_ORDER_TEMP_FOLDER. A payload is written to a temporary file and
+    # renamed, a reader in another process never sees a partially written file. Orders that failed to render
+    # have no file, they are rendered inline when printed.
+    #
+    # The first line of a file is the media type of the payload, a payload is only served in its media type.
+
+    def __contains__(self, uuid: str) -> bool:
+        return os.path.exists(self._path(uuid))
+
+    def _path(self, uuid: str) -> str:
+        return os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".cp")
+
+    def put(self, uuid: str, payload: Optional[bytes], media_type: str):
+
+        if not payload:
+            return
+
+        path = self._path(uuid)
+        temporary = f"{path}.{os.getpid()}.tmp"
+
+        try:
+            with open(temporary, "wb") as f:
+                f.write(media_type.encode() + b"\n")
+                f.write(payload)
+
+            os.replace(temporary, path)
+
+        except OSError as e:
+            logger.error(f"Error writing print job [uuid:{uuid}] to disk, it will be rendered inline: {e!r}")
+
+    def take(self, uuid: str, media_type: str) -> Optional[bytes]:
+        # Remove and return the payload of this order, None if it is not available or was rendered in another
+        # media type. Only the process that claimed the order takes its payload.
+
+        try:
+            with open(self._path(uuid), "rb") as f:
+                rendered_as = f.readline().rstrip(b"\n").decode()
+                payload = f.read()
+
+        except FileNotFoundError:
+            return None
+
+        except OSError as e:
+            logger.error(f"Error reading print job [uuid:{uuid}]: {e!r}")
+            return None
+
+        self.discard(uuid)
+
+        return payload if rendered_as == media_type else None
+
+    def discard(self, uuid: str):
+        try:
+            os.remove(self._path(uuid))
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        folder = get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER")
+
+        try:
+            files = [entry for entry in os.scandir(folder) if entry.name.endswith(".cp")]
+        except OSError:
+            files = []
+
+        return {
+            "shared": True,
+            "disk_entries": len(files),
+            "disk_bytes": sum(entry.stat().st_size for entry in files),
+        }
@@ -0,0 +1,454 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+# Leading bytes of the image formats CPUtil reads, and the file extension of each.
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+)
+
+
+def image_extension(content: bytes) -> Optional[str]:
+    # None if the content is not an image, e.g. the HTML error page of the image host.
+    for signature, extension in IMAGE_SIGNATURES:
+        if content.startswith(signature):
+            return extension
+
+    return None
+
+
+@dataclass
+class LogoAsset:
+    # A logo downloaded to the CLOUDPRINT_LOGO_FOLDER, <url digest>.<content digest>.<extension>
+    path: str
+    size: int
+
+    # Epoch seconds the logo was downloaded or last found unchanged.
+    fetched: float
+
+    # time.monotonic() of the last check that its file exists.
+    checked: float = 0.0
+
+
+class LogoCache:
+    # Local copies of the restaurant logos. The receipt template prints the logo with [image: url ...], left to
+    # itself CPUtil downloads the image again on every conversion, and the receipt fails or waits whenever the
+    # image host does. Each distinct logo_url is downloaded once instead, checked to be an image of at most
+    # CLOUDPRINT_LOGO_MAX_BYTES, and stored in the CLOUDPRINT_LOGO_FOLDER; the markup references the local file.
+    # The file name includes a digest of the image, a changed logo is a new file and never served from the
+    # conversion or segment caches of the old one.
+    #
+    # Logos are downloaded again after CLOUDPRINT_LOGO_TTL seconds, in the background: until then, while the new
+    # download is in progress and whenever it fails the local copy is used. The folder is bounded by
+    # CLOUDPRINT_LOGO_CACHE_BYTES, the least recently used logos are removed first. With
+    # CLOUDPRINT_LOGO_OFFLINE=true nothing is downloaded, only logos preloaded with tools.logo_cache are used.
+    # A logo that is not available locally is printed from its URL, or from the CLOUDPRINT_LOGO_FALLBACK image
+    # if set.
+    #
+    # The folder is read and written off the event loop. The file of an indexed logo is checked to still exist
+    # at most every CLOUDPRINT_LOGO_CHECK_INTERVAL seconds, in between the renders rely on the in-memory index.
+
+    _self = None
+    _session: Optional[aiohttp.ClientSession] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    lock = threading.Lock()
+
+    # url digest -> LogoAsset, least recently used first.
+    assets = OrderedDict()
+    assets_bytes = 0
+    scanned = False
+
+    # url digest -> asyncio.Lock, so that concurrent renders download a logo once.
+    locks = {}
+
+    # url digest -> asyncio.Task downloading a stale logo again.
+    refreshing = {}
+
+    # url -> time.monotonic() of the last failed download.
+    failed = {}
+
+    # Counters exposed for tuning.
+    hits = 0
+    downloads = 0
+    refreshed = 0
+    failures = 0
+    evictions = 0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @staticmethod
+    def folder() -> str:
+        return os.path.abspath(get_constant("CLOUDPRINT_LOGO_FOLDER", "logos"))
+
+    @staticmethod
+    def is_enabled() -> bool:
+        # Set CLOUDPRINT_LOGO_CACHE=false to let CPUtil download the logos.
+        return get_constant("CLOUDPRINT_LOGO_CACHE", "true").lower() == "true"
+
+    @staticmethod
+    def is_offline() -> bool:
+        return get_constant("CLOUDPRINT_LOGO_OFFLINE", "false").lower() == "true"
+
+    @staticmethod
+    def digest(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+    def scan(self):
+        # Index the logos downloaded by a previous run or another worker process, oldest first. Only the newest
+        # logo of a URL is kept.
+        entries = []
+
+        try:
+            for entry in os.scandir(self.folder()):
+                parts = entry.name.split(".")
+
+                if len(parts) == 3 and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, parts[0], entry.path, stat.st_size))
+
+        except OSError:
+            pass
+
+        replaced = []
+
+        with self.lock:
+            for fetched, url_digest, path, size in sorted(entries):
+                replaced.append(self._index(url_digest, LogoAsset(path=path, size=size, fetched=fetched)))
+
+            LogoCache.scanned = True
+
+        for path in replaced:
+            if path is not None:
+                self.remove(path)
+
+        self._evict()
+
+    def find(self, url_digest: str) -> Optional[LogoAsset]:
+        # A logo downloaded by another worker process since the folder was scanned.
+        try:
+            names = [name for name in os.listdir(self.folder()) if name.startswith(url_digest + ".")]
+        except OSError:
+            return None
+
+        for name in names:
+            if name.count(".") != 2:
+                continue
+
+            path = os.path.join(self.folder(), name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            with self.lock:
+                self._index(url_digest, LogoAsset(path=path, size=stat.st_size, fetched=stat.st_mtime,
+                                                  checked=time.monotonic()))
+                return self.assets[url_digest]
+
+        return None
+
+    def cached(self, url_digest: str) -> Optional[LogoAsset]:
+        # The indexed logo of this url digest, if its file still exists: another worker process may have replaced
+        # it with a newer logo of the url, or evicted it, since it was indexed here. Reads the folder.
+        asset = self.assets.get(url_digest)
+
+        if asset is None:
+            return None
+
+        if os.path.exists(asset.path):
+            asset.checked = time.monotonic()
+            return asset
+
+        with self.lock:
+            if self.assets.get(url_digest) is asset:
+                del self.assets[url_digest]
+                LogoCache.assets_bytes -= asset.size
+
+        return None
+
+    def _index(self, url_digest: str, asset: LogoAsset):
+        # Called with the lock held. Returns the path of the logo it replaces, if any.
+        replaced = self.assets.pop(url_digest, None)
+
+        if replaced is not None:
+            LogoCache.assets_bytes -= replaced.size
+
+        self.assets[url_digest] = asset
+        LogoCache.assets_bytes += asset.size
+
+        if replaced is not None and replaced.path != asset.path:
+            return replaced.path
+
+        return None
+
+    async def indexed(self, url_digest: str) -> Optional[LogoAsset]:
+        # The indexed logo of this url digest, its file is checked off the event loop when it is due.
+        asset = self.assets.get(url_digest)
+
+        if asset is None:
+            return None
+
+        if time.monotonic() - asset.checked < float(get_constant("CLOUDPRINT_LOGO_CHECK_INTERVAL", 5)):
+            return asset
+
+        return await asyncio.to_thread(self.cached, url_digest)
+
+    def local(self, url: Optional[str]) -> Optional[str]:
+        # What the markup prints for the logo at this url: the path of its local copy, or the url itself. Called on
+        # the render path, after fetch: only reads the index.
+        if not url or not self.is_enabled():
+            return url
+
+        url_digest = self.digest(url)
+        asset = self.assets.get(url_digest)
+
+        if asset is not None:
+            with self.lock:
+                if url_digest in self.assets:
+                    self.assets.move_to_end(url_digest)
+
+            return asset.path
+
+        fallback = get_constant("CLOUDPRINT_LOGO_FALLBACK")
+
+        if fallback and (self.is_offline() or url in self.failed):
+            return os.path.abspath(fallback)
+
+        return url
+
+    async def fetch(self, url: Optional[str], wait: bool = False) -> Optional[LogoAsset]:
+        # Make sure the logo at this url is available locally, downloading it if it is not cached yet. A logo older
+        # than CLOUDPRINT_LOGO_TTL is returned as is and downloaded again in the background, the render does not
+        # wait on the image host; wait=True waits for the new download. Returns None if the logo is not available.
+        if not url or not self.is_enabled():
+            return None
+
+        if not LogoCache.scanned:
+            await asyncio.to_thread(self.scan)
+
+        url_digest = self.digest(url)
+        asset = await self.indexed(url_digest)
+
+        if self.is_fresh(asset):
+            LogoCache.hits += 1
+            return asset
+
+        if asset is None:
+            asset = await asyncio.to_thread(self.find, url_digest)
+
+            if self.is_fresh(asset):
+                LogoCache.hits += 1
+                return asset
+
+        # Failed recently, use the local copy if any until the next attempt.
+        failed = self.failed.get(url)
+        if failed is not None and time.monotonic() - failed < float(get_constant("CLOUDPRINT_LOGO_RETRY", 60)):
+            return asset
+
+        # Preloaded logos are used however old they are.
+        if self.is_offline():
+            return asset
+
+        if asset is None or wait:
+            return await self.refresh(url)
+
+        if url_digest not in self.refreshing:
+            task = asyncio.get_running_loop().create_task(self.refresh(url))
+            task.add_done_callback(lambda t: self.refreshing.pop(url_digest, None))
+            self.refreshing[url_digest] = task
+
+        return asset
+
+    async def refresh(self, url: str) -> Optional[LogoAsset]:
+        # Download the logo at this url again, once for concurrent callers. Returns the local copy if it fails.
+        url_digest = self.digest(url)
+        lock = self.locks.setdefault(url_digest, asyncio.Lock())
+
+        async with lock:
+            asset = await self.indexed(url_digest)
+
+            if self.is_fresh(asset):
+                LogoCache.hits += 1
+                return asset
+
+            downloaded = await self.download(url)
+
+            return downloaded if downloaded is not None else asset
+
+    @staticmethod
+    def is_fresh(asset: Optional[LogoAsset]) -> bool:
+        return asset is not None and time.time() - asset.fetched < float(get_constant("CLOUDPRINT_LOGO_TTL", 86400))
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # Created lazily, bound to the running event loop.
+        loop = asyncio.get_running_loop()
+
+        if LogoCache._session is None or LogoCache._session.closed or LogoCache._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=int(get_constant("CLOUDPRINT_LOGO_HTTP_POOL_SIZE", 8)))
+            timeout = aiohttp.ClientTimeout(total=float(get_constant("CLOUDPRINT_LOGO_HTTP_TIMEOUT", 10)))
+
+            LogoCache._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            LogoCache._loop = loop
+
+        return LogoCache._session
+
+    async def close(self):
+        # Close the shared session and its connection pool, called on application shutdown.
+        for task in list(self.refreshing.values()):
+            task.cancel()
+
+        if LogoCache._session is not None and not LogoCache._session.closed:
+            await LogoCache._session.close()
+
+        LogoCache._session = None
+        LogoCache._loop = None
+
+    async def download(self, url: str) -> Optional[LogoAsset]:
+        max_bytes = int(get_constant("CLOUDPRINT_LOGO_MAX_BYTES", 1024 * 1024))
+
+        try:
+            async with self.get_session().get(url) as response:
+                response.raise_for_status()
+                content = await response.content.read(max_bytes + 1)
+
+            if len(content) > max_bytes:
+                raise ValueError(f"logo is larger than [{max_bytes}] bytes")
+
+            asset = await asyncio.to_thread(self.store, url, content)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, OSError) as e:
+            LogoCache.failures += 1
+            self.failed[url] = time.monotonic()
+
+            logger.warning(f"Error downloading logo [{url}], using the local copy if any: {e!r}")
+            return None
+
+        self.failed.pop(url, None)
+
+        return asset
+
+    def store(self, url: str, content: bytes) -> LogoAsset:
+        # Raises ValueError if the content is not an image, OSError if it cannot be written.
+        extension = image_extension(content)
+
+        if extension is None:
+            raise ValueError("logo is not a PNG, JPEG, GIF or BMP image")
+
+        content_digest = hashlib.sha256(content).hexdigest()[:16]
+        path = os.path.join(self.folder(), f"{self.digest(url)}.{content_digest}.{extension}")
+
+        if os.path.exists(path):
+            # Same logo as before, only its age is reset.
+            os.utime(path)
+            LogoCache.refreshed += 1
+
+        else:
+            os.makedirs(self.folder(), exist_ok=True)
+
+            # Written to a temporary file and renamed, CPUtil never reads a partially written logo.
+            temporary = f"{path}.{os.getpid()}.tmp"
+
+            with open(temporary, "wb") as f:
+                f.write(content)
+
+            os.replace(temporary, path)
+
+            LogoCache.downloads += 1
+            logger.info(f"Logo [{url}] cached as [{path}], [{len(content)}] bytes.")
+
+        asset = LogoAsset(path=path, size=len(content), fetched=time.time(), checked=time.monotonic())
+
+        with self.lock:
+            replaced = self._index(self.digest(url), asset)
+
+        # The previous logo of this url, the logo changed.
+        if replaced is not None:
+            self.remove(replaced)
+
+        self._evict()
+
+        return asset
+
+    def preload(self, url: str, file: str) -> LogoAsset:
+        # Cache the image in this file as the logo of url, for running without access to the image host.
+        if not LogoCache.scanned:
+            self.scan()
+
+        with open(file, "rb") as f:
+            return self.store(url, f.read())
+
+    async def warm_up(self, urls) -> int:
+        # Download the logos of these urls ahead of the first receipt, e.g. of the restaurants with orders
+        # pending on startup. Waits at most CLOUDPRINT_LOGO_WARMUP_TIMEOUT seconds, slower downloads go on in
+        # the background. Returns the number of logos available locally.
+        urls = {url for url in urls if url}
+
+        if len(urls) == 0 or not self.is_enabled():
+            return 0
+
+        tasks = [asyncio.get_running_loop().create_task(self.fetch(url)) for url in urls]
+        done, _ = await asyncio.wait(tasks, timeout=float(get_constant("CLOUDPRINT_LOGO_WARMUP_TIMEOUT", 5)))
+
+        available = sum(1 for task in done if task.exception() is None and task.result() is not None)
+
+        logger.info(f"Logo cache warmed up, [{available}] of [{len(urls)}] logos available locally.")
+
+        return available
+
+    def _evict(self):
+        limit = int(get_constant("CLOUDPRINT_LOGO_CACHE_BYTES", 64 * 1024 * 1024))
+        evicted = []
+
+        with self.lock:
+            while LogoCache.assets_bytes > limit and len(self.assets) > 1:
+                _, asset = self.assets.popitem(last=False)
+                LogoCache.assets_bytes -= asset.size
+                LogoCache.evictions += 1
+                evicted.append(asset.path)
+
+        for path in evicted:
+            self.remove(path)
+
+    @staticmethod
+    def remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.assets),
+                "bytes": LogoCache.assets_bytes,
+                "limit": int(get_constant("CLOUDPRINT_LOGO_CACHE_BYTES", 64 * 1024 * 1024)),
+                "offline": self.is_offline(),
+                "hits": LogoCache.hits,
+                "downloads": LogoCache.downloads,
+                "refreshed": LogoCache.refreshed,
+                "failures": LogoCache.failures,
+                "failing": len(self.failed),
+                "evictions": LogoCache.evictions,
+            }
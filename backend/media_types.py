@@ -0,0 +1,212 @@
+from typing import Optional
+import asyncio
+import logging
+import time
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+# Print job encodings CPUtil can produce, see `cputil decode`. The native command streams are a fraction of the
+# size of the raster and image encodings of the same receipt, which print the text as bitmaps.
+CPUTIL_MEDIA_TYPES = (
+    "application/vnd.star.starprnt",
+    "application/vnd.star.line",
+    "application/vnd.star.starprntcore",
+    "application/vnd.star.linematrix",
+    "application/vnd.star.raster",
+    "image/png",
+    "image/jpeg",
+    "image/bmp",
+)
+
+
+def default_media_type() -> str:
+    return get_constant("CPUTIL_OUTPUT_FORMAT", CPUTIL_MEDIA_TYPES[0])
+
+
+# Encodings whose print jobs can be assembled from separately converted header, body and footer segments: their
+# CPUtil output is a stream of commands that only set up the text they print, so segments concatenate into the
+# receipt of the whole template. Raster and image jobs are one bitmap with its own size header and cannot be
+# concatenated. CLOUDPRINT_SEGMENTED_MEDIA_TYPES overrides this list, e.g. to leave out an encoding a printer
+# model prints wrongly when segmented; the other encodings are always converted as a whole receipt.
+SEGMENTABLE_MEDIA_TYPES = (
+    "application/vnd.star.starprnt",
+    "application/vnd.star.starprntcore",
+    "application/vnd.star.line",
+    "application/vnd.star.linematrix",
+)
+
+
+def is_segmentable(media_type: str) -> bool:
+    configured = get_constant("CLOUDPRINT_SEGMENTED_MEDIA_TYPES")
+
+    if configured is not None:
+        return media_type.lower() in [segmented.strip().lower() for segmented in configured.split(",")]
+
+    return media_type.lower() in SEGMENTABLE_MEDIA_TYPES
+
+
+class MediaTypes:
+    # Negotiates the encoding of the print jobs with each printer. The POST poll response offers the encodings
+    # of CLOUDPRINT_MEDIA_TYPES, in order of preference, that the printer supports; the printer GETs the job in
+    # the first one it supports. The encodings a printer supports are requested once with the "Encodings" client
+    # action, until they are known all the encodings are offered.
+    #
+    # The encoding negotiated by the printer of a restaurant is the one its orders are rendered in ahead of time.
+    # With CLOUDPRINT_QUEUE_BACKEND=sqlite it is shared by the worker processes through the database.
+
+    _self = None
+
+    # Pluggable store of the negotiated encodings, set on startup when the worker processes share the queues.
+    shared_store = None
+
+    # restaurant_code -> media type
+    negotiated = {}
+
+    # restaurant_code -> time.monotonic() the encoding was loaded from the shared store.
+    loaded = {}
+
+    # restaurant_code -> asyncio.Task loading the encoding from the shared store again.
+    refreshing = {}
+
+    # media type -> [jobs, bytes, largest job], of the jobs sent to the printers.
+    payloads = {}
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @staticmethod
+    def preference() -> list[str]:
+        configured = get_constant("CLOUDPRINT_MEDIA_TYPES")
+
+        if configured:
+            return [media_type.strip().lower() for media_type in configured.split(",") if media_type.strip()]
+
+        # Default: the configured CPUtil output format, then the most compact encodings first.
+        default = default_media_type()
+        return [default] + [media_type for media_type in CPUTIL_MEDIA_TYPES if media_type != default]
+
+    @staticmethod
+    def parse_encodings(client_actions: Optional[list]) -> Optional[list[str]]:
+        # The encodings reported by the printer in response to the "Encodings" client action, a semicolon
+        # separated list. None if the poll does not carry the response.
+        for client_action in client_actions or []:
+            if not isinstance(client_action, dict) or client_action.get("request") != "Encodings":
+                continue
+
+            result = client_action.get("result")
+
+            if isinstance(result, str):
+                result = result.split(";")
+
+            if isinstance(result, list):
+                encodings = [str(encoding).strip().lower() for encoding in result if str(encoding).strip()]
+
+                if len(encodings) > 0:
+                    return encodings
+
+        return None
+
+    def offered(self, supported: Optional[list[str]]) -> list[str]:
+        # The encodings offered to a printer, the printer picks the first one it supports.
+        preference = self.preference()
+
+        if supported is None:
+            return preference
+
+        offered = [media_type for media_type in preference if media_type in supported]
+
+        if len(offered) == 0:
+            logger.warning(f"Printer supports none of the configured media types, encodings reported: {supported}")
+            return preference
+
+        return offered
+
+    def select(self, restaurant_code: str, media_type: str):
+        # The printer of this restaurant prints jobs in this encoding.
+        restaurant_code = restaurant_code.lower()
+
+        if self.negotiated.get(restaurant_code) == media_type:
+            return
+
+        logger.info(f"Print jobs of [{restaurant_code}] are rendered as [{media_type}].")
+        self.negotiated[restaurant_code] = media_type
+
+        if self.shared_store is not None:
+            self.shared_store.save(restaurant_code, media_type)
+            self.loaded[restaurant_code] = time.monotonic()
+
+    def requested(self, restaurant_code: str, media_type: Optional[str]) -> str:
+        # Encoding of a GET, the media type the printer picked from the offered ones. GETs without a known
+        # media type get the encoding negotiated for the restaurant. Reads the shared store, called on the route
+        # threads when there is one.
+        if media_type is not None and media_type.lower() in self.preference():
+            self.select(restaurant_code, media_type.lower())
+            return media_type.lower()
+
+        return self.load(restaurant_code)
+
+    def is_stale(self, restaurant_code: str) -> bool:
+        if self.shared_store is None:
+            return False
+
+        loaded = self.loaded.get(restaurant_code)
+
+        return loaded is None or time.monotonic() - loaded > float(get_constant("CLOUDPRINT_MEDIA_TYPE_TTL", 60))
+
+    def load(self, restaurant_code: str) -> str:
+        # Encoding negotiated for this restaurant, loaded again from the shared store if it is stale.
+        restaurant_code = restaurant_code.lower()
+
+        if self.is_stale(restaurant_code):
+            media_type = self.shared_store.load(restaurant_code)
+
+            if media_type is not None:
+                self.negotiated[restaurant_code] = media_type
+
+            self.loaded[restaurant_code] = time.monotonic()
+
+        return self.negotiated.get(restaurant_code) or self.preference()[0]
+
+    async def refresh(self, restaurant_code: str):
+        try:
+            await asyncio.to_thread(self.load, restaurant_code)
+        except Exception as e:
+            logger.error(f"Error loading the media type of [{restaurant_code}]: {e!r}")
+        finally:
+            self.refreshing.pop(restaurant_code, None)
+
+    def for_restaurant(self, restaurant_code: str) -> str:
+        # Encoding the orders of this restaurant are rendered in ahead of time. Called from the event loop, it does
+        # not wait on the shared store: a stale encoding is loaded again in the background, orders are rendered in
+        # the encoding known until then.
+        restaurant_code = restaurant_code.lower()
+
+        if self.is_stale(restaurant_code) and restaurant_code not in self.refreshing:
+            self.refreshing[restaurant_code] = asyncio.get_running_loop().create_task(self.refresh(restaurant_code))
+
+        return self.negotiated.get(restaurant_code) or self.preference()[0]
+
+    def record(self, media_type: str, size: int):
+        # A job of this size was sent to a printer.
+        jobs = self.payloads.setdefault(media_type, [0, 0, 0])
+
+        jobs[0] += 1
+        jobs[1] += size
+        jobs[2] = max(jobs[2], size)
+
+    def stats(self) -> dict:
+        restaurants = {}
+        for media_type in self.negotiated.values():
+            restaurants[media_type] = restaurants.get(media_type, 0) + 1
+
+        return {
+            "preference": self.preference(),
+            "restaurants": restaurants,
+            "payloads": {media_type: {"jobs": jobs, "bytes": size, "avg_bytes": size // jobs, "max_bytes": largest}
+                         for media_type, (jobs, size, largest) in self.payloads.items()},
+        }
@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+import hashlib
+import json
+import logging
+import os
+
+from pydantic import ValidationError
+from pydantic_core import from_json
+
+from backend.order_queue import OrderQueue, order_key
+from backend.schemas import BodyItem, CloudPrintOrdersEnvelope
+from backend.shard_ring import ShardRing
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+# Key of the orders without restaurant_code, order_id or cloud_print_id.
+UNIDENTIFIED_ORDER = ("?", "?", "?")
+
+
+@dataclass
+class DecodedOrders:
+    envelope: CloudPrintOrdersEnvelope
+
+    # New orders, fully validated.
+    orders: list = field(default_factory=list)
+
+    # cloud_print_id of every order received, including duplicates and quarantined orders.
+    cloud_print_ids: list = field(default_factory=list)
+
+    duplicates: int = 0
+    quarantined: int = 0
+
+    # Orders of restaurants of other shard nodes.
+    foreign: int = 0
+
+    @property
+    def cursor(self) -> Optional[str]:
+        return self.envelope.cursor
+
+    @property
+    def has_more(self) -> bool:
+        return bool(self.envelope.has_more)
+
+
+class OrderDecoder:
+    # Deserializes the orders list returned by the POTLAM backend in two steps. The envelope is parsed
+    # first with the orders left as plain json, and only the identity fields (restaurant_code, order_id,
+    # cloud_print_id) of each order are read. Orders already in the queues are skipped without validating
+    # their nested models, only the new orders are validated into BodyItems, one at a time.
+    #
+    # An order that fails validation does not fail the others: it is quarantined, written once to
+    # CLOUDPRINT_QUARANTINE_FOLDER with its validation errors, and skipped. At most CLOUDPRINT_QUARANTINE_MAX
+    # quarantined orders are remembered, the least recently returned are forgotten first and written again if
+    # the POTLAM backend still returns them. With sharding, the orders of the restaurants of other nodes are
+    # skipped as well.
+
+    _self = None
+
+    # order_key -> (digest of the order, validation error) of the quarantined orders, least recently
+    # returned first.
+    quarantine = OrderedDict()
+
+    # Counters exposed for tuning.
+    decoded = 0
+    validated = 0
+    duplicates = 0
+    quarantined = 0
+    foreign = 0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    def decode(self, response_text: str) -> DecodedOrders:
+        # Raises ValueError if the response is not json, ValidationError if the envelope itself is invalid.
+        # Parsing the json first and validating the parsed envelope leaves the orders as they are, validating
+        # the json directly would copy every order into a new dict.
+        envelope = CloudPrintOrdersEnvelope.model_validate(from_json(response_text))
+        decoded = DecodedOrders(envelope=envelope)
+
+        queue = OrderQueue()
+        ring = ShardRing()
+
+        for item in envelope.body:
+
+            try:
+                restaurant_code = str(item["restaurant_code"])
+                order_id = str(item["order_id"])
+                cloud_print_id = str(item["cloud_print_id"])
+
+            except (KeyError, TypeError):
+                self.quarantine_order(UNIDENTIFIED_ORDER, item,
+                                      "Order without restaurant_code, order_id or cloud_print_id.")
+                decoded.quarantined += 1
+                continue
+
+            decoded.cloud_print_ids.append(cloud_print_id)
+
+            if not ring.is_local(restaurant_code):
+                decoded.foreign += 1
+                continue
+
+            if queue.has_order(restaurant_code, order_id, cloud_print_id):
+                decoded.duplicates += 1
+                continue
+
+            key = order_key(restaurant_code, order_id, cloud_print_id)
+
+            try:
+                decoded.orders.append(BodyItem.model_validate(item))
+                self.quarantine.pop(key, None)
+
+            except ValidationError as e:
+                self.quarantine_order(key, item, str(e))
+                decoded.quarantined += 1
+
+        OrderDecoder.decoded += len(envelope.body)
+        OrderDecoder.validated += len(decoded.orders)
+        OrderDecoder.duplicates += decoded.duplicates
+        OrderDecoder.quarantined += decoded.quarantined
+        OrderDecoder.foreign += decoded.foreign
+
+        return decoded
+
+    def quarantine_order(self, key: tuple, item, error: str):
+        digest = hashlib.sha256(json.dumps(item, sort_keys=True, default=str).encode()).hexdigest()[:12]
+        name = "_".join(key + (digest,))
+
+        # The orders without identity fields all have the same key, they are told apart by their content.
+        if key == UNIDENTIFIED_ORDER:
+            key = key + (digest,)
+
+        # The POTLAM backend returns the order again on every fetch, it is written and logged only once.
+        if self.quarantine.get(key) == (digest, error):
+            self.quarantine.move_to_end(key)
+            return
+
+        self.quarantine[key] = (digest, error)
+        self.quarantine.move_to_end(key)
+
+        while len(self.quarantine) > int(get_constant("CLOUDPRINT_QUARANTINE_MAX", 1000)):
+            self.quarantine.popitem(last=False)
+
+        logger.error(f"Order [{key[0]}] [order_id:{key[1]}] [cloudprint_id:{key[2]}] failed validation, "
+                     f"quarantined: {error}")
+
+        folder = get_constant("CLOUDPRINT_QUARANTINE_FOLDER", "quarantine")
+
+        try:
+            os.makedirs(folder, exist_ok=True)
+
+            with open(os.path.join(folder, name.replace(os.sep, "-") + ".json"), "w") as f:
+                json.dump({"error": error, "order": item}, f, indent=2, default=str)
+
+        except OSError as e:
+            logger.error(f"Error writing quarantined order: {e!r}")
+
+    def stats(self) -> dict:
+        return {
+            "decoded": OrderDecoder.decoded,
+            "validated": OrderDecoder.validated,
+            "duplicates": OrderDecoder.duplicates,
+            "quarantined": OrderDecoder.quarantined,
+            "foreign": OrderDecoder.foreign,
+            "quarantine": len(self.quarantine),
+        }
@@ -1,92 +1,245 @@
 from collections import deque
+from typing import Optional
 import logging
+import threading
 
+from backend.job_store import JobStore
 from backend.schemas import BodyItem
+from database.cloudprint_db import load_order
+from database.db_writer import DatabaseWriter
+from libs.constants import get_constant
 
 logger = logging.getLogger(__name__)
 
 
+def order_key(restaurant_code: str, order_id: str, cloud_print_id: str) -> tuple:
+    return restaurant_code.lower(), order_id, cloud_print_id
+
+
+def job_token(restaurant_code: str, order_id: str, cloud_print_id: str, uuid: str) -> str:
+    # Job token of an order, takes the form: <restaurant_code>_<order_id>_<cloud_print_id>_<uuid>
+    return restaurant_code.lower() + "_" + order_id + "_" + cloud_print_id + "_" + uuid
+
+
+def parse_job_token(token: Optional[str]) -> Optional[tuple[str, str, str, str]]:
+    # (restaurant_code, order_id, cloud_print_id, uuid) of a job token, None if it is not a job token. Split from
+    # the right, the restaurant code may contain underscores. The uuid names the files of the job, it must not
+    # contain a path separator.
+    parts = (token or "").rsplit("_", 3)
+
+    if len(parts) != 4 or not all(parts) or "/" in parts[3] or "\\" in parts[3]:
+        return None
+
+    return parts[0], parts[1], parts[2], parts[3]
+
+
 class OrderQueue:
     queues = {}
 
+    # Membership index of the orders in the queues, keyed by (restaurant_code, order_id, cloud_print_id).
+    # Gives constant time duplicate checks and removal of a specific order. A removed order stays in
+    # its restaurant's deque until it reaches the end of the deque, where it is skipped: an entry in a
+    # deque is live only while the index maps its key to that same order object.
+    index = {}
+
+    # Number of live orders in the queue of each restaurant.
+    counts = {}
+
+    lock = threading.RLock()
+
+    # The queues are in memory, their methods can be called from the event loop.
+    blocking = False
+
+    # Rendered print job payloads keyed by order uuid, an order is ready to be printed once
+    # its payload is available. If rendering ahead of time failed, the GET falls back to
+    # rendering the order inline.
+    payloads = JobStore()
+
     _self = None
 
     def __new__(cls):
+        # With CLOUDPRINT_QUEUE_BACKEND=sqlite the queues are shared by the worker processes, decided on
+        # every call as the environment constants are loaded after this module is imported.
+        if cls is OrderQueue:
+            from backend.shared_queue import is_shared_queue, SharedOrderQueue
+
+            if is_shared_queue():
+                return SharedOrderQueue()
+
         # Create an instance of this class only if it does not already exist.
         if cls._self is None:
             cls._self = super().__new__(cls)
         return cls._self
 
-    def add_order(self, order: BodyItem):
+    def add_order(self, order: BodyItem, front: bool = False) -> bool:
+        # Returns True if the order was added, False if it already exists in the queue.
+        # front=True puts the order at the front of the queue, it is the next one to be popped.
 
-        queue = self.queues.get(order.restaurant_code.lower())
+        key = order_key(order.restaurant_code, order.order_id, order.cloud_print_id)
 
-        # TODO: Check whether an order with the same order_id, cloud_print_id and restaurant_code exists
-        #  in the queue. Do NOT add the order if it already exists.
-        #  There is a chance of duplicate orders in the queue IF the status of the orders is
-        #  updated with a delay OR not updated.
+        with self.lock:
+            # Do NOT add the order if an order with the same order_id, cloud_print_id and restaurant_code
+            # already exists in the queue.
+            if key in self.index:
+                logger.info(f"Order already in CloudPrint Queue [{order.restaurant_code}] "
+                            f"[order_id:{order.order_id}] [cloudprint_id:{order.cloud_print_id}], not added.")
+                return False
 
-        if queue is not None:
-            queue.appendleft(order)
-        else:
-            queue = deque([order])
+            queue = self.queues.get(key[0])
+
+            if queue is not None and front:
+                queue.append(order)
+            elif queue is not None:
+                queue.appendleft(order)
+            else:
+                queue = deque([order])
 
-        # Add this order to the queue of this restaurant
-        self.queues[order.restaurant_code.lower()] = queue
+            # Add this order to the queue of this restaurant
+            self.queues[key[0]] = queue
+            self.index[key] = order
+            self.counts[key[0]] = self.counts.get(key[0], 0) + 1
 
         logger.info(f"Order added to CloudPrint Queue [{order.restaurant_code}] "
                     f"[order_id:{order.order_id}] [cloudprint_id:{order.cloud_print_id}]")
 
+        return True
+
+    def _is_live(self, order: BodyItem) -> bool:
+        return self.index.get(order_key(order.restaurant_code, order.order_id, order.cloud_print_id)) is order
+
+    def _next_order(self, restaurant_code: str) -> Optional[BodyItem]:
+        # Next order to be popped, skipping orders that were removed from the queue.
+        queue = self.queues.get(restaurant_code.lower())
+
+        while queue:
+            if self._is_live(queue[-1]):
+                return queue[-1]
+
+            queue.pop()
+
+        return None
+
+    def restaurants(self) -> list[str]:
+        # Restaurants with orders in the queues.
+        return [restaurant_code for restaurant_code, count in list(self.counts.items()) if count > 0]
+
     def get_orders(self, restaurant_code: str) -> deque:
-        return self.queues.get(restaurant_code)
+        queue = self.queues.get(restaurant_code.lower())
+
+        if queue is None:
+            return None
+
+        with self.lock:
+            return deque(order for order in queue if self._is_live(order))
 
     def pop_order(self, restaurant_code: str) -> BodyItem:
-        return self.queues.get(restaurant_code.lower()).pop()
+
+        with self.lock:
+            order = self._next_order(restaurant_code)
+
+            if order is None:
+                raise IndexError(f"pop from an empty queue [{restaurant_code}]")
+
+            self.queues.get(restaurant_code.lower()).pop()
+            self.index.pop(order_key(order.restaurant_code, order.order_id, order.cloud_print_id), None)
+            self.counts[restaurant_code.lower()] -= 1
+
+        return order
+
+    def claim_order(self, restaurant_code: str, order_id: str, cloud_print_id: str, uuid: str) -> Optional[BodyItem]:
+        # Remove a specific order from the queue to print it, keeping its rendered payload. Returns the order,
+        # None if it is not in the queue.
+
+        key = order_key(restaurant_code, order_id, cloud_print_id)
+
+        with self.lock:
+            order = self.index.get(key)
+
+            if order is None or order.uuid != uuid:
+                return None
+
+            del self.index[key]
+            self.counts[key[0]] -= 1
+
+        return order
+
+    def remove_order(self, restaurant_code: str, order_id: str, cloud_print_id: str) -> Optional[BodyItem]:
+        # Remove a specific order from the queue, e.g. a cancelled order. Returns the removed order,
+        # None if it is not in the queue.
+
+        key = order_key(restaurant_code, order_id, cloud_print_id)
+
+        with self.lock:
+            order = self.index.pop(key, None)
+
+            if order is None:
+                return None
+
+            self.counts[key[0]] -= 1
+
+        # Its rendered payload is no longer needed.
+        self.payloads.discard(order.uuid)
+
+        logger.info(f"Order removed from CloudPrint Queue [{restaurant_code}] "
+                    f"[order_id:{order_id}] [cloudprint_id:{cloud_print_id}]")
+
+        return order
+
+    def requeue_order(self, uuid: str) -> Optional[BodyItem]:
+        # Put an order claimed for printing back in the queue, e.g. when the printer did not confirm it was
+        # printed before its job lease expired. It goes back at the front of the queue, it was the next order
+        # to be printed. Returns the order, None if it is no longer in progress. Reads the order from the database.
+
+        order = load_order(uuid, str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
+
+        if order is None or not self.add_order(order, front=True):
+            return None
+
+        DatabaseWriter().update_status(uuid, str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
+
+        return order
 
     def length(self, restaurant_code: str) -> int:
-        if self.queues.get(restaurant_code.lower()) is not None:
-            return len(self.queues.get(restaurant_code.lower()))
-        else:
-            return 0
+        return self.counts.get(restaurant_code.lower(), 0)
 
-    # True if queue exists and length of queue is > 0 for this restaurant
-    # False otherwise
+    # True if queue exists, length of queue is > 0 for this restaurant and the next order
+    # to be popped has been rendered; False otherwise
     def is_job_ready(self, restaurant_code: str) -> bool:
-        if (self.queues.get(restaurant_code.lower()) is not None
-                and len(self.queues.get(restaurant_code.lower())) > 0):
+        with self.lock:
+            next_order = self._next_order(restaurant_code)
+
+        if next_order is not None and next_order.uuid in self.payloads:
             return True
         else:
             return False
 
-    def is_order_in_queue(self, restaurant_code: str, order: BodyItem) -> bool:
+    def mark_ready(self, uuid: str, payload: Optional[bytes], media_type: str):
+        self.payloads.put(uuid, payload, media_type)
 
-        orders = self.get_orders(restaurant_code.lower())
+    def take_payload(self, uuid: str, media_type: str) -> Optional[bytes]:
+        # Remove and return the rendered payload for this order, None if it is not ready or was
+        # rendered in another media type.
+        return self.payloads.take(uuid, media_type)
 
-        if orders is None or len(orders) == 0:
-            return False
-        else:
-
-            for existing_order in orders:
+    def discard_payload(self, uuid: str):
+        self.payloads.discard(uuid)
 
-                if existing_order.order_id == order.order_id:
-                    return True
+    def is_order_in_queue(self, restaurant_code: str, order: BodyItem) -> bool:
+        return order_key(restaurant_code, order.order_id, order.cloud_print_id) in self.index
 
-            return False
+    def has_order(self, restaurant_code: str, order_id: str, cloud_print_id: str) -> bool:
+        # Same as is_order_in_queue, for orders not deserialized into a BodyItem yet.
+        return order_key(restaurant_code, order_id, cloud_print_id) in self.index
 
     def get_token_for_next_order(self, restaurant_code: str) -> str:
 
         # This function will be called / used only if the queue has items;
         # that is, is_job_ready function returns true for this restaurant.
 
-        queue_length = self.length(restaurant_code)
-
         # Get the next order that will be popped without popping the queue.
-        next_order = self.queues.get(restaurant_code.lower())[queue_length - 1]
+        with self.lock:
+            next_order = self._next_order(restaurant_code)
 
         # Construct the job token, takes the form: <restaurant_code>_<order_id>_<cloud_print_id>_<uuid>
         # the UUID in this token is used in the DELETE method to remove tmp files and db entry.
-        token = (restaurant_code.lower() + "_" + next_order.order_id + "_" + next_order.cloud_print_id
-                 + "_" + next_order.uuid)
-
-        return token
-
+        return job_token(restaurant_code, next_order.order_id, next_order.cloud_print_id, next_order.uuid)
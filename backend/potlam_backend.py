@@ -1,8 +1,13 @@
+import asyncio
 import json
 import logging
+from typing import Optional
+
+import aiohttp
 import requests
 
 from libs.constants import get_constant
+from backend.order_decoder import DecodedOrders, OrderDecoder
 from backend.schemas import CloudPrintOrdersModel
 from backend.services import PotlamService, PotlamBulkUpdateOrderStatusService, PotlamUpdateOrderStatusService
 
@@ -69,23 +74,126 @@ class PotlamBackend:
         return json.dumps(self, default=lambda o: o.__dict__)
 
 
-def bulk_update_status(in_progress_orders: list):
-    # Bulk update status of orders in POTLAM Backend
+class AsyncPotlamBackend:
+    # Non-blocking variant of PotlamBackend used from the event loop (cron, route handlers).
+    # All instances share a single aiohttp session, so connections to the POTLAM backend are
+    # kept alive and re-used instead of paying a new TCP/TLS handshake for every service call.
+    params: PotlamService
+
+    _session: Optional[aiohttp.ClientSession] = None
+    _semaphore: Optional[asyncio.Semaphore] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __init__(self, params: PotlamService = None):
+        self.params = params
+
+        # True once a service call of this instance failed, to tell a failed call from an empty response.
+        self.failed = False
+
+    @classmethod
+    def get_session(cls) -> aiohttp.ClientSession:
+
+        # Create the shared session lazily, it must be created from within the running event loop
+        # and is bound to that loop.
+        loop = asyncio.get_running_loop()
+
+        if cls._session is None or cls._session.closed or cls._loop is not loop:
+
+            connector = aiohttp.TCPConnector(
+                limit=int(get_constant("POTLAM_HTTP_POOL_SIZE", 10)),
+                keepalive_timeout=float(get_constant("POTLAM_HTTP_KEEPALIVE_TIMEOUT", 60)))
+
+            timeout = aiohttp.ClientTimeout(
+                total=float(get_constant("POTLAM_HTTP_TOTAL_TIMEOUT", 30)),
+                connect=float(get_constant("POTLAM_HTTP_CONNECT_TIMEOUT", 10)))
+
+            cls._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+            # Limits the number of POTLAM service calls in flight at any time.
+            cls._semaphore = asyncio.Semaphore(int(get_constant("POTLAM_HTTP_MAX_CONCURRENCY", 4)))
+            cls._loop = loop
+
+        return cls._session
+
+    @classmethod
+    async def close(cls):
+        # Close the shared session and its connection pool, called on application shutdown.
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+
+        cls._session = None
+        cls._semaphore = None
+        cls._loop = None
+
+    async def do_post(self, url) -> Optional[str]:
+
+        session = self.get_session()
+
+        try:
+
+            # Make the POTLAM backend POST service call
+            async with self._semaphore:
+                async with session.post(url, data=self.params.to_json()) as response:
+                    response.raise_for_status()
+                    return await response.text()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"[backend:do_post] Error making POST request to [{url}]: {e!r}")
+            self.failed = True
+
+        return None
+
+    async def update_order_status(self):
+
+        # Create the service url for Print Status Update from the env constants
+        service_url = get_constant("POTLAM_BACKEND_HOST") + get_constant("POTLAM_STATUS_UPDATE")
+
+        await self.do_post(service_url)
+
+    async def bulk_update_order_status(self) -> bool:
+
+        # Create the service url for Bulk Print Status Update from the env constants
+        service_url = get_constant("POTLAM_BACKEND_HOST") + get_constant("POTLAM_MULTI_STATUS_UPDATE")
+
+        return await self.do_post(service_url) is not None
+
+    async def fetch_cloudprint_orders(self) -> Optional[DecodedOrders]:
+
+        # Create the service url from the env constants
+        service_url = get_constant("POTLAM_BACKEND_HOST") + get_constant("POTLAM_PRINT_LIST")
+
+        response_text = await self.do_post(service_url)
+
+        # response text is empty if there are no more pending orders to print in POTLAM database.
+        if not response_text:
+            return None
+
+        # Deserialize the response, only the new orders are validated into BodyItems.
+        try:
+            return OrderDecoder().decode(response_text)
+
+        except ValueError as e:
+            logger.error(f"Error deserializing response into CloudPrintOrdersEnvelope: {e!r}")
+            self.failed = True
+
+
+async def bulk_update_status(in_progress_orders: list) -> bool:
+    # Bulk update status of orders in POTLAM Backend, returns False if the service call failed.
     update_orders_status = PotlamBulkUpdateOrderStatusService(order_list=in_progress_orders)
     update_orders_status.public_key = get_constant("POTLAM_BACKEND_PUBLIC_KEY")
 
-    potlam_backend = PotlamBackend(params=update_orders_status)
+    potlam_backend = AsyncPotlamBackend(params=update_orders_status)
 
-    potlam_backend.bulk_update_order_status()
+    return await potlam_backend.bulk_update_order_status()
 
 
-def update_status(cloud_print_id: str, status: str):
+async def update_status(cloud_print_id: str, status: str):
     # Update status of a single order in the POTLAM Backend
     update_order_status = PotlamUpdateOrderStatusService(cloud_print_id=cloud_print_id, status=status)
     update_order_status.public_key = get_constant("POTLAM_BACKEND_PUBLIC_KEY")
 
-    potlam_backend = PotlamBackend(params=update_order_status)
+    potlam_backend = AsyncPotlamBackend(params=update_order_status)
 
     logger.info(f"Updating status of order [cloudprint_id:{cloud_print_id}] to [status:{status}] in POTLAM backend.")
 
-    potlam_backend.update_order_status()
+    await potlam_backend.update_order_status()
@@ -0,0 +1,180 @@
+from typing import Optional
+import asyncio
+import logging
+import os
+
+from backend.media_types import MediaTypes
+from backend.order_queue import OrderQueue
+from backend.schemas import BodyItem
+from libs.constants import get_constant
+from replace_template import render_print_job
+
+logger = logging.getLogger(__name__)
+
+
+class RenderPipeline:
+    # Renders print jobs ahead of time, as soon as an order is added to the queue, so that the
+    # printer's GET request only has to serve the prepared bytes. Renders are run by a fixed number of
+    # worker tasks on the event loop, CLOUDPRINT_RENDER_WORKERS, taking the orders from a queue in the order
+    # they were submitted: a fetch of thousands of orders does not start thousands of renders at once. Orders
+    # are rendered ahead of time in the media type negotiated with the printer of their restaurant.
+
+    _self = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # Pending renders keyed by order uuid: (media type, future of the payload).
+    tasks = {}
+
+    # Orders waiting for a worker: (order, media type, future), and the uuids of the orders being rendered.
+    jobs: Optional[asyncio.Queue] = None
+    rendering = set()
+    workers = []
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @staticmethod
+    def worker_count() -> int:
+        # Twice the CPUtil processes by default, renders also wait on logos and cached segments.
+        return int(get_constant("CLOUDPRINT_RENDER_WORKERS",
+                                2 * int(get_constant("CPUTIL_MAX_PROCESSES", os.cpu_count() or 2))))
+
+    def start(self):
+        # Started on the first submit, from the event loop.
+        loop = asyncio.get_running_loop()
+
+        if RenderPipeline._loop is loop and len(self.workers) > 0:
+            return
+
+        RenderPipeline._loop = loop
+        RenderPipeline.jobs = asyncio.Queue()
+        RenderPipeline.workers = [loop.create_task(self.work()) for _ in range(self.worker_count())]
+
+    def submit(self, order: BodyItem):
+        # Must be called from the event loop.
+        self.start()
+
+        media_type = MediaTypes().for_restaurant(order.restaurant_code)
+
+        future = asyncio.get_running_loop().create_future()
+        self.tasks[order.uuid] = (media_type, future)
+
+        future.add_done_callback(lambda f: self._on_rendered(order, media_type, f))
+
+        self.jobs.put_nowait((order, media_type, future))
+
+    async def work(self):
+        while True:
+            order, media_type, future = await self.jobs.get()
+
+            # Cancelled while waiting for a worker, e.g. rendered inline for the printer's GET.
+            if future.done():
+                continue
+
+            self.rendering.add(order.uuid)
+
+            try:
+                payload = await render_print_job(order, media_type)
+
+                if not future.done():
+                    future.set_result(payload)
+
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+            finally:
+                self.rendering.discard(order.uuid)
+
+    def _on_rendered(self, order: BodyItem, media_type: str, task: asyncio.Future):
+
+        # The order was already claimed by a GET request and rendered inline, nothing to do.
+        if self.tasks.pop(order.uuid, None) is None:
+            return
+
+        payload = None
+        if not task.cancelled():
+            try:
+                payload = task.result()
+            except Exception as e:
+                logger.error(f"Error rendering order [{order.restaurant_code}] [order_id:{order.order_id}] "
+                             f"[cloudprint_id:{order.cloud_print_id}]: {e!r}")
+
+        # The shared queues check the order and store its payload in the database and the job folder, off the
+        # event loop.
+        if OrderQueue().blocking:
+            asyncio.get_running_loop().run_in_executor(None, self._store, order, payload, media_type)
+        else:
+            self._store(order, payload, media_type)
+
+    @staticmethod
+    def _store(order: BodyItem, payload: Optional[bytes], media_type: str):
+        queue = OrderQueue()
+
+        try:
+            # The order was removed from the queue while it was rendered.
+            if not queue.is_order_in_queue(order.restaurant_code, order):
+                return
+
+            # Mark this order as ready to be printed. If the render failed the payload is None and the
+            # order will be rendered inline when the printer requests it.
+            queue.mark_ready(order.uuid, payload, media_type)
+
+        except Exception as e:
+            logger.error(f"Error storing the rendered order [{order.restaurant_code}] [order_id:{order.order_id}] "
+                         f"[cloudprint_id:{order.cloud_print_id}], it is rendered inline: {e!r}")
+
+    async def render_now(self, order: BodyItem, media_type: str) -> Optional[bytes]:
+
+        # Called when the printer requests an order whose payload is not ready, or was rendered ahead of time
+        # in another media type.
+        rendering = self.tasks.pop(order.uuid, None)
+
+        if rendering is None:
+            # The render may have completed since the payload was checked.
+            payload = OrderQueue().take_payload(order.uuid, media_type)
+            if payload is not None:
+                return payload
+
+        elif order.uuid not in self.rendering:
+            # Still waiting for a worker, rendered now rather than behind the orders submitted before it.
+            rendering[1].cancel()
+
+        elif rendering[0] == media_type:
+            task = rendering[1]
+
+            # Render is already in progress, wait for it instead of rendering twice.
+            try:
+                payload = await asyncio.wait_for(asyncio.shield(task),
+                                                 timeout=float(get_constant("CLOUDPRINT_RENDER_TIMEOUT", 30)))
+                if payload is not None:
+                    return payload
+
+            except asyncio.TimeoutError:
+                logger.error(f"Timed out waiting for render of order [{order.restaurant_code}] "
+                             f"[order_id:{order.order_id}], rendering inline.")
+            except Exception as e:
+                logger.error(f"Error rendering order [{order.restaurant_code}] [order_id:{order.order_id}]: {e!r}")
+
+        logger.info(f"Rendering order inline [{order.restaurant_code}] [order_id:{order.order_id}] "
+                    f"[cloudprint_id:{order.cloud_print_id}]")
+
+        return await render_print_job(order, media_type)
+
+    def shutdown(self):
+        # Cancel pending renders and stop the workers.
+        for _, task in list(self.tasks.values()):
+            task.cancel()
+
+        for worker in self.workers:
+            worker.cancel()
+
+        self.tasks.clear()
+        RenderPipeline.workers = []
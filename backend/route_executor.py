@@ -0,0 +1,169 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+import anyio.to_thread
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+
+class RouteExecutor:
+    # Runs the blocking work of the CloudPRNT route handlers, e.g. the database reads and claims of the shared
+    # queues, on a dedicated pool of CLOUDPRINT_ROUTE_THREADS threads instead of the event loop, so that a slow
+    # database does not hold up the other requests. The time a call waits for a free thread is measured.
+    #
+    # The size of Starlette's default thread pool, used for the sync handlers and background tasks, is set to
+    # CLOUDPRINT_THREADPOOL_SIZE on startup if configured.
+
+    _self = None
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    lock = threading.Lock()
+
+    # Counters exposed for tuning.
+    calls = 0
+    running = 0
+    waits_ms = deque(maxlen=500)
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @property
+    def max_workers(self) -> int:
+        return int(get_constant("CLOUDPRINT_ROUTE_THREADS", 8))
+
+    def configure(self):
+        # Must be called from the event loop, on application startup.
+        threadpool_size = get_constant("CLOUDPRINT_THREADPOOL_SIZE")
+
+        if threadpool_size:
+            anyio.to_thread.current_default_thread_limiter().total_tokens = int(threadpool_size)
+
+    def executor(self) -> ThreadPoolExecutor:
+        # Created on first use, after the environment constants have been loaded.
+        with self.lock:
+            if RouteExecutor._executor is None:
+                RouteExecutor._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                             thread_name_prefix="route")
+            return RouteExecutor._executor
+
+    async def run(self, function, *args, blocking: bool = True):
+        # Run function(*args) on the route threads, or directly on the event loop if it does not block.
+        if not blocking:
+            return function(*args)
+
+        submitted = time.perf_counter()
+
+        def timed():
+            RouteExecutor.waits_ms.append((time.perf_counter() - submitted) * 1000)
+            RouteExecutor.running += 1
+
+            try:
+                return function(*args)
+            finally:
+                RouteExecutor.running -= 1
+
+        RouteExecutor.calls += 1
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor(), timed)
+
+    def shutdown(self):
+        # Called on application shutdown.
+        with self.lock:
+            if RouteExecutor._executor is not None:
+                RouteExecutor._executor.shutdown(wait=False, cancel_futures=True)
+                RouteExecutor._executor = None
+
+    def stats(self) -> dict:
+        waits = sorted(RouteExecutor.waits_ms)
+        executor = RouteExecutor._executor
+
+        return {
+            "route_threads": self.max_workers,
+            "route_calls": RouteExecutor.calls,
+            "route_running": RouteExecutor.running,
+            "route_queued": executor._work_queue.qsize() if executor is not None else 0,
+            "route_wait_ms_avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+            "route_wait_ms_p95": round(waits[int(len(waits) * 0.95)], 3) if waits else 0.0,
+            "route_wait_ms_max": round(waits[-1], 3) if waits else 0.0,
+        }
+
+
+class RestaurantLocks:
+    # One asyncio lock per restaurant, held while a GET claims the restaurant's next job, so that two concurrent
+    # GETs of the same restaurant cannot both find an order and then race to pop it. GETs of different
+    # restaurants do not wait on each other. Locks are dropped once no request holds or waits on them.
+
+    _self = None
+
+    locks = weakref.WeakValueDictionary()
+
+    # Counters exposed for tuning.
+    claims = 0
+    contended = 0
+    waits_ms = deque(maxlen=500)
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @asynccontextmanager
+    async def claim(self, restaurant_code: str):
+        # Must be used from the event loop.
+        lock = self.locks.get(restaurant_code.lower())
+
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[restaurant_code.lower()] = lock
+
+        RestaurantLocks.claims += 1
+
+        if lock.locked():
+            RestaurantLocks.contended += 1
+            start = time.perf_counter()
+
+            await lock.acquire()
+
+            RestaurantLocks.waits_ms.append((time.perf_counter() - start) * 1000)
+        else:
+            await lock.acquire()
+
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self) -> dict:
+        waits = RestaurantLocks.waits_ms
+
+        return {
+            "claim_locks": len(self.locks),
+            "claims": RestaurantLocks.claims,
+            "claims_contended": RestaurantLocks.contended,
+            "claim_wait_ms_max": round(max(waits), 3) if waits else 0.0,
+        }
+
+
+def threadpool_stats() -> dict:
+    # Starlette's default thread pool, shared by the sync route handlers and the background tasks.
+    # Must be called from the event loop.
+    statistics = anyio.to_thread.current_default_thread_limiter().statistics()
+
+    return {
+        "threadpool_size": statistics.total_tokens,
+        "threadpool_busy": statistics.borrowed_tokens,
+        "threadpool_waiting": statistics.tasks_waiting,
+    }
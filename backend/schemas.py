@@ -1,8 +1,9 @@
 from __future__ import annotations
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field
 from pydantic import BaseModel
 from pydantic.dataclasses import dataclass
-from typing import List, Optional, Union
+from typing import Any, List, Optional, Union
 
 import json
 
@@ -163,13 +164,62 @@ class CloudPrintOrdersModel(BaseModel):
     body: List[BodyItem]
 
 
+# Envelope of the orders list response, the orders are left as parsed json until they are known to be new
+# (see backend/order_decoder.py). An incremental fetch (see backend/fetch_cursor.py) returns the orders after
+# the cursor in pages; cursor is the high-water mark of this page and has_more is true if more pages follow.
+class CloudPrintOrdersEnvelope(BaseModel):
+    status: int
+    message: str
+    body: List[Any]
+    cursor: Optional[str] = None
+    has_more: Optional[bool] = False
+
+
 # Database table schema to track the print status of each order.
 # This is also saved in memory but may not be long lived as it may be lost due to
 # an application shutdown, termination, system shutdown etc. Hence, persisting the
 # orders also in the database.
+#
+# Indexes support the lookups by restaurant_code and order_id (reconciling fetched orders, cleanup)
+# and by restaurant_code and status (pending orders of a restaurant).
 class CloudPrintOrderStatus(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_cloudprintorderstatus_restaurant_code_order_id", "restaurant_code", "order_id"),
+        Index("ix_cloudprintorderstatus_restaurant_code_status", "restaurant_code", "status"),
+    )
+
     uuid: str = Field(primary_key=True, default=None)
     restaurant_code: str | None
     cloud_print_id: str | None
     order_id: str | None
     status: str | None
+
+    # zlib compressed BodyItem json, used to rebuild the print queues after a restart.
+    payload: bytes | None = None
+
+
+# Small key / value state of the service that must survive a restart, e.g. the incremental fetch cursor.
+class ServiceState(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    value: str | None
+
+
+# Acknowledgement of the orders pushed by the POTLAM backend to the ingest route, one per order
+# in the order they were received. status is one of the INGEST_* values below.
+INGEST_QUEUED = "queued"
+INGEST_DUPLICATE = "duplicate"
+INGEST_REJECTED = "rejected"
+INGEST_ERROR = "error"
+
+
+class IngestAck(BaseModel):
+    restaurant_code: Optional[str] = None
+    order_id: Optional[str] = None
+    cloud_print_id: Optional[str] = None
+    status: str
+    detail: Optional[str] = None
+
+
+class IngestResponse(BaseModel):
+    queued: int
+    items: List[IngestAck]
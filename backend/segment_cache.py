@@ -0,0 +1,118 @@
+from dataclasses import dataclass
+from typing import Optional
+import asyncio
+import hashlib
+import logging
+
+from backend.schemas import RestaurantDetails
+from libs.cputil import convert_markup
+from libs.receipt_template import CompiledTemplate
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RestaurantSegments:
+    # Converted header and footer of the receipts of a restaurant.
+    key: str
+    header: bytes
+    footer: bytes
+
+
+class SegmentCache:
+    # Per restaurant cache of the converted static header (logo, name, address, phone) and footer
+    # (message) of the print order template. Every receipt of a restaurant is assembled from these
+    # cached segments and the converted order body, the logo is dithered once per restaurant.
+    #
+    # Segments are cached per restaurant and print job media type. An entry is keyed on a hash of the
+    # RestaurantDetails, the logo printed (its URL or local copy, see LogoCache), the template and the media type;
+    # the entry is replaced as soon as any of these change.
+
+    _self = None
+
+    # (restaurant_code, media type) -> RestaurantSegments
+    segments = {}
+
+    # (restaurant_code, media type) -> asyncio.Lock, so that concurrent orders of a restaurant convert its
+    # segments once.
+    locks = {}
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @staticmethod
+    def make_key(restaurant_details: RestaurantDetails, logo: Optional[str], template: CompiledTemplate,
+                 media_type: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(restaurant_details.model_dump_json().encode())
+        digest.update(b"\0")
+        digest.update(str(logo).encode())
+        digest.update(b"\0")
+        digest.update(template.digest.encode())
+        digest.update(b"\0")
+        digest.update(media_type.encode())
+
+        return digest.hexdigest()
+
+    async def get(self, restaurant_code: str, restaurant_details: RestaurantDetails,
+                  template: CompiledTemplate, values: dict, media_type: str) -> Optional[RestaurantSegments]:
+
+        cached = (restaurant_code.lower(), media_type)
+        key = self.make_key(restaurant_details, values.get("LOGO_IMAGE_URL"), template, media_type)
+
+        segments = self.segments.get(cached)
+        if segments is not None and segments.key == key:
+            return segments
+
+        lock = self.locks.setdefault(cached, asyncio.Lock())
+
+        async with lock:
+            segments = self.segments.get(cached)
+            if segments is not None and segments.key == key:
+                return segments
+
+            segments = await self.convert(key, template, values, media_type)
+
+            if segments is not None:
+                if cached in self.segments:
+                    logger.info(f"Restaurant details or template changed for [{restaurant_code}], "
+                                f"header and footer segments re-rendered.")
+
+                self.segments[cached] = segments
+
+            return segments
+
+    @staticmethod
+    async def convert(key: str, template: CompiledTemplate, values: dict,
+                      media_type: str) -> Optional[RestaurantSegments]:
+
+        converted = {}
+
+        for name in ("header", "footer"):
+            section = template.section(name)
+
+            if section is None:
+                converted[name] = b""
+                continue
+
+            # Only the static restaurant values may be used in the header and footer.
+            order_placeholders = section.placeholders - values.keys()
+            if len(order_placeholders) > 0:
+                logger.warning(f"Template section [{name}] uses order placeholders {sorted(order_placeholders)}, "
+                               f"it cannot be cached per restaurant.")
+                return None
+
+            payload = await convert_markup(section.render(values).encode("utf-8"), media_type)
+            if payload is None:
+                return None
+
+            converted[name] = payload
+
+        return RestaurantSegments(key=key, header=converted["header"], footer=converted["footer"])
+
+    def invalidate(self, restaurant_code: str):
+        for cached in [cached for cached in self.segments if cached[0] == restaurant_code.lower()]:
+            self.segments.pop(cached, None)
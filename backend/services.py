@@ -20,6 +20,13 @@ class PotlamUpdateOrderStatusService(PotlamService):
 
 
 class PotlamOrdersListService(PotlamService):
+    # Set for an incremental fetch only: orders after this cloud_print_id, at most page_size orders.
+    since_cloud_print_id: str = None
+    page_size: int = None
 
     def __init__(self):
         super().__init__()
+
+    def to_json(self):
+        # The incremental fetch fields are left out of a full fetch.
+        return json.dumps({key: value for key, value in self.__dict__.items() if value is not None})
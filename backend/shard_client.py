@@ -0,0 +1,126 @@
+from typing import Optional
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from backend.schemas import BodyItem, IngestAck, IngestResponse, INGEST_ERROR
+from backend.shard_ring import FORWARDED_HEADER, sign_forwarded
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+# Hop-by-hop and recomputed headers, not copied to the forwarded request or response.
+SKIPPED_HEADERS = {"host", "content-length", "connection", "keep-alive", "transfer-encoding", "content-encoding"}
+
+
+class ShardClient:
+    # Forwards requests to the other shard nodes: printer requests that reached the wrong node when
+    # CLOUDPRINT_SHARD_ROUTING=proxy, and orders pushed by the POTLAM backend for restaurants of another node.
+    # All calls share one aiohttp session, connections to the other nodes are kept alive.
+
+    _session: Optional[aiohttp.ClientSession] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # Counters exposed for tuning.
+    proxied = 0
+    orders_forwarded = 0
+    errors = 0
+
+    @classmethod
+    def get_session(cls) -> aiohttp.ClientSession:
+
+        # Create the shared session lazily, it must be created from within the running event loop
+        # and is bound to that loop.
+        loop = asyncio.get_running_loop()
+
+        if cls._session is None or cls._session.closed or cls._loop is not loop:
+
+            connector = aiohttp.TCPConnector(limit=int(get_constant("CLOUDPRINT_SHARD_HTTP_POOL_SIZE", 20)))
+            timeout = aiohttp.ClientTimeout(total=float(get_constant("CLOUDPRINT_SHARD_HTTP_TIMEOUT", 10)))
+
+            cls._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            cls._loop = loop
+
+        return cls._session
+
+    @classmethod
+    async def close(cls):
+        # Close the shared session and its connection pool, called on application shutdown.
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+
+        cls._session = None
+        cls._loop = None
+
+    @classmethod
+    def forwarded_headers(cls, headers, method: str, path: str) -> dict:
+        # The forwarded header is signed for the method and path of the request, see sign_forwarded. A header
+        # sent by the client is never passed on.
+        forwarded = {name: value for name, value in headers.items()
+                     if name.lower() not in SKIPPED_HEADERS and name.lower() != FORWARDED_HEADER.lower()}
+
+        signature = sign_forwarded(method, path)
+        if signature is not None:
+            forwarded[FORWARDED_HEADER] = signature
+
+        return forwarded
+
+    @classmethod
+    async def proxy(cls, method: str, url: str, path: str, headers,
+                    body: bytes) -> Optional[tuple[int, dict, bytes]]:
+        # Returns the status, headers and body of the response of the other node, None if it could not be reached.
+        try:
+            async with cls.get_session().request(method, url, headers=cls.forwarded_headers(headers, method, path),
+                                                 data=body) as response:
+                content = await response.read()
+                ShardClient.proxied += 1
+
+                return response.status, {name: value for name, value in response.headers.items()
+                                          if name.lower() not in SKIPPED_HEADERS}, content
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            ShardClient.errors += 1
+            logger.error(f"Error proxying [{method} {url}] to its shard node: {e!r}")
+
+        return None
+
+    @classmethod
+    async def forward_orders(cls, node: str, orders: list[BodyItem], authorization: Optional[str]) -> list[IngestAck]:
+        # Push orders to the ingest route of their node. Returns an acknowledgement for each order, in the same order.
+
+        body = json.dumps({"status": 1, "message": "Forwarded",
+                           "body": [order.model_dump(mode="json", exclude={"uuid"}) for order in orders]})
+
+        headers = cls.forwarded_headers({"Authorization": authorization} if authorization else {}, "POST",
+                                        "/ingest/orders")
+        headers["Content-Type"] = "application/json"
+
+        try:
+            async with cls.get_session().post(node + "/ingest/orders", data=body, headers=headers) as response:
+                response.raise_for_status()
+                acks = IngestResponse.model_validate_json(await response.read()).items
+
+            if len(acks) != len(orders):
+                raise ValueError(f"[{len(acks)}] acknowledgements received for [{len(orders)}] orders")
+
+            ShardClient.orders_forwarded += len(orders)
+
+            return acks
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            ShardClient.errors += 1
+            logger.error(f"Error forwarding [{len(orders)}] orders to shard node [{node}]: {e!r}")
+
+        return [IngestAck(restaurant_code=order.restaurant_code, order_id=order.order_id,
+                          cloud_print_id=order.cloud_print_id, status=INGEST_ERROR,
+                          detail="Order could not be forwarded to its shard node.") for order in orders]
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "proxied": ShardClient.proxied,
+            "orders_forwarded": ShardClient.orders_forwarded,
+            "errors": ShardClient.errors,
+        }
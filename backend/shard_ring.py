@@ -0,0 +1,215 @@
+from bisect import bisect
+from typing import Optional
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+# Header of the requests forwarded by another node, served where they land even if the ring of this node
+# disagrees, e.g. while a membership change is being rolled out.
+FORWARDED_HEADER = "X-CloudPrint-Forwarded"
+
+
+def forwarded_signature(timestamp: str, method: str, path: str) -> Optional[str]:
+    # HMAC of a forwarded request with CLOUDPRINT_SHARD_SECRET, the secret shared by the nodes of the cluster.
+    # None while no secret is configured.
+    secret = get_constant("CLOUDPRINT_SHARD_SECRET")
+
+    if not secret:
+        return None
+
+    message = timestamp + "\n" + method.upper() + "\n" + path
+
+    return hmac.new(secret.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+
+def sign_forwarded(method: str, path: str) -> Optional[str]:
+    # Value of the FORWARDED_HEADER of a request forwarded to another node: <timestamp>:<signature>.
+    timestamp = str(int(time.time()))
+    signature = forwarded_signature(timestamp, method, path)
+
+    return timestamp + ":" + signature if signature is not None else None
+
+
+def is_forwarded(headers, method: str, path: str) -> bool:
+    # True if the request was forwarded by another node of the cluster. Anyone can send the header, it is only
+    # trusted with a valid signature at most CLOUDPRINT_SHARD_SIGNATURE_MAX_AGE seconds old; without a
+    # CLOUDPRINT_SHARD_SECRET no request is taken as forwarded.
+    value = headers.get(FORWARDED_HEADER)
+
+    if not value:
+        return False
+
+    timestamp, _, signature = value.partition(":")
+    expected = forwarded_signature(timestamp, method, path)
+
+    if expected is None or not hmac.compare_digest(signature.encode(), expected.encode()):
+        return False
+
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        return False
+
+    return age <= float(get_constant("CLOUDPRINT_SHARD_SIGNATURE_MAX_AGE", 60))
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def parse_nodes(nodes: str) -> list[str]:
+    # Comma or newline separated node base urls, e.g. "http://10.0.0.1:8000,http://10.0.0.2:8000".
+    return sorted({node.strip().rstrip("/") for node in nodes.replace("\n", ",").split(",") if node.strip()})
+
+
+class ShardRing:
+    # Partitions the restaurants between the service nodes with consistent hashing: every node is placed
+    # CLOUDPRINT_SHARD_VNODES times on a hash ring, a restaurant belongs to the first node after the hash of
+    # its restaurant_code. A node only fetches and accepts the orders of its restaurants, printer requests for
+    # the other restaurants are redirected or proxied to their node. Adding or removing a node only moves the
+    # restaurants between that node and its neighbours on the ring.
+    #
+    # Sharding is enabled by CLOUDPRINT_SHARD_SELF, the base url of this node as the other nodes reach it,
+    # with the nodes listed in CLOUDPRINT_SHARD_NODES or, to change the membership without a restart, one per
+    # line in the CLOUDPRINT_SHARD_NODES_FILE, re-read every CLOUDPRINT_SHARD_RELOAD_INTERVAL seconds.
+
+    _self = None
+    _task: Optional[asyncio.Task] = None
+
+    node: Optional[str] = None
+    nodes: list = []
+    points: list = []
+    owners: list = []
+
+    nodes_file_mtime = 0.0
+
+    # Counters exposed for tuning.
+    rebalances = 0
+    restaurants_moved = 0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @property
+    def enabled(self) -> bool:
+        return ShardRing.node is not None
+
+    def configure(self):
+        # Called on application startup, after the environment constants have been loaded.
+        node = get_constant("CLOUDPRINT_SHARD_SELF")
+
+        if not node:
+            return
+
+        ShardRing.node = node.strip().rstrip("/")
+        self.build(self.read_nodes() or [ShardRing.node])
+
+    def read_nodes(self) -> list[str]:
+        nodes_file = get_constant("CLOUDPRINT_SHARD_NODES_FILE")
+
+        if nodes_file:
+            try:
+                ShardRing.nodes_file_mtime = os.path.getmtime(nodes_file)
+
+                with open(nodes_file) as f:
+                    return parse_nodes(f.read())
+
+            except OSError as e:
+                logger.error(f"Error reading the shard nodes file [{nodes_file}], keeping the current nodes: {e!r}")
+                return ShardRing.nodes
+
+        return parse_nodes(get_constant("CLOUDPRINT_SHARD_NODES", ""))
+
+    def build(self, nodes: list[str]):
+        vnodes = int(get_constant("CLOUDPRINT_SHARD_VNODES", 64))
+
+        ring = sorted((ring_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(vnodes))
+
+        ShardRing.nodes = list(nodes)
+        ShardRing.points = [point for point, _ in ring]
+        ShardRing.owners = [node for _, node in ring]
+
+        logger.info(f"Shard ring of [{len(nodes)}] nodes: {nodes}, this node [{ShardRing.node}].")
+
+        if ShardRing.node not in nodes:
+            logger.warning(f"This node [{ShardRing.node}] is not in the shard ring, all restaurants are forwarded.")
+
+    def owner(self, restaurant_code: str) -> Optional[str]:
+        # Base url of the node of this restaurant, None if sharding is disabled.
+        if not self.enabled or len(ShardRing.points) == 0:
+            return None
+
+        index = bisect(ShardRing.points, ring_hash(restaurant_code.lower())) % len(ShardRing.points)
+
+        return ShardRing.owners[index]
+
+    def is_local(self, restaurant_code: str) -> bool:
+        owner = self.owner(restaurant_code)
+
+        return owner is None or owner == ShardRing.node
+
+    def start(self, on_rebalance):
+        # Must be called from the event loop, on application startup. on_rebalance() is awaited after every
+        # membership change, it releases the restaurants that moved to another node and returns their number.
+        if self.enabled and get_constant("CLOUDPRINT_SHARD_NODES_FILE"):
+            ShardRing._task = asyncio.get_running_loop().create_task(self.run(on_rebalance))
+
+    async def run(self, on_rebalance):
+        nodes_file = get_constant("CLOUDPRINT_SHARD_NODES_FILE")
+
+        while True:
+            await asyncio.sleep(float(get_constant("CLOUDPRINT_SHARD_RELOAD_INTERVAL", 10)))
+
+            try:
+                if os.path.getmtime(nodes_file) == ShardRing.nodes_file_mtime:
+                    continue
+
+                nodes = self.read_nodes()
+                if nodes == ShardRing.nodes:
+                    continue
+
+                await self.rebalance(nodes, on_rebalance)
+
+            except Exception as e:
+                logger.error(f"Error reloading the shard nodes: {e!r}")
+
+    async def rebalance(self, nodes: list[str], on_rebalance):
+        previous = ShardRing.nodes
+        self.build(nodes)
+
+        ShardRing.rebalances += 1
+        logger.info(f"Shard membership changed from {previous} to {nodes}.")
+
+        moved = await on_rebalance()
+        ShardRing.restaurants_moved += moved
+
+    async def stop(self):
+        # Called on application shutdown.
+        if ShardRing._task is not None:
+            ShardRing._task.cancel()
+
+            try:
+                await ShardRing._task
+            except asyncio.CancelledError:
+                pass
+
+            ShardRing._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "node": ShardRing.node,
+            "nodes": ShardRing.nodes,
+            "rebalances": ShardRing.rebalances,
+            "restaurants_moved": ShardRing.restaurants_moved,
+        }
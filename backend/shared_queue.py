@@ -0,0 +1,179 @@
+from collections import deque
+from typing import Optional
+import logging
+import threading
+import time
+
+from backend.job_store import SharedJobStore
+from backend.order_queue import job_token, OrderQueue, order_key
+from backend.schemas import BodyItem
+from database.cloudprint_db import claim_next_pending_order, count_pending_orders, delete_pending_order, \
+    deserialize_order, is_order_pending, load_pending_keys, load_pending_orders, load_pending_restaurants, load_state, \
+    next_pending_order, transition_order, write_states
+from database.db_writer import DatabaseWriter
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+
+def is_shared_queue() -> bool:
+    # CLOUDPRINT_QUEUE_BACKEND=sqlite shares the print queues between the worker processes of a host,
+    # e.g. uvicorn --workers N. The default "memory" keeps them in the process.
+    return str(get_constant("CLOUDPRINT_QUEUE_BACKEND", "memory")).lower() == "sqlite"
+
+
+class SharedOrderQueue(OrderQueue):
+    # Print queues shared by all the worker processes, with the same interface as the OrderQueue. The orders
+    # pending in the database table are the queues: an order is added by the database writer when it is
+    # ingested, and claimed by a GET request by setting its status to CLOUDPRINT_STATUS_PRINT_IN_PROGRESS in a
+    # single statement, so a printer's POST and GET see the same next order whichever worker they land on,
+    # and two workers never print the same order.
+    #
+    # Rendered payloads are shared as files, see SharedJobStore. An order is ready to be printed as soon as it
+    # is pending, whether or not its payload has been rendered yet: the worker rendering it ahead of time may
+    # not be the one answering the printer's POST, the GET renders it inline if needed.
+
+    _self = None
+
+    # The queues are read from the database, the route handlers call their methods on the route threads.
+    blocking = True
+
+    payloads = SharedJobStore()
+
+    # Keys of the pending orders, read at most every CLOUDPRINT_SHARED_QUEUE_SNAPSHOT_TTL seconds,
+    # for the duplicate checks of the fetched orders.
+    snapshot = set()
+    snapshot_at = 0.0
+    snapshot_lock = threading.Lock()
+
+    def pending_keys(self) -> set:
+        ttl = float(get_constant("CLOUDPRINT_SHARED_QUEUE_SNAPSHOT_TTL", 1))
+
+        with self.snapshot_lock:
+            if time.monotonic() - SharedOrderQueue.snapshot_at > ttl:
+                SharedOrderQueue.snapshot = load_pending_keys()
+                SharedOrderQueue.snapshot_at = time.monotonic()
+
+            return SharedOrderQueue.snapshot
+
+    def add_order(self, order: BodyItem, front: bool = False) -> bool:
+        # The order was added to the database table, pending, when it was ingested.
+        self.pending_keys().add(order_key(order.restaurant_code, order.order_id, order.cloud_print_id))
+
+        logger.info(f"Order added to shared CloudPrint Queue [{order.restaurant_code}] "
+                    f"[order_id:{order.order_id}] [cloudprint_id:{order.cloud_print_id}]")
+
+        return True
+
+    def restaurants(self) -> list[str]:
+        return load_pending_restaurants()
+
+    def get_orders(self, restaurant_code: str) -> deque:
+        # Same order as the in-process queues, the next order to be popped last.
+        return deque(reversed(load_pending_orders(restaurant_code)))
+
+    def pop_order(self, restaurant_code: str) -> BodyItem:
+
+        claimed = claim_next_pending_order(restaurant_code,
+                                           str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
+
+        if claimed is None:
+            raise IndexError(f"pop from an empty queue [{restaurant_code}]")
+
+        uuid, payload = claimed
+
+        return deserialize_order(uuid, payload)
+
+    def claim_order(self, restaurant_code: str, order_id: str, cloud_print_id: str, uuid: str) -> Optional[BodyItem]:
+        claimed = transition_order(uuid, str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")),
+                                   str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")), restaurant_code)
+
+        return deserialize_order(*claimed) if claimed is not None else None
+
+    def requeue_order(self, uuid: str) -> Optional[BodyItem]:
+        # The order keeps its row, it is back at its place in the queue, ahead of the orders added after it.
+        requeued = transition_order(uuid, str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")),
+                                    str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
+
+        return deserialize_order(*requeued) if requeued is not None else None
+
+    def remove_order(self, restaurant_code: str, order_id: str, cloud_print_id: str) -> Optional[BodyItem]:
+        # Removing an order from the shared queues deletes it from the database.
+        removed = delete_pending_order(restaurant_code, order_id, cloud_print_id)
+
+        if removed is None:
+            return None
+
+        uuid, payload = removed
+        self.payloads.discard(uuid)
+        self.pending_keys().discard(order_key(restaurant_code, order_id, cloud_print_id))
+
+        logger.info(f"Order removed from shared CloudPrint Queue [{restaurant_code}] "
+                    f"[order_id:{order_id}] [cloudprint_id:{cloud_print_id}]")
+
+        return deserialize_order(uuid, payload)
+
+    def length(self, restaurant_code: str) -> int:
+        return count_pending_orders(restaurant_code)
+
+    def is_job_ready(self, restaurant_code: str) -> bool:
+        return next_pending_order(restaurant_code) is not None
+
+    def mark_ready(self, uuid: str, payload: Optional[bytes], media_type: str):
+        # The order may have been claimed by another worker while it was rendered.
+        if is_order_pending(uuid):
+            self.payloads.put(uuid, payload, media_type)
+
+    def is_order_in_queue(self, restaurant_code: str, order: BodyItem) -> bool:
+        return order_key(restaurant_code, order.order_id, order.cloud_print_id) in self.pending_keys()
+
+    def has_order(self, restaurant_code: str, order_id: str, cloud_print_id: str) -> bool:
+        return order_key(restaurant_code, order_id, cloud_print_id) in self.pending_keys()
+
+    def get_token_for_next_order(self, restaurant_code: str) -> Optional[str]:
+        # None if the queue was emptied by another worker since is_job_ready.
+        next_order = next_pending_order(restaurant_code)
+
+        if next_order is None:
+            return None
+
+        uuid, order_id, cloud_print_id = next_order
+
+        return job_token(restaurant_code, order_id, cloud_print_id, uuid)
+
+
+class SharedAuthorizations:
+    # Authorizations of the printers shared by all the worker processes, so that a printer authenticated by
+    # the worker answering its POST is also authenticated by the worker answering its GET. Kept in the
+    # ServiceState table as the epoch time the authorization expires; mac "" is the printer of the
+    # restaurant that authenticated last, for requests that do not carry the MAC address.
+
+    @staticmethod
+    def _key(restaurant_code: str, mac: str) -> str:
+        return f"printer_auth:{restaurant_code}:{mac}"
+
+    def load(self, restaurant_code: str, mac: str) -> Optional[float]:
+        value = load_state(self._key(restaurant_code, mac))
+
+        return float(value) if value is not None else None
+
+    def save(self, restaurant_code: str, macs: list[str], expires: float):
+        # Committed before the response is sent, called on the route threads: the printer's next request may be
+        # answered by another worker process.
+        write_states({self._key(restaurant_code, mac): str(expires) for mac in macs})
+
+
+class SharedMediaTypes:
+    # Print job media types negotiated with the printers, shared by all the worker processes so that the orders
+    # rendered ahead of time by the fetching worker are rendered in the media type of their printer. Kept in the
+    # ServiceState table.
+
+    @staticmethod
+    def _key(restaurant_code: str) -> str:
+        return f"media_type:{restaurant_code}"
+
+    def load(self, restaurant_code: str) -> Optional[str]:
+        return load_state(self._key(restaurant_code))
+
+    def save(self, restaurant_code: str, media_type: str):
+        DatabaseWriter().save_state(self._key(restaurant_code), media_type)
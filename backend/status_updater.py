@@ -0,0 +1,154 @@
+from typing import Optional
+import asyncio
+import logging
+import threading
+
+from backend.potlam_backend import bulk_update_status
+from backend.schemas import PotlamOrderPrintStatus
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+
+class StatusUpdater:
+    # Write-behind of order status updates to the POTLAM backend. Route handlers record status
+    # transitions and return immediately, the printer never waits on the POTLAM backend. Only the
+    # latest status of each cloud_print_id is kept, and pending updates are sent through the bulk
+    # status update service every POTLAM_STATUS_FLUSH_INTERVAL seconds, or as soon as
+    # POTLAM_STATUS_FLUSH_SIZE orders are pending. A failed flush is retried with exponential
+    # backoff, capped at POTLAM_STATUS_RETRY_MAX_DELAY seconds.
+
+    _self = None
+    _task: Optional[asyncio.Task] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _wakeup: Optional[asyncio.Event] = None
+
+    # cloud_print_id -> latest status not yet sent to the POTLAM backend.
+    pending = {}
+    lock = threading.Lock()
+
+    # Counters exposed for tuning.
+    sent = 0
+    coalesced = 0
+    failed_flushes = 0
+    retry_delay = 0.0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    @staticmethod
+    def flush_interval() -> float:
+        return float(get_constant("POTLAM_STATUS_FLUSH_INTERVAL", 2))
+
+    @staticmethod
+    def flush_size() -> int:
+        return int(get_constant("POTLAM_STATUS_FLUSH_SIZE", 50))
+
+    def record(self, cloud_print_id: str, status: str):
+        # Safe to call from route handlers running in the thread pool.
+
+        with self.lock:
+            if cloud_print_id in StatusUpdater.pending:
+                StatusUpdater.coalesced += 1
+
+            StatusUpdater.pending[cloud_print_id] = status
+            size = len(StatusUpdater.pending)
+
+        if size >= self.flush_size() and StatusUpdater._loop is not None:
+            StatusUpdater._loop.call_soon_threadsafe(StatusUpdater._wakeup.set)
+
+    def start(self):
+        # Must be called from the event loop, on application startup.
+        StatusUpdater._loop = asyncio.get_running_loop()
+        StatusUpdater._wakeup = asyncio.Event()
+        StatusUpdater._task = StatusUpdater._loop.create_task(self.run())
+
+    async def run(self):
+        failures = 0
+
+        while True:
+            try:
+                await asyncio.wait_for(StatusUpdater._wakeup.wait(), timeout=self.flush_interval())
+            except asyncio.TimeoutError:
+                pass
+
+            StatusUpdater._wakeup.clear()
+
+            if await self.flush():
+                failures = 0
+                StatusUpdater.retry_delay = 0.0
+                continue
+
+            # The POTLAM backend is unavailable, back off before the next attempt.
+            failures += 1
+            StatusUpdater.retry_delay = min(self.flush_interval() * 2 ** failures,
+                                            float(get_constant("POTLAM_STATUS_RETRY_MAX_DELAY", 60)))
+
+            logger.warning(f"Status update of [{len(StatusUpdater.pending)}] orders failed, "
+                           f"retrying in [{StatusUpdater.retry_delay:.1f}s].")
+
+            await asyncio.sleep(StatusUpdater.retry_delay)
+
+    async def flush(self) -> bool:
+        # Send all pending status updates in one bulk service call. Returns False if the call
+        # failed, the updates are then pending again unless a newer status was recorded meanwhile.
+
+        with self.lock:
+            batch = StatusUpdater.pending
+            StatusUpdater.pending = {}
+
+        if len(batch) == 0:
+            return True
+
+        statuses = [PotlamOrderPrintStatus(cloud_print_id=cloud_print_id, status=status)
+                    for cloud_print_id, status in batch.items()]
+
+        updated = False
+        try:
+            updated = await bulk_update_status(statuses)
+
+        finally:
+            # Also reached when the flush is cancelled on shutdown, so the batch is not lost.
+            if updated:
+                StatusUpdater.sent += len(batch)
+                logger.info(f"Updated status of [{len(batch)}] orders in POTLAM backend.")
+
+            else:
+                StatusUpdater.failed_flushes += 1
+
+                with self.lock:
+                    for cloud_print_id, status in batch.items():
+                        StatusUpdater.pending.setdefault(cloud_print_id, status)
+
+        return updated
+
+    async def stop(self):
+        # Stop the flush task and make a last attempt to send the pending updates, called on
+        # application shutdown.
+        if StatusUpdater._task is not None:
+            StatusUpdater._task.cancel()
+
+            try:
+                await StatusUpdater._task
+            except asyncio.CancelledError:
+                pass
+
+            StatusUpdater._task = None
+
+        StatusUpdater._loop = None
+
+        if not await self.flush():
+            logger.error(f"Status of [{len(StatusUpdater.pending)}] orders could not be updated "
+                         f"in POTLAM backend before shutdown.")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(StatusUpdater.pending),
+            "sent": StatusUpdater.sent,
+            "coalesced": StatusUpdater.coalesced,
+            "failed_flushes": StatusUpdater.failed_flushes,
+            "retry_delay": StatusUpdater.retry_delay,
+        }
@@ -0,0 +1,126 @@
+# Lookup latency of the CloudPrintOrderStatus queries on a large table, with and without the
+# composite indexes.
+#
+# Usage: python -m benchmarks.db_lookup_benchmark [--rows 1000000] [--repeat 200] [--db /tmp/cp_orders_bench.db]
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+import uuid
+
+RESTAURANTS = 500
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CloudPrintOrderStatus lookup latency benchmark")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--db", default="/tmp/cp_orders_bench.db")
+    return parser.parse_args()
+
+
+def populate(path: str, rows: int):
+    # Raw sqlite3 inserts, the table itself is created by init_db.
+    connection = sqlite3.connect(path)
+
+    batch = []
+    for number in range(rows):
+        batch.append((str(uuid.uuid4()), f"rest{number % RESTAURANTS}", str(number), str(number),
+                      "2" if number % 50 else "0"))
+
+        if len(batch) == 50_000:
+            connection.executemany("INSERT INTO cloudprintorderstatus "
+                                   "(uuid, restaurant_code, cloud_print_id, order_id, status) "
+                                   "VALUES (?, ?, ?, ?, ?)", batch)
+            batch.clear()
+
+    if batch:
+        connection.executemany("INSERT INTO cloudprintorderstatus "
+                               "(uuid, restaurant_code, cloud_print_id, order_id, status) "
+                               "VALUES (?, ?, ?, ?, ?)", batch)
+
+    connection.commit()
+    connection.close()
+
+
+def measure(function, repeat: int) -> tuple:
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def run(rows: int, repeat: int, db) -> list:
+    from backend.schemas import CloudPrintOrderStatus
+    from libs.constants import get_constant
+
+    pending = str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))
+
+    def random_order():
+        number = random.randrange(rows)
+        return f"rest{number % RESTAURANTS}", str(number)
+
+    def upsert_batch():
+        db.upsert_orders_in_db([
+            CloudPrintOrderStatus(uuid=str(uuid.uuid4()), restaurant_code=restaurant_code, cloud_print_id=order_id,
+                                  order_id=order_id, status=pending)
+            for restaurant_code, order_id in (random_order() for _ in range(100))])
+
+    return [
+        ("is_order_available_in_db", measure(lambda: db.is_order_available_in_db(random_order()[0]), repeat)),
+        ("is_order_in_db", measure(lambda: db.is_order_in_db(*random_order()), repeat)),
+        ("delete_order_from_db", measure(lambda: db.delete_order_from_db(*random_order()), repeat)),
+        ("upsert_orders_in_db (100)", measure(upsert_batch, max(repeat // 10, 5))),
+    ]
+
+
+def main():
+    args = parse_args()
+
+    if os.path.exists(args.db):
+        os.remove(args.db)
+
+    # The database module reads its url and constants when imported.
+    os.environ["CLOUDPRINT_DB_URL"] = f"sqlite:///{args.db}"
+    os.environ.setdefault("CLOUDPRINT_STATUS_PRINT_PENDING", "0")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import backend  # noqa: F401 - imports the database module in the order used by the service
+    from database import cloudprint_db as db
+    from sqlalchemy import text
+
+    db.init_db()
+
+    start = time.perf_counter()
+    populate(args.db, args.rows)
+    print(f"Populated [{args.rows}] rows in {time.perf_counter() - start:.1f}s\n")
+
+    with db.get_db_engine().begin() as connection:
+        for index in db.CloudPrintOrderStatus.__table__.indexes:
+            connection.execute(text(f"DROP INDEX {index.name}"))
+        connection.execute(text("ANALYZE"))
+
+    without_indexes = run(args.rows, args.repeat, db)
+
+    with db.get_db_engine().begin() as connection:
+        db.migrate_add_indexes(connection)
+        connection.execute(text("ANALYZE"))
+
+    with_indexes = run(args.rows, args.repeat, db)
+
+    print(f"{'query':<28}{'no index p50':>14}{'p95':>10}{'indexed p50':>14}{'p95':>10}   (ms)")
+    for (name, (p50, p95)), (_, (ip50, ip95)) in zip(without_indexes, with_indexes):
+        print(f"{name:<28}{p50:>14.3f}{p95:>10.3f}{ip50:>14.3f}{ip95:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
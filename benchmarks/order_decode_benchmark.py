@@ -0,0 +1,86 @@
+# Deserialization time of a POTLAM orders list response: full validation of the whole response with
+# CloudPrintOrdersModel, against the OrderDecoder which validates only the orders not already queued.
+#
+# Usage: python -m benchmarks.order_decode_benchmark [--orders 5000] [--queued 0.9] [--repeat 5]
+#                                                    [--payload captured_response.json]
+
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.order_decoder import OrderDecoder  # noqa: E402
+from backend.order_queue import OrderQueue  # noqa: E402
+from backend.schemas import BodyItem, CloudPrintOrdersModel  # noqa: E402
+from tools.potlam_stub import make_order  # noqa: E402
+
+TOPPINGS = {
+    "commontoppings": [{"commoncategoryname": "Sauces",
+                        "toppings": {"topping_id": "1", "toppingname": "Chutney", "qty": "1", "toppingprice": "0.50"}}],
+    "normaltoppings": [{"normalcategoryname": "Extras",
+                        "toppings": {"topping_id": "2", "toppingname": "Cheese", "qty": "2", "toppingprice": "1.00"}},
+                       []],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="POTLAM orders list deserialization benchmark")
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--queued", type=float, default=0.9, help="fraction of the orders already in the queues")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--payload", help="captured POTLAM_PRINT_LIST response, instead of generated orders")
+    return parser.parse_args()
+
+
+def generate(orders: int) -> str:
+    body = []
+    for number in range(orders):
+        order = make_order(number, 50)
+        for detail in order["print_order"]["orderdetails"]:
+            detail["toppingsdetails"] = copy.deepcopy(TOPPINGS)
+        body.append(order)
+
+    return json.dumps({"status": 1, "message": "Success", "body": body})
+
+
+def measure(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(timings)
+
+
+def main():
+    args = parse_args()
+
+    if args.payload:
+        with open(args.payload) as f:
+            payload = f.read()
+    else:
+        payload = generate(args.orders)
+
+    items = json.loads(payload)["body"]
+
+    # Queue the given fraction of the orders, as after an earlier fetch.
+    queue = OrderQueue()
+    for item in items[:int(len(items) * args.queued)]:
+        queue.add_order(BodyItem.model_validate(item))
+
+    full = measure(lambda: CloudPrintOrdersModel.model_validate_json(payload), args.repeat)
+    lazy = measure(lambda: OrderDecoder().decode(payload), args.repeat)
+
+    print(f"{len(items)} orders, {len(payload) / 1e6:.1f} MB, {args.queued:.0%} already queued")
+    print(f"  full validation (CloudPrintOrdersModel): {full:8.1f} ms")
+    print(f"  OrderDecoder, new orders validated:      {lazy:8.1f} ms  ({full / lazy:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,396 @@
-from sqlmodel import create_engine, Session
+from sqlalchemy import Engine, bindparam, delete, event, func, select, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import create_engine, Session, SQLModel
 
 import logging
+import threading
+import zlib
 
-from backend.schemas import CloudPrintOrderStatus
+from backend.schemas import BodyItem, CloudPrintOrderStatus, ServiceState
 from libs.constants import get_constant
 
 logger = logging.getLogger(__name__)
 
-db_engine = create_engine(
-    "sqlite:///cp_orders.db",
-    connect_args={"check_same_thread": False},  # Needed for SQLite
-    echo=bool(get_constant("DB_ENGINE_ECHO"))  # Log generated SQL, set this to False on Production
-)
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+
+    # Write-ahead logging: readers do not block the writer and commits append to the log
+    # instead of rewriting the database file.
+    cursor.execute("PRAGMA journal_mode=WAL")
+
+    # With WAL, NORMAL only syncs at checkpoints; a commit may be lost on power failure but the
+    # database cannot be corrupted. Orders are re-fetched from the POTLAM backend in that case.
+    cursor.execute("PRAGMA synchronous=NORMAL")
+
+    # Wait for a lock instead of failing immediately with "database is locked".
+    cursor.execute("PRAGMA busy_timeout=5000")
+
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-16000")  # 16 MB
+
+    cursor.close()
+
+
+# Created on first use rather than on import: CLOUDPRINT_DB_URL may be set in the conf file, which Environment()
+# loads after the modules are imported.
+_db_engine: Engine | None = None
+_db_engine_lock = threading.Lock()
+
+
+def get_db_engine() -> Engine:
+    global _db_engine
+
+    if _db_engine is None:
+        with _db_engine_lock:
+            if _db_engine is None:
+                engine = create_engine(
+                    get_constant("CLOUDPRINT_DB_URL", "sqlite:///cp_orders.db"),
+                    connect_args={"check_same_thread": False},  # Needed for SQLite
+                    echo=bool(get_constant("DB_ENGINE_ECHO"))  # Log generated SQL, set this to False on Production
+                )
+                event.listen(engine, "connect", set_sqlite_pragmas)
+
+                _db_engine = engine
+
+    return _db_engine
+
+
+# Schema migrations of existing databases, applied in order. The version of a database
+# is kept in PRAGMA user_version; migration N brings a database from version N - 1 to N.
+def migrate_add_indexes(connection):
+    for index in CloudPrintOrderStatus.__table__.indexes:
+        index.create(bind=connection, checkfirst=True)
+
+
+def migrate_add_payload(connection):
+    columns = [column[1] for column in connection.execute(text("PRAGMA table_info(cloudprintorderstatus)"))]
+
+    if "payload" not in columns:
+        connection.execute(text("ALTER TABLE cloudprintorderstatus ADD COLUMN payload BLOB"))
+
+
+MIGRATIONS = [
+    migrate_add_indexes,
+    migrate_add_payload,
+]
+
+
+def init_db():
+    # Create all database tables (SQLModels) if they don't already exist, and bring an existing
+    # database up to the current schema version.
+
+    SQLModel.metadata.create_all(get_db_engine())
+
+    with get_db_engine().begin() as connection:
+        version = connection.execute(text("PRAGMA user_version")).scalar()
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Migrating database to schema version [{number}]: {migration.__name__}")
+            migration(connection)
+
+        connection.execute(text(f"PRAGMA user_version={len(MIGRATIONS)}"))
 
 
 def add_orders_to_db(db_orders: list[CloudPrintOrderStatus]):
-    with Session(db_engine) as session:
+    with Session(get_db_engine()) as session:
         session.add_all(db_orders)
         session.commit()
         session.close()
 
 
+# Maximum number of (restaurant_code, order_id) pairs per IN clause, SQLite limits the
+# number of bound parameters per statement.
+RECONCILE_CHUNK_SIZE = 400
+
+
+def upsert_orders_in_db(db_orders: list[CloudPrintOrderStatus]) -> list[CloudPrintOrderStatus]:
+    # Reconcile a batch of orders with the database in a single transaction: orders that already
+    # exist in the database (same restaurant_code and order_id) keep their existing uuid, all
+    # orders are then inserted or updated in one bulk statement. Returns the orders with the uuid
+    # and the status they are stored with.
+
+    with Session(get_db_engine()) as session:
+        reconcile_orders(session, db_orders)
+        session.commit()
+
+    return db_orders
+
+
+def reconcile_orders(session: Session, db_orders: list[CloudPrintOrderStatus]):
+    # Statements of upsert_orders_in_db, run in the transaction of the given session.
+
+    if len(db_orders) == 0:
+        return
+
+    for db_order in db_orders:
+        db_order.restaurant_code = db_order.restaurant_code.lower()
+
+    # Find the orders that already exist in the database.
+    existing = {}
+    duplicate_uuids = []
+
+    pairs = list({(db_order.restaurant_code, db_order.order_id) for db_order in db_orders})
+
+    for start in range(0, len(pairs), RECONCILE_CHUNK_SIZE):
+        rows = session.query(CloudPrintOrderStatus.uuid,
+                             CloudPrintOrderStatus.restaurant_code,
+                             CloudPrintOrderStatus.order_id,
+                             CloudPrintOrderStatus.status
+                             ).filter(tuple_(CloudPrintOrderStatus.restaurant_code,
+                                             CloudPrintOrderStatus.order_id
+                                             ).in_(pairs[start:start + RECONCILE_CHUNK_SIZE])).all()
+
+        for uuid, restaurant_code, order_id, status in rows:
+            if (restaurant_code, order_id) in existing:
+                # More than one row for the same order, only one is kept.
+                duplicate_uuids.append(uuid)
+            else:
+                existing[(restaurant_code, order_id)] = (uuid, status)
+
+    if len(duplicate_uuids) > 0:
+        session.query(CloudPrintOrderStatus
+                      ).filter(CloudPrintOrderStatus.uuid.in_(duplicate_uuids)).delete()
+
+    pending = str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))
+
+    for db_order in db_orders:
+        uuid, status = existing.get((db_order.restaurant_code, db_order.order_id), (db_order.uuid, pending))
+
+        # An order that is no longer pending keeps its status, see below.
+        db_order.uuid = uuid
+        if status != pending:
+            db_order.status = status
+
+    # Insert new orders and refresh the existing ones, as a single executemany statement. Only pending orders are
+    # refreshed: an order claimed by a printer is re-fetched until its status reaches the POTLAM backend, it keeps
+    # its status and the payload it is printed with.
+    statement = sqlite_insert(CloudPrintOrderStatus)
+    statement = statement.on_conflict_do_update(
+        index_elements=[CloudPrintOrderStatus.uuid],
+        set_={"cloud_print_id": statement.excluded.cloud_print_id,
+              "status": statement.excluded.status,
+              "payload": statement.excluded.payload},
+        where=CloudPrintOrderStatus.status == pending)
+
+    session.execute(statement, [
+        {"uuid": db_order.uuid,
+         "restaurant_code": db_order.restaurant_code,
+         "cloud_print_id": db_order.cloud_print_id,
+         "order_id": db_order.order_id,
+         "status": db_order.status,
+         "payload": db_order.payload} for db_order in db_orders])
+
+    logger.info(f"Reconciled [{len(db_orders)}] orders with the database, [{len(existing)}] already existed.")
+
+
+def update_order_statuses(session: Session, statuses: dict):
+    # Update the status of many orders, {uuid: status}, in the transaction of the given session.
+    table = CloudPrintOrderStatus.__table__
+
+    session.connection().execute(
+        update(table).where(table.c.uuid == bindparam("b_uuid")).values(status=bindparam("b_status")),
+        [{"b_uuid": uuid, "b_status": status} for uuid, status in statuses.items()])
+
+
+def delete_orders(session: Session, orders: list[tuple]):
+    # Delete many orders, [(restaurant_code, order_id)], in the transaction of the given session.
+    table = CloudPrintOrderStatus.__table__
+
+    session.connection().execute(
+        delete(table).where(table.c.restaurant_code == bindparam("b_restaurant_code"),
+                            table.c.order_id == bindparam("b_order_id")),
+        [{"b_restaurant_code": restaurant_code.lower(), "b_order_id": order_id}
+         for restaurant_code, order_id in orders])
+
+
+def serialize_order(order: BodyItem) -> bytes:
+    return zlib.compress(order.model_dump_json(exclude={"uuid"}).encode("utf-8"))
+
+
+def deserialize_order(uuid: str, payload: bytes) -> BodyItem:
+    order = BodyItem.model_validate_json(zlib.decompress(payload))
+    order.uuid = uuid
+
+    return order
+
+
+def load_pending_orders(restaurant_code: str | None = None) -> list[BodyItem]:
+    # Orders with status: CLOUDPRINT_STATUS_PRINT_PENDING, of all restaurants or of the given restaurant,
+    # in the order they were added to the database.
+
+    orders = []
+
+    with Session(get_db_engine()) as session:
+        query = session.query(CloudPrintOrderStatus.uuid,
+                              CloudPrintOrderStatus.payload
+                              ).filter(
+            CloudPrintOrderStatus.status == str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
+
+        if restaurant_code is not None:
+            query = query.filter(CloudPrintOrderStatus.restaurant_code == restaurant_code.lower())
+
+        rows = query.order_by(text("rowid")).all()
+
+    for uuid, payload in rows:
+
+        # Rows added before the payload was stored cannot be restored, they are re-fetched by the cron.
+        if payload is None:
+            continue
+
+        try:
+            orders.append(deserialize_order(uuid, payload))
+
+        except (zlib.error, ValueError) as e:
+            logger.error(f"Error restoring order [uuid:{uuid}] from the database: {e!r}")
+
+    return orders
+
+
+# Queries of the shared print queues (CLOUDPRINT_QUEUE_BACKEND=sqlite), where the orders pending in the
+# database table are the queues, shared by all the worker processes. Orders are printed in the order
+# they were added to the database.
+def count_pending_orders(restaurant_code: str) -> int:
+    table = CloudPrintOrderStatus.__table__
+
+    with get_db_engine().connect() as connection:
+        return connection.execute(
+            select(func.count()).select_from(table).where(
+                table.c.restaurant_code == restaurant_code.lower(),
+                table.c.status == str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))).scalar()
+
+
+def next_pending_order(restaurant_code: str) -> tuple | None:
+    # (uuid, order_id, cloud_print_id) of the next order to be printed, None if there is none.
+    table = CloudPrintOrderStatus.__table__
+
+    with get_db_engine().connect() as connection:
+        return connection.execute(
+            select(table.c.uuid, table.c.order_id, table.c.cloud_print_id).where(
+                table.c.restaurant_code == restaurant_code.lower(),
+                table.c.status == str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))
+            ).order_by(text("rowid")).limit(1)).first()
+
+
+def claim_next_pending_order(restaurant_code: str, status: str) -> tuple | None:
+    # Set the status of the next order to be printed in a single statement, so that two processes
+    # can never claim the same order. Returns (uuid, payload) of the claimed order, None if there is none.
+    table = CloudPrintOrderStatus.__table__
+    pending = str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))
+
+    next_uuid = select(table.c.uuid).where(
+        table.c.restaurant_code == restaurant_code.lower(),
+        table.c.status == pending
+    ).order_by(text("rowid")).limit(1).scalar_subquery()
+
+    with get_db_engine().begin() as connection:
+        return connection.execute(
+            update(table).where(table.c.uuid == next_uuid, table.c.status == pending
+                                ).values(status=status).returning(table.c.uuid, table.c.payload)).first()
+
+
+def transition_order(uuid: str, from_status: str, to_status: str, restaurant_code: str | None = None) -> tuple | None:
+    # Change the status of an order only if it currently has from_status (and belongs to this restaurant), in a
+    # single statement so that two processes can never both make the same transition. Returns (uuid, payload)
+    # of the order, None if it does not exist or does not have from_status.
+    table = CloudPrintOrderStatus.__table__
+
+    statement = update(table).where(table.c.uuid == uuid, table.c.status == from_status)
+    if restaurant_code is not None:
+        statement = statement.where(table.c.restaurant_code == restaurant_code.lower())
+
+    with get_db_engine().begin() as connection:
+        return connection.execute(
+            statement.values(status=to_status).returning(table.c.uuid, table.c.payload)).first()
+
+
+def load_order(uuid: str, status: str) -> BodyItem | None:
+    # The order with this uuid if it has this status, None otherwise.
+    table = CloudPrintOrderStatus.__table__
+
+    with get_db_engine().connect() as connection:
+        row = connection.execute(
+            select(table.c.uuid, table.c.payload).where(table.c.uuid == uuid, table.c.status == status)).first()
+
+    if row is None or row.payload is None:
+        return None
+
+    return deserialize_order(row.uuid, row.payload)
+
+
+def delete_pending_order(restaurant_code: str, order_id: str, cloud_print_id: str) -> tuple | None:
+    # Delete an order if it is still pending. Returns (uuid, payload) of the deleted order, None if there is none.
+    table = CloudPrintOrderStatus.__table__
+
+    with get_db_engine().begin() as connection:
+        return connection.execute(
+            delete(table).where(table.c.restaurant_code == restaurant_code.lower(),
+                                table.c.order_id == order_id,
+                                table.c.cloud_print_id == cloud_print_id,
+                                table.c.status == str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))
+                                ).returning(table.c.uuid, table.c.payload)).first()
+
+
+def load_pending_restaurants() -> list[str]:
+    # Restaurants with orders pending in the database.
+    table = CloudPrintOrderStatus.__table__
+
+    with get_db_engine().connect() as connection:
+        return list(connection.execute(
+            select(table.c.restaurant_code).where(
+                table.c.status == str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))).distinct()).scalars())
+
+
+def is_order_pending(uuid: str) -> bool:
+    table = CloudPrintOrderStatus.__table__
+
+    with get_db_engine().connect() as connection:
+        return connection.execute(
+            select(table.c.uuid).where(table.c.uuid == uuid,
+                                       table.c.status == str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
+        ).first() is not None
+
+
+def load_pending_keys() -> set[tuple]:
+    # (restaurant_code, order_id, cloud_print_id) of all the orders pending in the database.
+    table = CloudPrintOrderStatus.__table__
+
+    with get_db_engine().connect() as connection:
+        rows = connection.execute(
+            select(table.c.restaurant_code, table.c.order_id, table.c.cloud_print_id).where(
+                table.c.status == str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING"))))
+
+        return {tuple(row) for row in rows}
+
+
+def load_state(key: str) -> str | None:
+    with Session(get_db_engine()) as session:
+        state = session.get(ServiceState, key)
+
+        return state.value if state is not None else None
+
+
+def save_state(session: Session, key: str, value: str | None):
+    # Insert or update a ServiceState value, in the transaction of the given session.
+    statement = sqlite_insert(ServiceState).values(key=key, value=value)
+    session.execute(statement.on_conflict_do_update(index_elements=[ServiceState.key],
+                                                    set_={"value": statement.excluded.value}))
+
+
+def write_states(states: dict):
+    # Insert or update ServiceState values {key: value} in their own transaction, committed on return.
+    with Session(get_db_engine()) as session:
+        for key, value in states.items():
+            save_state(session, key, value)
+
+        session.commit()
+
+
 # True if an order exists with status: CLOUDPRINT_STATUS_PRINT_PENDING for this restaurant
 # in the database table; False otherwise
 def is_order_available_in_db(restaurant_code: str) -> bool:
 
     # Check whether an order exists in the database that matches this restaurant code AND status =
-    with Session(db_engine) as session:
+    with Session(get_db_engine()) as session:
 
         # Find whether there are any orders in the database from this restaurant
         # and status: CLOUDPRINT_STATUS_PRINT_PENDING
@@ -44,7 +408,7 @@ def is_order_available_in_db(restaurant_code: str) -> bool:
 
 def update_order_status_in_db(uuid: str, status: str):
 
-    with (Session(db_engine) as session):
+    with (Session(get_db_engine()) as session):
         session.query(CloudPrintOrderStatus
                       ).filter(CloudPrintOrderStatus.uuid == uuid).update({'status': status})
 
@@ -55,7 +419,7 @@ def update_order_status_in_db(uuid: str, status: str):
 
 
 def delete_order_from_db(restaurant_code: str, order_id: str):
-    with (Session(db_engine) as session):
+    with (Session(get_db_engine()) as session):
         session.query(CloudPrintOrderStatus
                       ).filter(CloudPrintOrderStatus.restaurant_code == restaurant_code.lower(),
                                CloudPrintOrderStatus.order_id == order_id).delete()
@@ -67,7 +431,7 @@ def delete_order_from_db(restaurant_code: str, order_id: str):
 
 
 def is_order_in_db(restaurant_code: str, order_id: str) -> bool:
-    with Session(db_engine) as session:
+    with Session(get_db_engine()) as session:
 
         count = session.query(CloudPrintOrderStatus
                               ).filter(CloudPrintOrderStatus.restaurant_code == restaurant_code.lower(),
@@ -0,0 +1,227 @@
+from concurrent.futures import Future
+from typing import Optional
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+from sqlmodel import Session
+
+from backend.schemas import CloudPrintOrderStatus
+from database.cloudprint_db import delete_orders, get_db_engine, reconcile_orders, save_state, update_order_statuses
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+# Operations queued for the writer thread.
+OP_STATUS = "status"
+OP_DELETE = "delete"
+OP_UPSERT = "upsert"
+OP_STATE = "state"
+OP_FLUSH = "flush"
+OP_STOP = "stop"
+
+
+class DatabaseWriter:
+    # Single writer thread for the orders database. Request handlers and the fetch cron queue their
+    # status updates, deletes and inserts instead of opening a Session and committing themselves;
+    # the writer commits everything queued within CLOUDPRINT_DB_COMMIT_INTERVAL seconds in one
+    # transaction (group commit). Repeated status updates of the same uuid within a batch are
+    # coalesced into one, operations are otherwise applied in the order they were queued.
+
+    _self = None
+    thread: Optional[threading.Thread] = None
+
+    operations = queue.Queue()
+    lock = threading.Lock()
+
+    # Counters exposed for tuning.
+    batches = 0
+    operations_committed = 0
+    statuses_coalesced = 0
+    errors = 0
+    last_commit_ms = 0.0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    def start(self):
+        # Started on first use, after the environment constants have been loaded.
+        with self.lock:
+            if DatabaseWriter.thread is None or not DatabaseWriter.thread.is_alive():
+                DatabaseWriter.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+                DatabaseWriter.thread.start()
+
+    def submit(self, operation: str, argument=None, future: Future = None):
+        self.start()
+        self.operations.put((operation, argument, future))
+
+    def update_status(self, uuid: str, status: str):
+        self.submit(OP_STATUS, (uuid, status))
+
+    def delete_order(self, restaurant_code: str, order_id: str):
+        self.submit(OP_DELETE, (restaurant_code, order_id))
+
+    def upsert_orders(self, db_orders: list[CloudPrintOrderStatus]) -> Future:
+        # Reconcile the orders with the database (see upsert_orders_in_db), the returned future
+        # resolves to the orders with the uuid and the status they are stored with once committed.
+        future = Future()
+        self.submit(OP_UPSERT, db_orders, future)
+
+        return future
+
+    def save_state(self, key: str, value: str):
+        # Committed after the operations queued before, e.g. a fetch cursor after the fetched orders.
+        self.submit(OP_STATE, (key, value))
+
+    async def flush(self):
+        # Wait until everything queued so far has been committed.
+        future = Future()
+        self.submit(OP_FLUSH, None, future)
+
+        await asyncio.wrap_future(future)
+
+    async def stop(self):
+        # Commit everything queued and stop the writer thread, called on application shutdown.
+        if DatabaseWriter.thread is None or not DatabaseWriter.thread.is_alive():
+            return
+
+        future = Future()
+        self.operations.put((OP_STOP, None, future))
+
+        await asyncio.wrap_future(future)
+        await asyncio.to_thread(DatabaseWriter.thread.join)
+
+    def run(self):
+        interval = float(get_constant("CLOUDPRINT_DB_COMMIT_INTERVAL", 0.05))
+        max_batch = int(get_constant("CLOUDPRINT_DB_MAX_BATCH", 500))
+
+        while True:
+            batch = [self.operations.get()]
+
+            # Collect everything queued until the commit interval has passed.
+            deadline = time.monotonic() + interval
+            while len(batch) < max_batch and batch[-1][0] not in (OP_FLUSH, OP_STOP):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self.operations.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.commit(batch)
+
+            if batch[-1][0] == OP_STOP:
+                return
+
+    def commit(self, batch: list):
+
+        # Group consecutive status updates into one {uuid: status} map, keeping the latest status
+        # of each uuid, and consecutive deletes into one list.
+        groups = []
+        for operation, argument, future in batch:
+
+            if operation == OP_STATUS:
+                uuid, status = argument
+
+                if len(groups) > 0 and groups[-1][0] == OP_STATUS:
+                    if uuid in groups[-1][1]:
+                        DatabaseWriter.statuses_coalesced += 1
+                    groups[-1][1][uuid] = status
+                else:
+                    groups.append((OP_STATUS, {uuid: status}, None))
+
+            elif operation == OP_DELETE:
+                if len(groups) > 0 and groups[-1][0] == OP_DELETE:
+                    groups[-1][1].append(argument)
+                else:
+                    groups.append((OP_DELETE, [argument], None))
+
+            else:
+                groups.append((operation, argument, future))
+
+        start = time.perf_counter()
+
+        try:
+            with Session(get_db_engine()) as session:
+
+                for operation, argument, _ in groups:
+                    self.apply(session, operation, argument)
+
+                session.commit()
+
+        except Exception as e:
+            DatabaseWriter.errors += 1
+            logger.error(f"Error committing [{len(batch)}] database operations: {e!r}")
+
+            # One failing group, e.g. an upsert of an invalid order, must not drop the status updates, deletes
+            # and fetch cursors queued with it: commit each group in its own transaction, only the groups that
+            # fail again are lost.
+            if len(groups) > 1:
+                self.commit_groups(groups)
+                return
+
+            for operation, argument, future in groups:
+                if future is not None:
+                    future.set_exception(e)
+
+            return
+
+        DatabaseWriter.batches += 1
+        DatabaseWriter.operations_committed += len(batch)
+        DatabaseWriter.last_commit_ms = (time.perf_counter() - start) * 1000
+
+        for operation, argument, future in groups:
+            if future is not None:
+                future.set_result(argument)
+
+    def commit_groups(self, groups: list):
+        # Commit the groups of a failed batch one by one, failing the futures of the groups that fail.
+
+        for operation, argument, future in groups:
+            try:
+                with Session(get_db_engine()) as session:
+                    self.apply(session, operation, argument)
+                    session.commit()
+
+            except Exception as e:
+                DatabaseWriter.errors += 1
+                logger.error(f"Error committing database operation [{operation}], dropped: {e!r}")
+
+                if future is not None:
+                    future.set_exception(e)
+
+                continue
+
+            DatabaseWriter.batches += 1
+            DatabaseWriter.operations_committed += len(argument) if operation in (OP_STATUS, OP_DELETE) else 1
+
+            if future is not None:
+                future.set_result(argument)
+
+    @staticmethod
+    def apply(session: Session, operation: str, argument):
+        if operation == OP_STATUS:
+            update_order_statuses(session, argument)
+        elif operation == OP_DELETE:
+            delete_orders(session, argument)
+        elif operation == OP_UPSERT:
+            reconcile_orders(session, argument)
+        elif operation == OP_STATE:
+            save_state(session, *argument)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.operations.qsize(),
+            "batches": DatabaseWriter.batches,
+            "operations_committed": DatabaseWriter.operations_committed,
+            "statuses_coalesced": DatabaseWriter.statuses_coalesced,
+            "errors": DatabaseWriter.errors,
+            "last_commit_ms": round(DatabaseWriter.last_commit_ms, 3),
+        }
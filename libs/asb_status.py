@@ -0,0 +1,79 @@
+from functools import lru_cache
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Decoder of the Star ASB (Automatic Status Back) printer status reported by CloudPRNT printers in
+# every POST poll, e.g. "23 86 00 00 00 00 00 00 00". Returns the same fields as CPUtil's
+# jsonstatus, without spawning a CPUtil process. Printers report the same few status strings over
+# and over, decoded statuses are memoized.
+
+ASB_STATUS_CACHE_SIZE = 1024
+
+# Minimum number of bytes holding the header, printer status, error and paper status bytes.
+ASB_MIN_LENGTH = 6
+
+
+def parse_asb_bytes(status: str) -> Optional[bytes]:
+    # The status is sent as hex bytes separated by spaces, some firmware sends it without separators.
+    # Text after the status bytes, if any, is ignored.
+    tokens = status.split()
+
+    if len(tokens) == 1 and len(tokens[0]) > 2:
+        tokens = [tokens[0][i:i + 2] for i in range(0, len(tokens[0]) - 1, 2)]
+
+    data = bytearray()
+    for token in tokens:
+        try:
+            data.append(int(token, 16))
+        except ValueError:
+            break
+
+    if len(data) < ASB_MIN_LENGTH:
+        return None
+
+    # Header byte 1 holds the number of status bytes, bits 1-3 and bit 5.
+    length = ((data[0] >> 2) & 0x08) | ((data[0] >> 1) & 0x07)
+    if length >= ASB_MIN_LENGTH:
+        data = data[:length]
+
+    return bytes(data)
+
+
+@lru_cache(maxsize=ASB_STATUS_CACHE_SIZE)
+def _decode(status: str) -> Optional[tuple]:
+    data = parse_asb_bytes(status)
+    if data is None:
+        return None
+
+    printer, error, sensor, paper = data[2], data[3], data[4], data[5]
+
+    return (
+        ("Online", (printer & 0x08) == 0),
+        ("CoverOpen", bool(printer & 0x20)),
+        ("CompulsionSwitch", bool(printer & 0x04)),
+        ("OverTemperature", bool(error & 0x40)),
+        ("Recoverable", (error & 0x20) == 0),
+        ("CutterError", bool(error & 0x08)),
+        ("MechanicalError", bool(error & 0x04)),
+        ("ReceiveBufferOverflow", bool(sensor & 0x40)),
+        ("VoltageError", bool(sensor & 0x20)),
+        ("BlackMarkError", bool(sensor & 0x08)),
+        ("PresenterPaperJam", bool(sensor & 0x04)),
+        ("PaperEmpty", bool(paper & 0x08)),
+        ("PaperLow", bool(paper & 0x06)),
+    )
+
+
+def decode_asb(status: str) -> Optional[dict]:
+    # Returns None if the status is not a valid ASB status.
+    decoded = _decode(status.strip())
+
+    return dict(decoded) if decoded is not None else None
+
+
+def cache_stats() -> dict:
+    info = _decode.cache_info()
+
+    return {"hits": info.hits, "misses": info.misses, "entries": info.currsize, "max_entries": info.maxsize}
@@ -1,8 +1,12 @@
+from dataclasses import dataclass as std_dataclass
 from fastapi import Header, status
 from pydantic.dataclasses import dataclass
+from typing import Optional
 
-import datetime
+import hmac
 import json
+import threading
+import time
 
 from libs.constants import get_constant
 
@@ -17,10 +21,104 @@ class AuthorizationResponse:
         return json.dumps(self, default=lambda o: o.__dict__)
 
 
-class Auth(object):
+# Responses are the same for every request, created once.
+AUTHENTICATED_SESSION = AuthorizationResponse(
+    status=True, http_status=status.HTTP_200_OK, status_message="Authenticated using active time token.")
+AUTHENTICATED_HEADER = AuthorizationResponse(
+    status=True, http_status=status.HTTP_200_OK, status_message="Authenticated using authorization header.")
+INVALID_CREDENTIALS = AuthorizationResponse(
+    status=False, http_status=status.HTTP_401_UNAUTHORIZED, status_message="Authentication Failed. Invalid Credentials.")
+AUTHENTICATION_REQUIRED = AuthorizationResponse(
+    status=False, http_status=status.HTTP_401_UNAUTHORIZED, status_message="Authentication Required.")
+
+
+def is_valid_bearer_key(authorization: Optional[str], key: Optional[str]) -> bool:
+    # "Authorization: Bearer <key>", always False while the key is not configured.
+    if not key or authorization is None:
+        return False
+
+    scheme, _, token = authorization.partition(" ")
+
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), key.encode())
+
+
+def is_valid_ingest_key(authorization: Optional[str]) -> bool:
+    # The POTLAM backend pushes orders with the header "Authorization: Bearer <POTLAM_INGEST_KEY>".
+    # Pushing orders is disabled while no POTLAM_INGEST_KEY is configured.
+    return is_valid_bearer_key(authorization, get_constant("POTLAM_INGEST_KEY"))
+
+
+def is_valid_stats_key(authorization: Optional[str]) -> bool:
+    # The /stats routes are served with the header "Authorization: Bearer <CLOUDPRINT_STATS_KEY>", and disabled
+    # while no CLOUDPRINT_STATS_KEY is configured. A key of its own: setting POTLAM_INGEST_KEY turns on the push
+    # mode of the POTLAM backend.
+    return is_valid_bearer_key(authorization, get_constant("CLOUDPRINT_STATS_KEY"))
+
+
+@std_dataclass
+class PrinterSession:
+    # A CloudPRNT printer of a restaurant. Times are time.monotonic() seconds.
+    restaurant_code: str
+    mac: str
+    auth_expires: float = 0.0
+    last_seen: float = 0.0
+    last_poll: float = 0.0
+    last_status_code: Optional[str] = None
+    last_status: Optional[str] = None
+    polls: int = 0
+
+    # Moving average of the seconds between two polls.
+    poll_interval: float = 0.0
+
+    # Print job encodings the printer supports, None until it answered the "Encodings" client action.
+    media_types: Optional[list] = None
+    encodings_requested: float = 0.0
+
+    def is_authenticated(self, now: float) -> bool:
+        return now < self.auth_expires
+
+    def record_poll(self, status_code: str, printer_status: Optional[str]):
+        now = time.monotonic()
+
+        if self.polls > 0:
+            interval = now - self.last_poll
+            self.poll_interval = interval if self.polls == 1 else 0.8 * self.poll_interval + 0.2 * interval
+
+        self.polls += 1
+        self.last_poll = now
+        self.last_status_code = status_code
+        self.last_status = printer_status
+
+    def poll_rate(self) -> float:
+        # Polls per minute.
+        return 60 / self.poll_interval if self.poll_interval > 0 else 0.0
+
+
+class PrinterSessions(object):
+    # Registry of the printers polling this service, keyed by restaurant code and printer MAC address.
+    # A printer that authenticated with the Authorization header stays authenticated for
+    # AUTHORIZATION_ACTIVE_TIME seconds. Sessions of printers that have not been seen for
+    # PRINTER_SESSION_IDLE_TIMEOUT seconds are evicted.
+
     _self = None
-    auth_add_time: int
-    auth_cutoff_times = {}
+
+    # (restaurant_code, mac) -> PrinterSession
+    sessions = {}
+
+    # restaurant_code -> PrinterSession last authenticated, for requests that do not carry the MAC address.
+    latest = {}
+
+    lock = threading.Lock()
+
+    # Authorizations shared with the other worker processes, set on startup when the queues are shared.
+    # Provides load(restaurant_code, mac) -> Optional[float] and save(restaurant_code, mac, expires), the
+    # expiry in epoch seconds.
+    shared_store = None
+
+    auth_active_time: float = None
+    idle_timeout: float = None
+    credential: bytes = None
+    last_sweep = 0.0
 
     def __new__(cls):
         # Create an instance of this class only if it does not already exist.
@@ -28,57 +126,125 @@ class Auth(object):
             cls._self = super().__new__(cls)
         return cls._self
 
-    def __init__(self):
-        self.auth_add_time = get_constant("AUTHORIZATION_ACTIVE_TIME")
+    def configure(self):
+        # Read the settings once, after the environment constants have been loaded.
+        PrinterSessions.auth_active_time = float(get_constant("AUTHORIZATION_ACTIVE_TIME"))
+        PrinterSessions.idle_timeout = max(float(get_constant("PRINTER_SESSION_IDLE_TIMEOUT", 3600)),
+                                           PrinterSessions.auth_active_time)
+        PrinterSessions.credential = str(get_constant("CLOUDPRINT_AUTHENTICATION")).encode()
+
+    def is_valid_credential(self, authorization: str) -> bool:
+        # The Authorization header must end with the expected credential, compared in constant time.
+        credential = PrinterSessions.credential
+        supplied = authorization.encode()
+
+        if len(supplied) < len(credential):
+            return False
 
-    def is_authorized(self, authorization: Header, restaurant_code: str) -> AuthorizationResponse:
+        return hmac.compare_digest(supplied[len(supplied) - len(credential):], credential)
 
-        # check if this restaurant has an authentication that is currently active.
-        if self.is_active(restaurant_code):
-            auth_response = AuthorizationResponse(
-                status=True, http_status=status.HTTP_200_OK, status_message="Authenticated using active time token.")
+    def authorize(self, restaurant_code: str, mac: Optional[str],
+                  authorization: Header = None) -> tuple[Optional[PrinterSession], AuthorizationResponse]:
+
+        if PrinterSessions.credential is None:
+            self.configure()
+
+        now = time.monotonic()
+
+        if mac is not None:
+            session = self.sessions.get((restaurant_code, mac.lower()))
         else:
-            # Authorization header is not Empty, it is supplied by the printer.
-            if authorization is not None:
+            session = self.latest.get(restaurant_code)
 
-                # Check if Authorization header supplied is what is expected.
-                if authorization.endswith(get_constant("CLOUDPRINT_AUTHENTICATION")):
-                    # if authorization.endswith("dGVzdFVzZXI6dGVzdFBhc3N3b3Jk"):
+        if session is not None:
+            session.last_seen = now
 
-                    # Successfully Authenticated, updated the cutoff time token for any future authentications
-                    self.update_auth_cutoff_time(restaurant_code)
+            # check if this printer has an authentication that is currently active.
+            if session.is_authenticated(now):
+                return session, AUTHENTICATED_SESSION
 
-                    auth_response = AuthorizationResponse(
-                        status=True, http_status=status.HTTP_200_OK, status_message="Authenticated using authorization header.")
+        # Authorization header is not Empty, it is supplied by the printer.
+        if authorization is None:
+            # The printer may have authenticated with another worker process.
+            if PrinterSessions.shared_store is not None:
+                session = self.load_shared(restaurant_code, mac, session, now)
 
-                else:
-                    auth_response = AuthorizationResponse(
-                        status=False, http_status=status.HTTP_401_UNAUTHORIZED, status_message="Authentication Failed. Invalid Credentials.")
+                if session is not None and session.is_authenticated(now):
+                    return session, AUTHENTICATED_SESSION
 
-            else:
-                auth_response = AuthorizationResponse(
-                    status=False, http_status=status.HTTP_401_UNAUTHORIZED, status_message="Authentication Required.")
+            return session, AUTHENTICATION_REQUIRED
 
-        return auth_response
+        # Check if Authorization header supplied is what is expected.
+        if not self.is_valid_credential(authorization):
+            return session, INVALID_CREDENTIALS
 
-    def is_active(self, restaurant_code: str) -> bool:
-        # Check if an authorization for this restaurant already exists in the dictionary
-        if (self.get_auth_cutoff_time(restaurant_code) is not None and
-                datetime.datetime.now() < self.get_auth_cutoff_time(restaurant_code)):
-            return True
-        else:
-            return False
+        with self.lock:
+            if session is None:
+                session = PrinterSession(restaurant_code=restaurant_code, mac=mac.lower() if mac else "", last_seen=now)
+                session = self.sessions.setdefault((restaurant_code, session.mac), session)
+
+            # Successfully Authenticated, updated the cutoff time for any future authentications.
+            session.auth_expires = now + PrinterSessions.auth_active_time
+            self.latest[restaurant_code] = session
+
+            if now - PrinterSessions.last_sweep > PrinterSessions.idle_timeout / 10:
+                self.evict_idle(now)
+
+        if PrinterSessions.shared_store is not None:
+            expires = time.time() + PrinterSessions.auth_active_time
+            PrinterSessions.shared_store.save(restaurant_code, [session.mac, ""], expires)
+
+        return session, AUTHENTICATED_HEADER
+
+    def load_shared(self, restaurant_code: str, mac: Optional[str], session: Optional[PrinterSession],
+                    now: float) -> Optional[PrinterSession]:
+        # Authenticate the session from the shared authorizations, if the printer authenticated with another
+        # worker process and its authorization is still active.
+        expires = PrinterSessions.shared_store.load(restaurant_code, mac.lower() if mac else "")
+
+        if expires is None or expires <= time.time():
+            return session
+
+        with self.lock:
+            if session is None:
+                session = PrinterSession(restaurant_code=restaurant_code, mac=mac.lower() if mac else "", last_seen=now)
+                session = self.sessions.setdefault((restaurant_code, session.mac), session)
+
+            # Converted to this process' monotonic clock.
+            session.auth_expires = now + expires - time.time()
+            self.latest.setdefault(restaurant_code, session)
+
+        return session
+
+    def evict_idle(self, now: float):
+        # Called with the lock held, whenever a printer authenticates.
+        PrinterSessions.last_sweep = now
+        cutoff = now - PrinterSessions.idle_timeout
+
+        for key, session in list(self.sessions.items()):
+            if session.last_seen < cutoff:
+                del self.sessions[key]
 
-    def update_auth_cutoff_time(self, restaurant_code):
-        current_time = datetime.datetime.now()
+                if self.latest.get(session.restaurant_code) is session:
+                    del self.latest[session.restaurant_code]
 
-        # Add the number of seconds this authentication should be active for this printer
-        future_cutoff_time = current_time + datetime.timedelta(seconds=int(self.auth_add_time))
+    def active_printers(self, window: float) -> int:
+        # Number of printers that polled within the last window seconds.
+        cutoff = time.monotonic() - window
 
-        # Set it as the new authentication cutoff time for this restaurant printer
-        self.auth_cutoff_times[restaurant_code] = future_cutoff_time
-        # print(f"auth_cutoff_times:{self.auth_cutoff_times}")
+        return sum(1 for session in list(self.sessions.values()) if session.last_poll > cutoff)
 
-    def get_auth_cutoff_time(self, restaurant_code: str):
-        return self.auth_cutoff_times.get(restaurant_code)
+    def stats(self) -> dict:
+        now = time.monotonic()
 
+        return {
+            "sessions": len(self.sessions),
+            "printers": [{"restaurant_code": session.restaurant_code,
+                          "mac": session.mac,
+                          "authenticated": session.is_authenticated(now),
+                          "idle_seconds": round(now - session.last_seen, 1),
+                          "polls": session.polls,
+                          "polls_per_minute": round(session.poll_rate(), 2),
+                          "last_status_code": session.last_status_code,
+                          "last_status": session.last_status} for session in list(self.sessions.values())],
+        }
@@ -2,8 +2,8 @@ from dotenv import load_dotenv
 import os
 
 
-def get_constant(constant: str):
-    return os.getenv(constant)
+def get_constant(constant: str, default=None):
+    return os.getenv(constant, default)
 
 
 class Environment(object):
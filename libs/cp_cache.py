@@ -0,0 +1,247 @@
+from collections import OrderedDict
+from typing import Optional
+import hashlib
+import logging
+import os
+import threading
+
+from libs.constants import get_constant
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionCache:
+    # Content addressed cache of CPUtil conversion output. Identical star markup converted to the
+    # same output format by the same CPUtil build always produces the same bytes, so re-prints and
+    # re-fetched orders skip the CPUtil subprocess.
+    #
+    # Two tiers, both bounded by size with least recently used eviction:
+    #   memory - recently converted payloads
+    #   disk   - payloads evicted from memory, kept in CLOUDPRINT_CACHE_FOLDER across restarts
+
+    _self = None
+    _initialized = False
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    def __init__(self):
+        if self._initialized:
+            return
+
+        self.lock = threading.Lock()
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.memory_limit = int(get_constant("CLOUDPRINT_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))
+
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.disk_limit = int(get_constant("CLOUDPRINT_CACHE_DISK_BYTES", 256 * 1024 * 1024))
+        self.folder = get_constant("CLOUDPRINT_CACHE_FOLDER", "cache")
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._cputil_version = None
+
+        self.load_disk_index()
+
+        ConversionCache._initialized = True
+
+    def load_disk_index(self):
+        # Rebuild the disk tier index from the files left by a previous run, oldest first.
+        if not os.path.isdir(self.folder):
+            return
+
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith(".cp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-3], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+        self._evict_disk()
+
+    def cputil_version(self) -> str:
+        # The CPUtil version is part of the key, a CPUtil upgrade must not serve stale conversions.
+        # CPUTIL_VERSION is combined with the size and modified time of the binary, so that replacing
+        # the binary invalidates the cache even if the constant is not updated.
+        if self._cputil_version is None:
+            version = str(get_constant("CPUTIL_VERSION", ""))
+
+            try:
+                stat = os.stat(get_constant("CPUTIL_LOCATION"))
+                version += f":{stat.st_size}:{int(stat.st_mtime)}"
+            except (OSError, TypeError):
+                pass
+
+            self._cputil_version = version
+
+        return self._cputil_version
+
+    def make_key(self, markup: bytes, output_format: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(self.cputil_version().encode())
+        digest.update(b"\0")
+        digest.update(str(output_format).encode())
+        digest.update(b"\0")
+        digest.update(markup)
+
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+
+        with self.lock:
+            payload = self.memory.get(key)
+
+            if payload is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return payload
+
+            in_disk = key in self.disk
+
+        if in_disk:
+            payload = self._read_disk(key)
+
+            if payload is not None:
+                with self.lock:
+                    self.disk_hits += 1
+
+                # Promote to the memory tier.
+                self._put_memory(key, payload)
+                return payload
+
+        with self.lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, key: str, payload: bytes):
+        self._put_memory(key, payload)
+
+    def _put_memory(self, key: str, payload: bytes):
+
+        evicted = []
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+
+            # Payloads larger than the memory tier go straight to disk.
+            if len(payload) > self.memory_limit:
+                evicted.append((key, payload))
+            else:
+                self.memory[key] = payload
+                self.memory_bytes += len(payload)
+
+            while self.memory_bytes > self.memory_limit:
+                old_key, old_payload = self.memory.popitem(last=False)
+                self.memory_bytes -= len(old_payload)
+                evicted.append((old_key, old_payload))
+
+        # Payloads evicted from memory are demoted to the disk tier.
+        for old_key, old_payload in evicted:
+            self._write_disk(old_key, old_payload)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".cp")
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+
+        try:
+            with open(path, "rb") as f:
+                payload = f.read()
+
+            # Touch the file so that the recency survives a restart.
+            os.utime(path)
+
+        except OSError:
+            with self.lock:
+                size = self.disk.pop(key, None)
+                if size is not None:
+                    self.disk_bytes -= size
+            return None
+
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+
+        return payload
+
+    def _write_disk(self, key: str, payload: bytes):
+
+        if self.disk_limit <= 0 or len(payload) > self.disk_limit:
+            return
+
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+                return
+
+        path = self._path(key)
+        tmp_path = path + "." + str(threading.get_ident()) + ".tmp"
+
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+
+            os.replace(tmp_path, path)
+
+        except OSError as e:
+            logger.error(f"Error writing conversion cache file [{path}]: {e!r}")
+            return
+
+        with self.lock:
+            self.disk[key] = len(payload)
+            self.disk_bytes += len(payload)
+
+        self._evict_disk()
+
+    def _evict_disk(self):
+
+        evicted = []
+
+        with self.lock:
+            while self.disk_bytes > self.disk_limit and len(self.disk) > 0:
+                old_key, size = self.disk.popitem(last=False)
+                self.disk_bytes -= size
+                self.evictions += 1
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups > 0 else 0.0,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "memory_limit": self.memory_limit,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+                "disk_limit": self.disk_limit,
+                "disk_evictions": self.evictions,
+            }
@@ -1,60 +1,241 @@
 import os.path
-import subprocess
+import asyncio
+import tempfile
 import logging
 import json
+from typing import Optional
 
+from libs.asb_status import decode_asb
 from libs.constants import get_constant
+from libs.cp_cache import ConversionCache
 
 logger = logging.getLogger(__name__)
 
 
-def create_cp_order(tmp_file: str, cp_file: str) -> str:
-    command = [
-        get_constant("CPUTIL_LOCATION"),
-        "dither",
-        "decode",
-        get_constant("CPUTIL_OUTPUT_FORMAT"),
-        tmp_file,
-        cp_file
-    ]
+class CPUtilError(Exception):
+    pass
+
+
+class CPUtilPool:
+    # Runs CPUtil as asyncio subprocesses, so conversions never block the event loop. The number of
+    # CPUtil processes running at the same time is bounded by CPUTIL_MAX_PROCESSES (defaults to the
+    # number of cores), further calls wait for a free slot. Every call is killed after CPUTIL_TIMEOUT.
+    #
+    # CPUtil converts a single input file per invocation, there is no batch mode to amortize the
+    # process startup across orders; conversions of identical markup are avoided by the
+    # ConversionCache instead.
+
+    _self = None
+    _semaphore: Optional[asyncio.Semaphore] = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # Calls running and waiting for a free slot, exposed for tuning.
+    running = 0
+    waiting = 0
+    timeouts = 0
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    def max_processes(self) -> int:
+        return int(get_constant("CPUTIL_MAX_PROCESSES", os.cpu_count() or 2))
+
+    def get_semaphore(self) -> asyncio.Semaphore:
+        # Created lazily, bound to the running event loop.
+        loop = asyncio.get_running_loop()
+
+        if CPUtilPool._semaphore is None or CPUtilPool._loop is not loop:
+            CPUtilPool._semaphore = asyncio.Semaphore(self.max_processes())
+            CPUtilPool._loop = loop
+
+        return CPUtilPool._semaphore
+
+    async def run(self, *args: str) -> bytes:
+        # Run CPUtil with these arguments and return its standard output.
+
+        command = [get_constant("CPUTIL_LOCATION"), *args]
+        timeout = float(get_constant("CPUTIL_TIMEOUT", 30))
+
+        semaphore = self.get_semaphore()
+
+        CPUtilPool.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            CPUtilPool.waiting -= 1
+
+        CPUtilPool.running += 1
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+
+            except asyncio.TimeoutError:
+                CPUtilPool.timeouts += 1
+                self.kill(process)
+                await process.wait()
+                raise CPUtilError(f"CPUtil timed out after {timeout}s: {args}")
+
+            except asyncio.CancelledError:
+                self.kill(process)
+                raise
+
+            # Per Subprocess documentation:
+            # Typically, an exit status of 0 for returncode indicates that subprocess ran successfully.
+            if process.returncode != 0:
+                raise CPUtilError(f"CPUtil exited with [{process.returncode}]: {stderr!r}")
+
+            return stdout
+
+        finally:
+            CPUtilPool.running -= 1
+            semaphore.release()
+
+    @staticmethod
+    def kill(process: asyncio.subprocess.Process):
+        # The process may have exited in the meantime.
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "max_processes": self.max_processes(),
+            "running": CPUtilPool.running,
+            "waiting": CPUtilPool.waiting,
+            "timeouts": CPUtilPool.timeouts,
+        }
+
+
+async def create_cp_order(tmp_file: str, cp_file: str, output_format: Optional[str] = None) -> str:
+
+    # Media type of the print job, defaults to CPUTIL_OUTPUT_FORMAT.
+    output_format = output_format or get_constant("CPUTIL_OUTPUT_FORMAT")
+
+    cache = ConversionCache()
+
+    # Identical markup converted before, write the cached conversion without running CPUtil.
+    with open(tmp_file, "rb") as f:
+        cache_key = cache.make_key(f.read(), output_format)
+
+    payload = cache.get(cache_key)
+    if payload is not None:
+        with open(cp_file, "wb") as f:
+            f.write(payload)
+
+        logger.info(f"cp file: [{cp_file}] created from the conversion cache.")
+
+        return cp_file
 
     try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        await CPUtilPool().run("dither", "decode", output_format, tmp_file, cp_file)
 
-        # Per Subprocess documentation:
-        # Typically, an exit status of 0 for returncode indicates that subprocess ran successfully.
         # We are performing an additional check whether the cp file exists.
-        if result.returncode == 0 and os.path.exists(cp_file):
+        if os.path.exists(cp_file):
             logger.info(f"cp file: [{cp_file}] successfully created.")
 
+            with open(cp_file, "rb") as f:
+                cache.put(cache_key, f.read())
+
             return cp_file
 
-    except subprocess.CalledProcessError as e:
-        logger.error("Error executing CPUtil command:", e)
+    except (CPUtilError, OSError) as e:
+        logger.error(f"Error executing CPUtil command: {e!r}")
 
 
-def decode_asb_status(statusCode: str, status: str):
+def scratch_folder() -> str:
+    # Memory backed (tmpfs) folder for the short-lived markup input handed to CPUtil.
+    folder = get_constant("CLOUDPRINT_RENDER_SCRATCH_FOLDER")
+
+    if folder is None:
+        folder = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+    return folder
 
-    logger.info(f"Printer [Status code: {statusCode}] [status:{status}]")
 
-    command = [
-        get_constant("CPUTIL_LOCATION"),
-        "jsonstatus",
-        status
-    ]
+async def convert_markup(markup: bytes, output_format: Optional[str] = None) -> Optional[bytes]:
+    # Diskless variant of create_cp_order: converts star markup held in memory and returns the
+    # converted print job. CPUtil writes its output to a pipe ("[stdout]"). The markup is handed over
+    # in an unlinked-on-close file in the memory backed scratch folder, as CPUtil reads its input
+    # from a named .stm file.
+
+    # Media type of the print job, defaults to CPUTIL_OUTPUT_FORMAT.
+    output_format = output_format or get_constant("CPUTIL_OUTPUT_FORMAT")
+
+    cache = ConversionCache()
+
+    # Identical markup converted before, return the cached conversion without running CPUtil.
+    cache_key = cache.make_key(markup, output_format)
+
+    payload = cache.get(cache_key)
+    if payload is not None:
+        return payload
 
     try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        with tempfile.NamedTemporaryFile(suffix=".stm", dir=scratch_folder()) as tmp_file:
+            tmp_file.write(markup)
+            tmp_file.flush()
+
+            payload = await CPUtilPool().run(
+                "dither", "decode", output_format, tmp_file.name, "[stdout]")
+
+        if len(payload) > 0:
+            cache.put(cache_key, payload)
+
+            return payload
 
-        # Per Subprocess documentation:
-        # Typically, an exit status of 0 for returncode indicates that subprocess ran successfully.
+        logger.error("CPUtil returned an empty print job.")
+
+    except CPUtilError as e:
+        logger.error(f"Error executing CPUtil command: {e!r}")
+
+    except OSError as e:
+        logger.error(f"Error creating CPUtil scratch file: {e!r}")
+
+    return None
+
+
+async def decode_asb_status(statusCode: str, status: str):
+
+    logger.info(f"Printer [Status code: {statusCode}] [status:{status}]")
+
+    if status is None:
+        return
+
+    # CLOUDPRINT_ASB_DECODER selects the decoder: "python" decodes in-process and falls back to
+    # CPUtil for statuses it cannot parse, "cputil" always runs CPUtil, "verify" runs both and
+    # logs any difference.
+    mode = str(get_constant("CLOUDPRINT_ASB_DECODER", "python")).lower()
+
+    decoded = None
+    if mode != "cputil":
+        decoded = decode_asb(status)
+
+        if decoded is not None and mode != "verify":
+            logger.info(f"Decoded printer status: {decoded}")
+            return
+
+    try:
+        result = await CPUtilPool().run("jsonstatus", status)
 
-        if result.returncode == 0:
-            # Convert JSON result string to dictionary
-            result_dict = json.loads(result.stdout)
-            logger.info(f"Decoded printer status: {result_dict}")
+        # Convert JSON result string to dictionary
+        result_dict = json.loads(result)
+        logger.info(f"Decoded printer status: {result_dict}")
 
-    except subprocess.CalledProcessError as e:
-        logger.error("Error executing CPUtil command:", e)
+    except (CPUtilError, OSError, ValueError) as e:
+        logger.error(f"Error executing CPUtil command: {e!r}")
+        return
 
+    if decoded is not None and isinstance(result_dict, dict):
+        differences = {key: (value, result_dict[key]) for key, value in decoded.items()
+                       if key in result_dict and result_dict[key] != value}
 
+        if len(differences) > 0:
+            logger.warning(f"ASB status decoder differs from CPUtil for [status:{status}], "
+                           f"(decoder, CPUtil): {differences}")
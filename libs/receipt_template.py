@@ -0,0 +1,140 @@
+from typing import Iterable, Optional
+import hashlib
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Placeholders take the form {PLACEHOLDER_NAME}. Star markup uses square brackets for its commands,
+# any other text in curly braces is left as-is.
+PLACEHOLDER_PATTERN = re.compile(r"\{([A-Z][A-Z0-9_]*)\}")
+
+# A template may be divided into sections by lines holding only a section marker, e.g. {#header}.
+# Sections are printed in the order they appear in the template. The header and footer sections
+# hold the static restaurant block, they are rendered and converted once per restaurant.
+SECTION_PATTERN = re.compile(r"^\{#(header|body|footer)\}[ \t]*(?:\n|$)", re.MULTILINE)
+
+# Header row printed before the item rows of an order.
+ITEM_ROWS_HEADER = "[column: left: Item; right: Quantity]\n"
+
+
+def format_item_rows(rows: list) -> str:
+    # Item and quantity of each order item appear in the same line.
+    return ITEM_ROWS_HEADER + "".join(f"[column: left: {row[0]}; right: {row[1]}]\n" for row in rows)
+
+
+class CompiledTemplate:
+    # Print order template parsed once into a list of literal text and placeholder segments.
+    # Rendering is a single pass over the segments, the cost does not depend on the number of
+    # placeholders replaced earlier or on the size of the values.
+
+    def __init__(self, content: str, name: str = None):
+        self.name = name
+
+        # Identifies the template content, used in the keys of rendered output caches.
+        self.digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+        # Section name -> CompiledTemplate of that section, empty if the template has no sections.
+        self.sections = {}
+
+        parts = SECTION_PATTERN.split(content)
+        if len(parts) > 1:
+            names = parts[1::2]
+            contents = parts[2::2]
+
+            # Text before the first section marker belongs to the first section.
+            contents[0] = parts[0] + contents[0]
+
+            for section, section_content in zip(names, contents):
+                self.sections[section] = CompiledTemplate(section_content, name=f"{name}#{section}")
+
+            # The whole template, without the section markers.
+            content = "".join(contents)
+
+        # Segments alternate between literal text (even indexes) and placeholder names (odd indexes).
+        self.segments = PLACEHOLDER_PATTERN.split(content)
+        self.placeholders = frozenset(self.segments[1::2])
+
+    def section(self, name: str) -> Optional["CompiledTemplate"]:
+        return self.sections.get(name)
+
+    def check(self, known_placeholders: Iterable[str]) -> tuple:
+        # Report placeholders in the template that no value is provided for, and values that
+        # the template does not use.
+        known_placeholders = set(known_placeholders)
+
+        unknown = sorted(self.placeholders - known_placeholders)
+        missing = sorted(known_placeholders - self.placeholders)
+
+        if len(unknown) > 0:
+            logger.warning(f"Template [{self.name}] contains unknown placeholders, left as-is: {unknown}")
+
+        if len(missing) > 0:
+            logger.warning(f"Template [{self.name}] does not use placeholders: {missing}")
+
+        return unknown, missing
+
+    def render(self, values: dict) -> str:
+        parts = []
+
+        for index, segment in enumerate(self.segments):
+
+            if index % 2 == 0:
+                parts.append(segment)
+                continue
+
+            if segment not in values:
+                # Unknown placeholder, keep it in the output as it is.
+                parts.append("{" + segment + "}")
+                continue
+
+            value = values[segment]
+
+            if isinstance(value, list):
+                # The only list value holds the item rows of the order.
+                parts.append(format_item_rows(value))
+
+            else:
+                parts.append(str(value))
+
+        return "".join(parts)
+
+
+class TemplateCache:
+    # Compiled templates keyed by file path, recompiled when the file's modified time changes.
+
+    _self = None
+    templates = {}
+    lock = threading.Lock()
+
+    def __new__(cls):
+        # Create an instance of this class only if it does not already exist.
+        if cls._self is None:
+            cls._self = super().__new__(cls)
+        return cls._self
+
+    def get(self, template_file: str, known_placeholders: Optional[Iterable[str]] = None) -> CompiledTemplate:
+        mtime = os.stat(template_file).st_mtime_ns
+
+        cached = self.templates.get(template_file)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with self.lock:
+            cached = self.templates.get(template_file)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+            with open(template_file, 'r') as f:
+                template = CompiledTemplate(f.read(), name=template_file)
+
+            logger.info(f"Compiled template [{template_file}] with placeholders: {sorted(template.placeholders)}")
+
+            if known_placeholders is not None:
+                template.check(known_placeholders)
+
+            self.templates[template_file] = (mtime, template)
+
+        return template
@@ -1,14 +1,30 @@
+import asyncio
 import os
 
 import uvicorn
 from fastapi import FastAPI
-from fastapi_utilities import repeat_every
-from sqlmodel import SQLModel
 
 from routers.cloudprint_methods import router
+from routers.ingest_methods import router as ingest_router
+from routers.shard_routing import route_to_shard
+from routers.stats_methods import router as stats_router
 from setup import init
-from database.cloudprint_db import db_engine
-from backend.cron_methods import cloudprint_orders
+from database.cloudprint_db import init_db
+from backend.cron_methods import release_moved_restaurants, requeue_orders, restore_orders
+from backend.fetch_leader import FetchLeader
+from backend.fetch_scheduler import FetchScheduler
+from backend.job_leases import JobLeases
+from backend.logo_cache import LogoCache
+from backend.potlam_backend import AsyncPotlamBackend
+from backend.render_pipeline import RenderPipeline
+from backend.route_executor import RouteExecutor
+from backend.shard_client import ShardClient
+from backend.shard_ring import ShardRing
+from backend.media_types import MediaTypes
+from backend.shared_queue import is_shared_queue, SharedAuthorizations, SharedMediaTypes
+from backend.status_updater import StatusUpdater
+from database.db_writer import DatabaseWriter
+from libs.auth import PrinterSessions
 
 app = FastAPI(title="RSData POTLAM CloudPrint Service",
               summary="REST API Service that integrates with POTLAM backend and a StarMicronics CloudPRNT device. "
@@ -17,21 +33,83 @@ app = FastAPI(title="RSData POTLAM CloudPrint Service",
 
 # Register router with the FastAPI app.
 app.include_router(router)
+app.include_router(ingest_router)
+app.include_router(stats_router)
+
+# Send the printer requests for restaurants of other shard nodes to their node.
+app.middleware("http")(route_to_shard)
 
 
 @app.on_event('startup')
 async def on_startup():
     init()
 
-    # Create all database tables (SQLModels) during the startup, if they don't already exist.
-    SQLModel.metadata.create_all(db_engine)
+    # Partition the restaurants between the service nodes, if sharding is enabled.
+    ShardRing().configure()
+
+    # Size Starlette's thread pool, if configured.
+    RouteExecutor().configure()
+
+    # Create all database tables (SQLModels) during the startup, if they don't already exist,
+    # and migrate an existing database to the current schema.
+    init_db()
+
+    # Start sending order status updates to the POTLAM backend in bulk.
+    StatusUpdater().start()
+
+    # Put the orders of the jobs not confirmed by their printer back in the queues once their lease expires.
+    JobLeases().start(requeue_orders)
+
+    if is_shared_queue():
+        # Worker processes share the queues, the printer authorizations and the negotiated print job media types
+        # through the database, and only one of them fetches orders from the POTLAM backend and renders them
+        # ahead of time.
+        PrinterSessions.shared_store = SharedAuthorizations()
+        MediaTypes.shared_store = SharedMediaTypes()
+        FetchLeader().start(start_fetching)
+
+    else:
+        await start_fetching()
+
+    # Release the restaurants that move to another node when the shard membership changes.
+    ShardRing().start(rebalance)
+
+
+async def start_fetching():
+    # Rebuild the print queues from the database before the first printer poll is answered.
+    await restore_orders()
+
+    # Fetch cloud print orders from the POTLAM backend, at an interval adapted to the printer activity.
+    FetchScheduler().start()
+
+
+async def rebalance() -> int:
+    moved = await asyncio.to_thread(release_moved_restaurants)
+
+    # Pick up the orders of the restaurants that moved to this node.
+    FetchScheduler().fetch_now()
+
+    return moved
+
+
+@app.on_event('shutdown')
+async def on_shutdown():
+    # Stop fetching orders from the POTLAM backend, and let another worker take over.
+    await FetchScheduler().stop()
+    await FetchLeader().stop()
+    await ShardRing().stop()
+    await JobLeases().stop()
 
-    # Fetch cloud print orders from the POTLAM backend
-    await fetch_orders()
+    # Send the pending order status updates and close the shared POTLAM backend connection pool.
+    await StatusUpdater().stop()
+    await AsyncPotlamBackend.close()
+    await ShardClient.close()
+    await LogoCache().close()
 
+    # Stop the render workers, pending renders are discarded.
+    RenderPipeline().shutdown()
+    RouteExecutor().shutdown()
 
-@repeat_every(seconds=30)
-# @repeat_every(seconds=86400)
-async def fetch_orders():
-    await cloudprint_orders()
+    # Commit the database writes still queued and stop the database writer.
+    await DatabaseWriter().stop()
 
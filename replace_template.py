@@ -1,11 +1,18 @@
 import os.path
 
 import logging
-
-from backend.schemas import PrintOrderItem, Toppings, Topping, BodyItem
-from database.cloudprint_db import delete_order_from_db
+from typing import Optional
+
+from backend.job_leases import JobLeases
+from backend.logo_cache import LogoCache
+from backend.media_types import default_media_type, is_segmentable
+from backend.order_queue import OrderQueue, parse_job_token
+from backend.schemas import PrintOrderItem, Toppings, Topping, BodyItem, RestaurantDetails
+from backend.segment_cache import SegmentCache
+from database.db_writer import DatabaseWriter
 from libs.constants import get_constant
-from libs.cputil import create_cp_order
+from libs.cputil import create_cp_order, convert_markup
+from libs.receipt_template import TemplateCache
 
 # Create a logger
 logger = logging.getLogger(__name__)
@@ -13,32 +20,11 @@ logger = logging.getLogger(__name__)
 
 # Replace placeholders from the template file with this order's values
 def replace_placeholders(template_file, values):
-    with open(template_file, 'r') as f:
-        template_content = f.read()
-
-    # Iterate over the keys in the order_values dictionary
-    for key, value in values.items():
-
-        # Check if the value is an array - there is only one array,
-        # which contains arrays of items and prices. if needed, we can add quantity as well later,
-        # by adding a third item (quantity) to the inner array.
-
-        if isinstance(value, list):
-            # For arrays, iterate over each element and format them together
-            # such that item and price appears in the same line
-            formatted_item_row = f"[column: left: Item; right: Quantity]\n"
-            for order_item in value:
-                formatted_item_row += f"[column: left: {order_item[0]}; right: {order_item[1]}]\n"
-
-            # Replace placeholder in the template with the formatted order item row
-            template_content = template_content.replace(f"{{{key}}}", formatted_item_row)
-
-        else:
 
-            # Otherwise, placeholder is a string - directly replace placeholder with the value
-            template_content = template_content.replace(f"{{{key}}}", str(value))
+    # The template is compiled once and re-used until the file changes.
+    template = TemplateCache().get(template_file, known_placeholders=values.keys())
 
-    return template_content
+    return template.render(values)
 
 
 def extract_order_details(print_order: PrintOrderItem) -> list:
@@ -81,17 +67,22 @@ def extract_order_details(print_order: PrintOrderItem) -> list:
     return order_item_rows
 
 
-def create_print_file(order: BodyItem) -> str:
-    # Print order template file
+def restaurant_values(restaurant_details: RestaurantDetails) -> dict:
+    # Values of the static restaurant block printed on every receipt of this restaurant. The logo is printed
+    # from its local copy once downloaded.
+    return {
+        "LOGO_IMAGE_URL": LogoCache().local(restaurant_details.logo_url),
+        "ORDER_RECEIPT_TITLE": restaurant_details.name,
+        "RESTAURANT_ADDRESS": restaurant_details.address,
+        "RESTAURANT_PHONE_NO": restaurant_details.phone,
+        "FOOTER_MESSAGE": restaurant_details.message
+    }
+
+
+def order_values(order: BodyItem) -> dict:
 
-    uuid = order.uuid
-    logo_url = order.restaurant_details.logo_url
-    title = order.restaurant_details.name
-    restaurant_address = order.restaurant_details.address
-    restaurant_phone = order.restaurant_details.phone
     datetime = order.print_order.orderdate + " " + order.print_order.ordertime
     print_order = order.print_order
-    footer = order.restaurant_details.message
 
     order_items = extract_order_details(print_order)
 
@@ -101,11 +92,8 @@ def create_print_file(order: BodyItem) -> str:
     discount = order.print_order.discount
     final_total = order.print_order.total
 
-    order_values = {
-        "LOGO_IMAGE_URL": logo_url,
-        "ORDER_RECEIPT_TITLE": title,
-        "RESTAURANT_ADDRESS": restaurant_address,
-        "RESTAURANT_PHONE_NO": restaurant_phone,
+    values = restaurant_values(order.restaurant_details)
+    values.update({
         "ORDER_ID": print_order.order_id,
         "ORDER_DATETIME": datetime,
         "ORDER_ITEM_ROWS": order_items,
@@ -114,11 +102,47 @@ def create_print_file(order: BodyItem) -> str:
         "TIPS": tips,
         "DISCOUNT": discount,
         "FINAL_TOTAL": final_total,
-        "FOOTER_MESSAGE": footer
-    }
+    })
 
+    return values
+
+
+def render_markup(order: BodyItem) -> str:
+    # Fill the print order template with this order's values, returns the star markup.
     template_file = get_constant("CLOUDPRINT_ORDER_PRINT_TEMPLATE")
-    content = replace_placeholders(template_file, order_values)
+
+    return replace_placeholders(template_file, order_values(order))
+
+
+async def render_segmented_print_job(order: BodyItem, media_type: str) -> Optional[bytes]:
+    # Assemble the print job from the restaurant's cached header and footer and a freshly
+    # converted order body. Returns None if the template has no sections to cache. Only used for
+    # the encodings whose segments concatenate safely, see is_segmentable.
+
+    values = order_values(order)
+    template = TemplateCache().get(get_constant("CLOUDPRINT_ORDER_PRINT_TEMPLATE"), known_placeholders=values.keys())
+
+    body = template.section("body")
+    if body is None:
+        return None
+
+    segments = await SegmentCache().get(order.restaurant_code, order.restaurant_details, template,
+                                        restaurant_values(order.restaurant_details), media_type)
+    if segments is None:
+        return None
+
+    payload = await convert_markup(body.render(values).encode("utf-8"), media_type)
+    if payload is None:
+        return None
+
+    return segments.header + payload + segments.footer
+
+
+async def create_print_file(order: BodyItem, media_type: str) -> str:
+    # Print order template file
+
+    uuid = order.uuid
+    content = render_markup(order)
 
     tmp_file = os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".stm")
     cp_file = os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".cp")
@@ -128,31 +152,89 @@ def create_print_file(order: BodyItem) -> str:
         file.write(content)
 
     # create the cloud print understandable file based on the tmp file using the CPUtil
-    cp_file = create_cp_order(tmp_file=tmp_file, cp_file=cp_file)
+    cp_file = await create_cp_order(tmp_file=tmp_file, cp_file=cp_file, output_format=media_type)
 
     return cp_file
 
 
+def is_segment_cache_enabled() -> bool:
+    # Set CLOUDPRINT_SEGMENT_CACHE=false to always convert the whole receipt in one CPUtil call.
+    return get_constant("CLOUDPRINT_SEGMENT_CACHE", "true").lower() == "true"
+
+
+def is_file_render_mode() -> bool:
+    # CLOUDPRINT_RENDER_MODE=file keeps the .stm and .cp files of every order in the
+    # CLOUDPRINT_ORDER_TEMP_FOLDER, the default "memory" mode renders without persistent files.
+    return get_constant("CLOUDPRINT_RENDER_MODE", "memory") == "file"
+
+
+async def render_print_job(order: BodyItem, media_type: Optional[str] = None) -> Optional[bytes]:
+    # Render this order and return the print job that is sent to the printer, encoded as media_type.
+    media_type = media_type or default_media_type()
+
+    # Download the logo once, CPUtil reads the local copy instead of downloading it on every conversion.
+    await LogoCache().fetch(order.restaurant_details.logo_url)
+
+    if is_file_render_mode():
+        cp_file = await create_print_file(order, media_type)
+
+        if cp_file is not None:
+            with open(cp_file, "rb") as f:
+                return f.read()
+
+    else:
+        payload = None
+
+        if is_segment_cache_enabled() and is_segmentable(media_type):
+            payload = await render_segmented_print_job(order, media_type)
+
+        if payload is None:
+            payload = await convert_markup(render_markup(order).encode("utf-8"), media_type)
+
+        if payload is not None:
+            return payload
+
+    logger.error(f"Failed to render order [{order.restaurant_code}] [order_id:{order.order_id}] "
+                 f"[cloudprint_id:{order.cloud_print_id}].")
+
+    return None
+
+
 def cleanup(restaurant_code: str, job_token: str):
-    # Split the job_token by underscores and take the last element (uuid) which is used to create the temporary files.
-    # job_token takes the form: <restaurant_code>_<order_id>_<cloud_print_id>_<uuid>
+    # job_token takes the form: <restaurant_code>_<order_id>_<cloud_print_id>_<uuid>, the uuid is used to create
+    # the temporary files.
+    parts = parse_job_token(job_token)
 
-    uuid = job_token.split("_")[-1]
-    order_id = job_token.split("_")[1]
+    if parts is None:
+        logger.error(f"Cleanup of an invalid job token [{job_token}] skipped.")
+        return
+
+    _, order_id, cloud_print_id, uuid = parts
 
     logger.info(f"Cleaning up by removing tmp files and Database entry. [{restaurant_code}] "
                 f"[order.id:{order_id}] [uuid:{uuid}].")
 
-    stm_file = os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".stm")
-    cp_file = os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".cp")
+    # The order may have been queued again, when it was fetched before its status reached the POTLAM backend. Left
+    # in the queue without its payload, dropped below, it would block the orders of the restaurant behind it.
+    OrderQueue().remove_order(restaurant_code, order_id, cloud_print_id)
+
+    # Drop the rendered payload if the order was never printed, including a copy spilled to disk.
+    OrderQueue().discard_payload(uuid)
+
+    # The printer confirmed the job, its lease is released.
+    JobLeases().release(uuid)
+
+    if is_file_render_mode():
+        stm_file = os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".stm")
+        cp_file = os.path.join(get_constant("CLOUDPRINT_ORDER_TEMP_FOLDER"), uuid + ".cp")
 
-    # Check if the stm file exists, if yes, remove file.
-    if os.path.exists(stm_file):
-        os.remove(stm_file)
+        # Check if the stm file exists, if yes, remove file.
+        if os.path.exists(stm_file):
+            os.remove(stm_file)
 
-    # Check if the cp file exists, if yes, remove file.
-    if os.path.exists(cp_file):
-        os.remove(cp_file)
+        # Check if the cp file exists, if yes, remove file.
+        if os.path.exists(cp_file):
+            os.remove(cp_file)
 
-    # Remove this order from the orders sqlite3 database table.
-    delete_order_from_db(restaurant_code=restaurant_code, order_id=order_id)
+    # Remove this order from the orders sqlite3 database table, committed by the database writer.
+    DatabaseWriter().delete_order(restaurant_code=restaurant_code, order_id=order_id)
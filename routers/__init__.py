@@ -1 +1 @@
-from libs.auth import Auth
+from libs.auth import PrinterSessions
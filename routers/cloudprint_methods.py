@@ -1,110 +1,348 @@
 from typing import Optional
+from urllib.parse import urlencode
 
-from fastapi import APIRouter, Header, status
-from fastapi.responses import Response
+from fastapi import APIRouter, BackgroundTasks, Header, Query, Request, status
+from fastapi.responses import FileResponse, Response
 
 import logging
-
-from backend.order_queue import OrderQueue
-from backend.potlam_backend import update_status
+import time
+
+from backend.fetch_scheduler import FetchScheduler
+from backend.job_leases import JobLease, JobLeases
+from backend.media_types import MediaTypes
+from backend.order_queue import job_token, OrderQueue, parse_job_token
+from backend.render_pipeline import RenderPipeline
+from backend.route_executor import RestaurantLocks, RouteExecutor
 from backend.schemas import PostPollRequest, PostPollResponse
-from database.cloudprint_db import update_order_status_in_db
-from libs.auth import Auth
+from backend.status_updater import StatusUpdater
+from database.db_writer import DatabaseWriter
+from libs.auth import PrinterSessions
 from libs.constants import get_constant
 from libs.cputil import decode_asb_status
-from replace_template import create_print_file, cleanup
+from replace_template import cleanup
 
 router = APIRouter(prefix="/cloudprint")
 
-auth = Auth()
+printer_sessions = PrinterSessions()
+
+render_pipeline = RenderPipeline()
+
+db_writer = DatabaseWriter()
+
+status_updater = StatusUpdater()
+
+fetch_scheduler = FetchScheduler()
+
+route_executor = RouteExecutor()
 
-queue = OrderQueue()
+restaurant_locks = RestaurantLocks()
+
+job_leases = JobLeases()
+
+media_types = MediaTypes()
 
 # Create a logger
 logger = logging.getLogger(__name__)
 
 
+def job_token_for(order) -> str:
+    return job_token(order.restaurant_code, order.order_id, order.cloud_print_id, order.uuid)
+
+
+def job_response(lease: JobLease, if_none_match: Optional[str]) -> Response:
+    # The leased job is served from its file, with the same ETag and Content-Length on every GET of its token.
+    if if_none_match == lease.etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": lease.etag})
+
+    return FileResponse(job_leases.job_path(lease.uuid), media_type=lease.media_type, headers={"ETag": lease.etag})
+
+
+async def lease_job(queue: OrderQueue, restaurant_code: str, order, mac: Optional[str], media_type: str,
+                    if_none_match: Optional[str]) -> Response:
+    # Render the order claimed by this GET, unless rendered ahead of time, and lease it to the printer.
+
+    # Update status of this order to CLOUDPRINT_STATUS_PRINT_IN_PROGRESS in the database, committed by the database
+    # writer together with the other writes of the next few milliseconds. Set as soon as the order is claimed: a
+    # fetch of the order before its status reaches the POTLAM backend must not queue it again.
+    db_writer.update_status(order.uuid, str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
+
+    # Serve the payload rendered ahead of time, render inline only if it is not ready yet or was rendered
+    # in another media type than the one the printer asked for.
+    content = await route_executor.run(queue.take_payload, order.uuid, media_type, blocking=queue.blocking)
+    if content is None:
+        content = await render_pipeline.render_now(order, media_type)
+
+    if content is None:
+        # The order is fetched and queued again.
+        db_writer.update_status(order.uuid, str(get_constant("CLOUDPRINT_STATUS_PRINT_PENDING")))
+
+        message = "Failed to render order " + order.order_id + " for " + restaurant_code
+        return Response(content=message, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        media_type="text/plain")
+
+    # Update status of this order in the POTLAM Backend, sent with the next bulk status update.
+    status_updater.record(order.cloud_print_id, str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
+
+    logger.info(f"Printing order [{restaurant_code}] [order.id:{order.order_id}] "
+                f"[cloudprint_id:{order.cloud_print_id}] [{media_type}, {len(content)} bytes]")
+
+    media_types.record(media_type, len(content))
+
+    try:
+        lease = await route_executor.run(job_leases.create, job_token_for(order), order.uuid, mac, content,
+                                         media_type)
+
+    except OSError as e:
+        # The job is still printed, it cannot be replayed.
+        logger.error(f"Error leasing the job of order [{restaurant_code}] [order_id:{order.order_id}]: {e!r}")
+        return Response(content, status_code=200, media_type=media_type)
+
+    return job_response(lease, if_none_match)
+
+
+def job_token_parts(restaurant_code: str, token: str) -> Optional[tuple[str, str, str, str]]:
+    # job_token takes the form: <restaurant_code>_<order_id>_<cloud_print_id>_<uuid>, None if the token is not
+    # a job token of this restaurant.
+    parts = parse_job_token(token)
+
+    if parts is None or parts[0] != restaurant_code.lower():
+        return None
+
+    return parts
+
+
+def unknown_job_token(token: str) -> Response:
+    return Response(content="Unknown job token " + token, status_code=status.HTTP_404_NOT_FOUND,
+                    media_type="text/plain")
+
+
+async def serve_job(restaurant_code: str, token: str, mac: Optional[str], media_type: str,
+                    if_none_match: Optional[str]) -> Response:
+    # GET of a job token: the first GET claims and leases the order of the token, the next GETs of the same
+    # printer replay the same job until it is confirmed with a DELETE or its lease expires.
+
+    parts = job_token_parts(restaurant_code, token)
+    if parts is None:
+        return unknown_job_token(token)
+
+    _, order_id, cloud_print_id, uuid = parts
+
+    lease = await route_executor.run(job_leases.load, uuid)
+
+    if lease is None:
+        queue = OrderQueue()
+
+        async with restaurant_locks.claim(restaurant_code):
+            lease = await route_executor.run(job_leases.load, uuid)
+
+            if lease is None:
+                order = await route_executor.run(queue.claim_order, restaurant_code.lower(), order_id, cloud_print_id,
+                                                 uuid, blocking=queue.blocking)
+
+                if order is not None:
+                    logger.info(f"Order claimed by job token [{token}]")
+                    return await lease_job(queue, restaurant_code, order, mac, media_type, if_none_match)
+
+                # Claimed by another worker process at the same time, or printed already.
+                lease = await route_executor.run(job_leases.load, uuid)
+
+    if lease is None:
+        return Response(content="No job for token " + token + ", it may have been printed already.",
+                        status_code=status.HTTP_404_NOT_FOUND, media_type="text/plain")
+
+    # A job is only replayed to the printer it was leased to.
+    if lease.mac and mac and lease.mac != mac.lower():
+        return Response(content="Job " + token + " is leased to another printer.",
+                        status_code=status.HTTP_409_CONFLICT, media_type="text/plain")
+
+    JobLeases.replayed += 1
+    logger.info(f"Replaying leased job [{token}]")
+
+    return job_response(lease, if_none_match)
+
+
+def authentication_required(auth_response) -> Response:
+    # CloudPrnt request needs to be authenticated, before any service calls can be placed.
+    # Set status_code = 401, if authentication required.
+    response = Response(content=auth_response.to_json(), status_code=auth_response.http_status)
+    response.headers["WWW-Authenticate"] = "Basic realm=\"Authentication Required\""
+
+    return response
+
+
 @router.get("/{restaurant_code}")
-def get_print_job(restaurant_code: str):
+async def get_print_job(restaurant_code: str,
+                        mac: Optional[str] = None,
+                        token: Optional[str] = None,
+                        media_type: Optional[str] = Query(None, alias="type"),
+                        Authorization: Optional[str] = Header(None),
+                        if_none_match: Optional[str] = Header(None)):
 
-    auth_response = auth.is_authorized(authorization=None, restaurant_code=restaurant_code.lower())
+    session, auth_response = await route_executor.run(printer_sessions.authorize, restaurant_code.lower(), mac,
+                                                      Authorization, blocking=PrinterSessions.shared_store is not None)
 
-    if auth_response.status:
+    if not auth_response.status:
+        return authentication_required(auth_response)
+
+    # The media type the printer picked from the ones offered in the POST response.
+    media_type = await route_executor.run(media_types.requested, restaurant_code, media_type,
+                                          blocking=MediaTypes.shared_store is not None)
+
+    # Printers that send the job token of the POST response get the job of that token.
+    if token:
+        return await serve_job(restaurant_code, token, mac, media_type, if_none_match)
+
+    # In-process or shared by the worker processes, see CLOUDPRINT_QUEUE_BACKEND.
+    queue = OrderQueue()
 
-        if queue.is_job_ready(restaurant_code):
+    # Star CloudPrnt prints only one order at a time, and makes subsequent POST and GET calls
+    # to fetch more orders if any in the queue. Concurrent GETs of a restaurant claim its orders
+    # one at a time.
+    async with restaurant_locks.claim(restaurant_code):
+        try:
+            order = await route_executor.run(queue.pop_order, restaurant_code.lower(), blocking=queue.blocking)
 
-            # Star CloudPrnt prints only one order at a time, and makes subsequent POST and GET calls
-            # to fetch more orders if any in the queue.
+        except IndexError:
+            # No order in the queue, or the last order was claimed by another worker process.
+            order = None
 
-            order = queue.pop_order(restaurant_code.lower())
+    if order is None:
+        message = "No more orders in queue for " + restaurant_code
+        return Response(content=message, status_code=200, media_type="text/plain")
 
-            logger.info(f"Order popped from CloudPrint Queue [{order.restaurant_code}] [order_id:{order.order_id}] "
-                        f"[cloudprint_id:{order.cloud_print_id}] "
-                        f"[order date/time:{order.print_order.orderdate} {order.print_order.ordertime}]")
+    logger.info(f"Order popped from CloudPrint Queue [{order.restaurant_code}] [order_id:{order.order_id}] "
+                f"[cloudprint_id:{order.cloud_print_id}] "
+                f"[order date/time:{order.print_order.orderdate} {order.print_order.ordertime}]")
 
-            cp_file = create_print_file(order)
+    return await lease_job(queue, restaurant_code, order, mac, media_type, if_none_match)
 
-            # Update status of this order in the POTLAM Backend
-            update_status(cloud_print_id=order.cloud_print_id,
-                          status=str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
 
-            # Update status of this order to CLOUDPRINT_STATUS_PRINT_IN_PROGRESS in the database
-            update_order_status_in_db(uuid=order.uuid, status=str(get_constant("CLOUDPRINT_STATUS_PRINT_IN_PROGRESS")))
+@router.get("/{restaurant_code}/job/{token}", name="get_leased_job")
+async def get_leased_job(restaurant_code: str,
+                         token: str,
+                         mac: Optional[str] = None,
+                         media_type: Optional[str] = Query(None, alias="type"),
+                         Authorization: Optional[str] = Header(None),
+                         if_none_match: Optional[str] = Header(None)):
+    # jobGetUrl of the POST response, the job of this token.
 
-            # Send this order, the CP file for printing in the response body.
+    session, auth_response = await route_executor.run(printer_sessions.authorize, restaurant_code.lower(), mac,
+                                                      Authorization, blocking=PrinterSessions.shared_store is not None)
 
-            with open(cp_file, "rb") as f:
-                content = f.read()
+    if not auth_response.status:
+        return authentication_required(auth_response)
 
-            logger.info(f"Printing order [{restaurant_code}] [order.id:{order.order_id}] "
-                        f"[cloudprint_id:{order.cloud_print_id}]")
-            logger.info(f"No of orders in queue for [{restaurant_code}]: [{queue.length(restaurant_code)}]")
+    media_type = await route_executor.run(media_types.requested, restaurant_code, media_type,
+                                          blocking=MediaTypes.shared_store is not None)
 
-            return Response(content, status_code=200, media_type="application/vnd.star.starprnt")
+    return await serve_job(restaurant_code, token, mac, media_type, if_none_match)
 
-        else:
-            message = "No more orders in queue for " + restaurant_code
-            return Response(content=message, status_code=200, media_type="text/plain")
 
+def job_get_url(http_request: Request, restaurant_code: str, job_token: str, media_type: str) -> str:
+    # URL of the leased job of this token, in the media type negotiated with the printer. Behind a proxy or
+    # load balancer set CLOUDPRINT_PUBLIC_URL to the address the printers use, e.g. https://print.example.com
+    public_url = get_constant("CLOUDPRINT_PUBLIC_URL")
+
+    if public_url:
+        url = public_url.rstrip("/") + router.prefix + "/" + restaurant_code + "/job/" + job_token
     else:
-        # CloudPrnt request needs to be authenticated, before any service calls can be placed.
-        # Set status_code = 401, if authentication required.
-        response = Response(content=auth_response.to_json(), status_code=auth_response.http_status)
-        response.headers["WWW-Authenticate"] = "Basic realm=\"Authentication Required\""
+        url = str(http_request.url_for("get_leased_job", restaurant_code=restaurant_code, token=job_token))
 
-    return response
+    return url + "?" + urlencode({"type": media_type})
+
+
+def negotiate_media_types(restaurant_code: str, session, client_actions: Optional[list]) -> list[str]:
+    # Media types offered to this printer, the printer prints in the first one it supports.
+
+    # Encodings the printer supports, reported in response to the "Encodings" client action.
+    supported = media_types.parse_encodings(client_actions)
+    if supported is not None:
+        session.media_types = supported
+
+    offered = media_types.offered(session.media_types)
+
+    # Orders of this restaurant are rendered ahead of time in the media type its printer will pick.
+    if session.media_types is not None:
+        media_types.select(restaurant_code, offered[0])
+
+    return offered
+
+
+def encodings_request(session, job_ready: bool) -> Optional[list]:
+    # Ask the printer for the encodings it supports, when no job is waiting. Printers that do not answer
+    # are asked again every CLOUDPRINT_ENCODINGS_RETRY seconds.
+    if job_ready or session.media_types is not None:
+        return None
+
+    now = time.monotonic()
+    if now - session.encodings_requested < float(get_constant("CLOUDPRINT_ENCODINGS_RETRY", 300)):
+        return None
+
+    session.encodings_requested = now
+
+    return [{"request": "Encodings", "options": ""}]
+
+
+def next_job(queue: OrderQueue, restaurant_code: str) -> tuple[bool, int, Optional[str]]:
+    # jobReady, the number of orders in the queue and the job token of the next order to be popped.
+
+    # Check whether there are orders available in the queue to be printed
+    job_ready = queue.is_job_ready(restaurant_code)
+    queue_len = queue.length(restaurant_code)
+
+    # Create job token for the next order that will be popped,
+    # token will have to be sent in the Post Poll response only if jobReady = true
+    job_token = None
+    if job_ready:
+        job_token = queue.get_token_for_next_order(restaurant_code)
+        job_ready = job_token is not None
+
+    return job_ready, queue_len, job_token
 
 
 @router.post("/{restaurant_code}", response_model=PostPollResponse, status_code=status.HTTP_200_OK)
-def post_poll(restaurant_code: str,
-              request: PostPollRequest,
-              Authorization: Optional[str] = Header(None)) -> PostPollResponse:
+async def post_poll(restaurant_code: str,
+                    request: PostPollRequest,
+                    http_request: Request,
+                    background_tasks: BackgroundTasks,
+                    Authorization: Optional[str] = Header(None)) -> PostPollResponse:
 
-    decode_asb_status(request.statusCode, request.status)
+    # Decode and log the printer status once the response has been sent.
+    background_tasks.add_task(decode_asb_status, request.statusCode, request.status)
 
-    auth_response = auth.is_authorized(Authorization, restaurant_code.lower())
+    session, auth_response = await route_executor.run(printer_sessions.authorize, restaurant_code.lower(),
+                                                      request.printerMAC, Authorization,
+                                                      blocking=PrinterSessions.shared_store is not None)
 
     if auth_response.status:
 
-        # Check whether there are orders available in the queue to be printed
-        jobReady = queue.is_job_ready(restaurant_code)
-        queue_len = queue.length(restaurant_code)
+        # First poll of this printer, its orders may be waiting in the POTLAM backend.
+        if session.polls == 0:
+            fetch_scheduler.printer_online()
 
-        # is_order_available_in_db(restaurant_code)
+        # Keep track of the poll rate and the last status reported by this printer.
+        session.record_poll(request.statusCode, request.status)
 
-        # Create job token for the next order that will be popped,
-        # token will have to be sent in the Post Poll response only if jobReady = true
-        job_token = None
-        if jobReady:
-            job_token = queue.get_token_for_next_order(restaurant_code)
+        queue = OrderQueue()
+
+        jobReady, queue_len, job_token = await route_executor.run(next_job, queue, restaurant_code,
+                                                                  blocking=queue.blocking)
+
+        offered = negotiate_media_types(restaurant_code, session, request.clientAction)
 
         # construct the PostPollResponse object.
         response = PostPollResponse(jobReady=str(jobReady).lower(),
-                                    mediaTypes=["application/vnd.star.starprnt"],
+                                    mediaTypes=offered,
                                     jobToken=job_token,
-                                    deleteMethod="DELETE"
+                                    deleteMethod="DELETE",
+                                    clientAction=encodings_request(session, jobReady)
                                     )
 
+        # The printer GETs the job of this token, a retried GET gets the same job again. The printer does not
+        # add the media type it picked to this URL, it is only set once the printer's encodings are known.
+        if job_token is not None and session.media_types is not None:
+            response.jobGetUrl = job_get_url(http_request, restaurant_code, job_token, offered[0])
+
         logger.info(f"No of orders in queue for [{restaurant_code}]: [{queue_len}]")
 
         response = Response(content=response.to_json(), status_code=status.HTTP_200_OK)
@@ -120,13 +358,34 @@ def post_poll(restaurant_code: str,
 
 
 @router.delete("/{restaurant_code}", status_code=status.HTTP_200_OK)
-async def delete(restaurant_code: str, token: str):
+async def delete(restaurant_code: str,
+                 token: str,
+                 mac: Optional[str] = None,
+                 Authorization: Optional[str] = Header(None)):
 
     logger.info(f"Received DELETE with [job_token:{token}]")
 
+    session, auth_response = await route_executor.run(printer_sessions.authorize, restaurant_code.lower(), mac,
+                                                      Authorization, blocking=PrinterSessions.shared_store is not None)
+
+    if not auth_response.status:
+        response = Response(content=auth_response.to_json(), status_code=auth_response.http_status)
+        response.headers["WWW-Authenticate"] = "Basic realm=\"Authentication Required\""
+
+        return response
+
     if token:
+        parts = job_token_parts(restaurant_code, token)
+        if parts is None:
+            return unknown_job_token(token)
+
         # Cleanup by removing stm and cp temporary files and delete the sqlite3 database table entry for this order.
-        cleanup(restaurant_code, job_token=token)
+        await route_executor.run(cleanup, restaurant_code, token)
+
+        # The printer confirmed the job was printed, update the status of this order in the POTLAM Backend
+        # with the next bulk status update. CLOUDPRINT_STATUS_PRINTED is the status of a printed order in the
+        # POTLAM Backend, "2" unless configured.
+        status_updater.record(parts[2], str(get_constant("CLOUDPRINT_STATUS_PRINTED", 2)))
 
     # Return 200
     return Response(status_code=200, content="Success.")
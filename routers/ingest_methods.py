@@ -0,0 +1,106 @@
+from typing import Optional, Union
+
+from fastapi import APIRouter, Header, Request, status
+from fastapi.responses import Response
+from pydantic import ValidationError
+
+import json
+import logging
+
+from backend.cron_methods import ingest_orders
+from backend.schemas import BodyItem, IngestAck, IngestResponse, INGEST_QUEUED, INGEST_REJECTED
+from backend.shard_client import ShardClient
+from backend.shard_ring import is_forwarded, ShardRing
+from libs.auth import is_valid_ingest_key
+
+# Orders pushed by the POTLAM backend as soon as they are placed, instead of waiting for the next fetch.
+router = APIRouter(prefix="/ingest")
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+
+def parse_order(item) -> Union[BodyItem, IngestAck]:
+    # Each order is validated on its own, an invalid order is rejected without failing the others.
+    try:
+        if isinstance(item, (str, bytes)):
+            return BodyItem.model_validate_json(item)
+
+        return BodyItem.model_validate(item)
+
+    except ValidationError as e:
+        ack = IngestAck(status=INGEST_REJECTED, detail=f"Invalid order: {e.error_count()} validation errors.")
+
+        if isinstance(item, dict):
+            ack.restaurant_code = item.get("restaurant_code")
+            ack.order_id = item.get("order_id")
+            ack.cloud_print_id = item.get("cloud_print_id")
+
+        return ack
+
+
+async def read_orders(request: Request) -> Optional[list]:
+    # Accepts the CloudPrintOrdersModel json returned by POTLAM_PRINT_LIST, or a stream of BodyItem json
+    # documents, one per line (Content-Type: application/x-ndjson). Returns None if the body is not valid json.
+
+    if "ndjson" in request.headers.get("content-type", ""):
+        items = []
+        buffer = b""
+
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            items.extend(parse_order(line) for line in lines if line.strip())
+
+        if buffer.strip():
+            items.append(parse_order(buffer))
+
+        return items
+
+    try:
+        orders = json.loads(await request.body())
+        return [parse_order(item) for item in orders["body"]]
+
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+@router.post("/orders", response_model=IngestResponse, status_code=status.HTTP_200_OK)
+async def ingest(request: Request, Authorization: Optional[str] = Header(None)):
+
+    if not is_valid_ingest_key(Authorization):
+        return Response(content="Authentication Failed.", status_code=status.HTTP_401_UNAUTHORIZED,
+                        media_type="text/plain")
+
+    items = await read_orders(request)
+
+    if items is None:
+        return Response(content="Invalid orders payload.", status_code=status.HTTP_400_BAD_REQUEST,
+                        media_type="text/plain")
+
+    # Orders of restaurants of other shard nodes are forwarded to their node, unless forwarded by another node.
+    ring = ShardRing()
+    forwarded = is_forwarded(request.headers, request.method, request.url.path)
+    by_node = {}
+
+    for item in items:
+        if isinstance(item, BodyItem):
+            node = None if forwarded else ring.owner(item.restaurant_code)
+            by_node.setdefault(node if node != ShardRing.node else None, []).append(item)
+
+    # Orders go through the same de-duplication, database and queue path as the fetched orders.
+    acknowledged = {}
+    for node, orders in by_node.items():
+        if node is None:
+            node_acks = await ingest_orders(orders)
+        else:
+            node_acks = await ShardClient.forward_orders(node, orders, Authorization)
+
+        acknowledged.update({id(order): ack for order, ack in zip(orders, node_acks)})
+
+    acks = [acknowledged[id(item)] if isinstance(item, BodyItem) else item for item in items]
+    queued = sum(1 for ack in acks if ack.status == INGEST_QUEUED)
+
+    logger.info(f"Received [{len(acks)}] orders pushed by the POTLAM backend, [{queued}] added to queues.")
+
+    return IngestResponse(queued=queued, items=acks)
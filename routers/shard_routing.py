@@ -0,0 +1,70 @@
+from fastapi import Request, status
+from fastapi.responses import RedirectResponse, Response
+
+import logging
+import os
+
+from backend.job_leases import JobLeases
+from backend.order_queue import parse_job_token
+from backend.shard_client import ShardClient
+from backend.shard_ring import is_forwarded, ShardRing
+from libs.constants import get_constant
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+ROUTED_PREFIX = "/cloudprint/"
+
+
+async def route_to_shard(request: Request, call_next):
+    # HTTP middleware: printer requests for a restaurant of another shard node are sent to that node, with a
+    # 307 redirect (CLOUDPRINT_SHARD_ROUTING=redirect, the default) that keeps the method and body, or proxied
+    # (CLOUDPRINT_SHARD_ROUTING=proxy) for printers that do not follow redirects.
+
+    ring = ShardRing()
+    path = request.url.path
+
+    if not ring.enabled or not path.startswith(ROUTED_PREFIX):
+        return await call_next(request)
+
+    if is_forwarded(request.headers, request.method, path):
+        return await call_next(request)
+
+    restaurant_code = path[len(ROUTED_PREFIX):].split("/", 1)[0]
+    owner = ring.owner(restaurant_code)
+
+    if owner is None or owner == ShardRing.node or is_leased_here(request):
+        return await call_next(request)
+
+    url = owner + path + ("?" + request.url.query if request.url.query else "")
+
+    if str(get_constant("CLOUDPRINT_SHARD_ROUTING", "redirect")).lower() != "proxy":
+        return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
+
+    proxied = await ShardClient.proxy(request.method, url, path, request.headers, await request.body())
+
+    if proxied is None:
+        return Response(content="Shard node of " + restaurant_code + " unavailable.",
+                        status_code=status.HTTP_502_BAD_GATEWAY, media_type="text/plain")
+
+    status_code, headers, content = proxied
+
+    return Response(content=content, status_code=status_code, headers=headers)
+
+
+def is_leased_here(request: Request) -> bool:
+    # A job leased by this node before its restaurant moved to another node is still served and confirmed
+    # here: the GETs of its job token replay the job, its DELETE releases the lease and marks the order printed.
+    if request.method == "DELETE":
+        token = request.query_params.get("token")
+    elif "/job/" in request.url.path:
+        token = request.url.path.rsplit("/", 1)[-1]
+    else:
+        return False
+
+    parts = parse_job_token(token)
+
+    if parts is None:
+        return False
+
+    return os.path.exists(JobLeases().lease_path(parts[3]))
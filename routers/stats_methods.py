@@ -0,0 +1,110 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+
+from backend.fetch_leader import FetchLeader
+from backend.fetch_scheduler import FetchScheduler
+from backend.job_leases import JobLeases
+from backend.logo_cache import LogoCache
+from backend.media_types import MediaTypes
+from backend.route_executor import RestaurantLocks, RouteExecutor, threadpool_stats
+from backend.shard_client import ShardClient
+from backend.shard_ring import ShardRing
+from backend.order_queue import OrderQueue
+from backend.status_updater import StatusUpdater
+from database.db_writer import DatabaseWriter
+from libs import asb_status
+from libs.auth import is_valid_stats_key, PrinterSessions
+from libs.cp_cache import ConversionCache
+from libs.cputil import CPUtilPool
+
+
+def require_stats_key(Authorization: Optional[str] = Header(None)):
+    # The statistics list the printers' MAC addresses and the shard nodes, they are served only with the header
+    # "Authorization: Bearer <CLOUDPRINT_STATS_KEY>".
+    if not is_valid_stats_key(Authorization):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authentication Failed.")
+
+
+# Service statistics, used to size caches and tune the service.
+router = APIRouter(prefix="/stats", dependencies=[Depends(require_stats_key)])
+
+
+@router.get("/cache")
+def conversion_cache_stats() -> dict:
+    # Hit / miss counters and sizes of the CPUtil conversion cache tiers.
+    return ConversionCache().stats()
+
+
+@router.get("/jobs")
+def job_store_stats() -> dict:
+    # Memory used by rendered print jobs waiting to be printed and the number spilled to disk.
+    return OrderQueue().payloads.stats()
+
+
+@router.get("/cputil")
+def cputil_pool_stats() -> dict:
+    # CPUtil processes running, calls waiting for a free process slot and timed out calls.
+    return CPUtilPool().stats()
+
+
+@router.get("/db")
+def database_writer_stats() -> dict:
+    # Writes waiting to be committed, transactions committed and status updates coalesced.
+    return DatabaseWriter().stats()
+
+
+@router.get("/potlam")
+def status_updater_stats() -> dict:
+    # Order status updates waiting to be sent to the POTLAM backend, sent, coalesced and failed flushes.
+    return StatusUpdater().stats()
+
+
+@router.get("/asb")
+def asb_status_cache_stats() -> dict:
+    # Hit / miss counters of the memoized printer status decoder.
+    return asb_status.cache_stats()
+
+
+@router.get("/printers")
+def printer_session_stats() -> dict:
+    # Printers polling this service, their poll rate and last reported status.
+    return PrinterSessions().stats()
+
+
+@router.get("/fetch")
+def fetch_scheduler_stats() -> dict:
+    # Current POTLAM fetch interval and the duration of the recent fetches, and whether this worker
+    # is the one fetching.
+    return {**FetchScheduler().stats(), **FetchLeader().stats()}
+
+
+@router.get("/shard")
+def shard_stats() -> dict:
+    # Shard nodes, membership changes and the requests and orders forwarded to the other nodes.
+    return {**ShardRing().stats(), **ShardClient.stats()}
+
+
+@router.get("/routes")
+async def route_executor_stats() -> dict:
+    # Size and use of the thread pools of the route handlers, the time blocking calls waited for a thread
+    # and the GETs that waited for another GET of the same restaurant.
+    return {**threadpool_stats(), **RouteExecutor().stats(), **RestaurantLocks().stats()}
+
+
+@router.get("/leases")
+def job_lease_stats() -> dict:
+    # Jobs leased to the printers and not yet confirmed, and the GETs that replayed a leased job.
+    return JobLeases().stats()
+
+
+@router.get("/media")
+def media_type_stats() -> dict:
+    # Media types negotiated with the printers, and the number and size of the jobs sent in each media type.
+    return MediaTypes().stats()
+
+
+@router.get("/logos")
+def logo_cache_stats() -> dict:
+    # Restaurant logos cached locally, their downloads and the downloads that failed.
+    return LogoCache().stats()
@@ -1,5 +1,5 @@
 from libs.constants import Environment
-from libs.auth import Auth
+from libs.auth import PrinterSessions
 
 import logging
 import os
@@ -9,8 +9,8 @@ def init():
     # Initialize the environment, load all the constants into the OS.
     Environment()
 
-    # Initialize Authorization
-    Auth()
+    # Initialize the printer sessions, reads the authorization settings.
+    PrinterSessions().configure()
 
     # Configure logging
     logging.basicConfig(
@@ -30,6 +30,15 @@ def init():
     # Create folder to save temporary .stm and .cp files for each order that is to be sent to the printer.
     create_folder("tmp")
 
+    # Create folder for the disk tier of the CPUtil conversion cache.
+    create_folder(os.getenv("CLOUDPRINT_CACHE_FOLDER", "cache"))
+
+    # Create folder for the print jobs leased to the printers.
+    create_folder(os.getenv("CLOUDPRINT_JOB_FOLDER", "jobs"))
+
+    # Create folder for the local copies of the restaurant logos.
+    create_folder(os.getenv("CLOUDPRINT_LOGO_FOLDER", "logos"))
+
 
 def create_folder(folder_name: str):
     if not os.path.exists(folder_name):
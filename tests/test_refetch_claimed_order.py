@@ -0,0 +1,130 @@
+# An order claimed by a printer is fetched again until its in progress status reaches the POTLAM backend with the
+# next status update, it must not be queued again. Run with: python -m unittest discover tests
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+folder = tempfile.mkdtemp(prefix="cloudprint-test-")
+
+os.environ.update({
+    "CLOUDPRINT_DB_URL": "sqlite:///" + os.path.join(folder, "cp_orders.db"),
+    "CLOUDPRINT_JOB_FOLDER": os.path.join(folder, "jobs"),
+    "CLOUDPRINT_STATUS_PRINT_PENDING": "0",
+    "CLOUDPRINT_STATUS_PRINT_IN_PROGRESS": "1",
+    "CLOUDPRINT_AUTHENTICATION": "secret",
+    "AUTHORIZATION_ACTIVE_TIME": "600",
+    "CLOUDPRINT_QUEUE_BACKEND": "memory",
+})
+
+os.makedirs(os.environ["CLOUDPRINT_JOB_FOLDER"], exist_ok=True)
+
+import backend  # noqa: E402, imported ahead of the database module
+from backend import cron_methods  # noqa: E402
+from backend.media_types import default_media_type  # noqa: E402
+from backend.order_queue import OrderQueue  # noqa: E402
+from backend.schemas import BodyItem, INGEST_DUPLICATE, INGEST_QUEUED  # noqa: E402
+from backend.status_updater import StatusUpdater  # noqa: E402
+from database.cloudprint_db import init_db, load_order  # noqa: E402
+from database.db_writer import DatabaseWriter  # noqa: E402
+from routers import cloudprint_methods  # noqa: E402
+from tools.potlam_stub import make_order  # noqa: E402
+
+RESTAURANT_CODE = "rest0"
+MAC = "00:11:62:00:00:01"
+
+
+def rendered(order: BodyItem):
+    # Stands in for the render pipeline, which needs CPUtil.
+    OrderQueue().mark_ready(order.uuid, b"print job of order " + order.order_id.encode(), default_media_type())
+
+
+def fetch(number: int) -> BodyItem:
+    # The order as returned by every fetch from the POTLAM backend, until it is printed.
+    return BodyItem(**make_order(number, restaurants=1))
+
+
+class RefetchClaimedOrderTest(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        init_db()
+
+    def setUp(self):
+        patcher = mock.patch.object(cron_methods.render_pipeline, "submit", side_effect=rendered)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await DatabaseWriter().stop()
+
+    async def get(self):
+        return await cloudprint_methods.get_print_job(RESTAURANT_CODE, mac=MAC, token=None, media_type=None,
+                                                     Authorization="secret", if_none_match=None)
+
+    async def delete(self, order: BodyItem):
+        return await cloudprint_methods.delete(RESTAURANT_CODE, token=cloudprint_methods.job_token_for(order),
+                                               mac=MAC, Authorization="secret")
+
+    async def test_fetch_get_fetch_delete(self):
+        queue = OrderQueue()
+
+        # Fetch.
+        order = fetch(1)
+        acks = await cron_methods.ingest_orders([order])
+        self.assertEqual(acks[0].status, INGEST_QUEUED)
+
+        # GET, the printer claims the order.
+        response = await self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queue.length(RESTAURANT_CODE), 0)
+
+        # Fetch again, before the in progress status is sent to the POTLAM backend.
+        self.assertEqual(StatusUpdater.pending.get(order.cloud_print_id), "1")
+
+        refetched = fetch(1)
+        acks = await cron_methods.ingest_orders([refetched])
+        self.assertEqual(acks[0].status, INGEST_DUPLICATE)
+        self.assertEqual(refetched.uuid, order.uuid)
+        self.assertEqual(queue.length(RESTAURANT_CODE), 0)
+
+        await DatabaseWriter().flush()
+        self.assertIsNotNone(load_order(order.uuid, "1"))
+
+        # DELETE, the printer confirms the job.
+        response = await self.delete(order)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StatusUpdater.pending.get(order.cloud_print_id), "2")
+
+        await DatabaseWriter().flush()
+        self.assertIsNone(load_order(order.uuid, "1"))
+        self.assertIsNone(cloudprint_methods.job_leases.load(order.uuid))
+
+        # The next order of the restaurant is not blocked.
+        acks = await cron_methods.ingest_orders([fetch(2)])
+        self.assertEqual(acks[0].status, INGEST_QUEUED)
+        self.assertEqual(queue.length(RESTAURANT_CODE), 1)
+        self.assertTrue(queue.is_job_ready(RESTAURANT_CODE))
+
+    async def test_delete_removes_order_queued_again(self):
+        queue = OrderQueue()
+
+        order = fetch(3)
+        await cron_methods.ingest_orders([order])
+
+        response = await self.get()
+        self.assertEqual(response.status_code, 200)
+
+        # Queued again, e.g. by a fetch that saw the order before it was claimed.
+        queue.add_order(fetch(3))
+        self.assertEqual(queue.length(RESTAURANT_CODE), 1)
+
+        response = await self.delete(order)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queue.length(RESTAURANT_CODE), 0)
+        self.assertFalse(queue.is_job_ready(RESTAURANT_CODE))
+
+
+if __name__ == "__main__":
+    unittest.main()
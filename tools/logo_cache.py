@@ -0,0 +1,90 @@
+# Fills the local logo cache of the service (CLOUDPRINT_LOGO_FOLDER), e.g. ahead of a deploy or to run without
+# access to the image hosts with CLOUDPRINT_LOGO_OFFLINE=true.
+#
+# Usage: python -m tools.logo_cache preload <logo url> <image file>   cache a local image as the logo of the url
+#        python -m tools.logo_cache fetch <logo url> [<logo url> ...]  download these logos now
+#        python -m tools.logo_cache known                              download the logos of the restaurants with
+#                                                                      orders pending in the database
+#        python -m tools.logo_cache list
+#
+# The constants are read from the environment and conf/.env_constants.<CLOUD_PRINTER_ENV>, as by the service.
+
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.constants import Environment  # noqa: E402
+
+# Load the constants before the modules that read them on import.
+Environment()
+
+from backend.logo_cache import LogoCache  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local logo cache of the CloudPrint service")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    preload = commands.add_parser("preload", help="cache a local image as the logo of a url")
+    preload.add_argument("url")
+    preload.add_argument("file")
+
+    fetch = commands.add_parser("fetch", help="download logos now")
+    fetch.add_argument("urls", nargs="+")
+
+    commands.add_parser("known", help="download the logos of the restaurants with pending orders")
+    commands.add_parser("list", help="list the cached logos")
+
+    return parser.parse_args()
+
+
+async def fetch(urls: list[str]):
+    cache = LogoCache()
+
+    try:
+        for url in urls:
+            asset = await cache.fetch(url, wait=True)
+            print(f"{url}: {asset.path if asset is not None else 'not available'}")
+    finally:
+        await cache.close()
+
+
+def known_logos() -> list[str]:
+    from database.cloudprint_db import load_pending_orders
+
+    return sorted({order.restaurant_details.logo_url for order in load_pending_orders()
+                   if order.restaurant_details.logo_url})
+
+
+def main():
+    args = parse_args()
+    cache = LogoCache()
+
+    if args.command == "preload":
+        try:
+            asset = cache.preload(args.url, args.file)
+        except (OSError, ValueError) as e:
+            sys.exit(f"{args.file}: {e}")
+
+        print(f"{args.url}: {asset.path}")
+
+    elif args.command == "fetch":
+        asyncio.run(fetch(args.urls))
+
+    elif args.command == "known":
+        asyncio.run(fetch(known_logos()))
+
+    else:
+        cache.scan()
+
+        for asset in cache.assets.values():
+            print(f"{asset.path} {asset.size} bytes")
+
+        print(cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Local stand-in for the POTLAM backend, to run the service offline. Serves generated pending orders on
+# POTLAM_PRINT_LIST, as a full list or incrementally after since_cloud_print_id in pages of page_size,
+# and records the status updates posted to POTLAM_STATUS_UPDATE and POTLAM_MULTI_STATUS_UPDATE.
+# Orders updated to the printed status are no longer pending.
+#
+# Usage: python -m tools.potlam_stub [--port 8081] [--orders 100] [--restaurants 5] [--rate 0.5]
+#
+# then run the service with POTLAM_BACKEND_HOST=http://127.0.0.1:8081. GET /stub returns the stub's counters.
+
+import argparse
+import asyncio
+import json
+import os
+
+from aiohttp import web
+
+PRINTED = os.getenv("CLOUDPRINT_STATUS_PRINTED", "2")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="POTLAM backend stub")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--orders", type=int, default=100, help="pending orders at startup")
+    parser.add_argument("--restaurants", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=0.5, help="new orders per second")
+    parser.add_argument("--print-list", default=os.getenv("POTLAM_PRINT_LIST", "/print_list"))
+    parser.add_argument("--status-update", default=os.getenv("POTLAM_STATUS_UPDATE", "/status_update"))
+    parser.add_argument("--multi-status-update", default=os.getenv("POTLAM_MULTI_STATUS_UPDATE",
+                                                                   "/multi_status_update"))
+    return parser.parse_args()
+
+
+def make_order(number: int, restaurants: int) -> dict:
+    order_id = str(number)
+
+    return {
+        "cloud_print_id": str(100000 + number),
+        "order_id": order_id,
+        "restaurant_code": f"rest{number % restaurants}",
+        "restaurant_details": {"name": "Stub Restaurant", "logo_url": None, "address": "1 Main Street",
+                               "phone": "555-0100", "website": "example.com", "message": "Thank you!"},
+        "print_order": {
+            "order_id": order_id, "orderdate": "2024-01-01", "ordertime": "12:00", "orderstatus": "1",
+            "delivery": "0", "pickup": "1", "billingfirstname": "Stub", "billinglastname": "Customer",
+            "billingaddress": "2 Main Street", "billingcity": "City", "billingstate": "ST", "billingzipcode": "00000",
+            "upcharge": None, "upchargetransaction_id": None, "refund": "0", "refundtransaction_id": "",
+            "order_cancelled": "0", "cancelled_trancation_id": "", "subtotal": "20.00", "tax": "1.60",
+            "tips": "2.00", "delivery_charge": "0", "discount": "0", "upchargeamount": None, "refundamount": "0",
+            "total": "23.60",
+            "orderdetails": [{"order_id": order_id, "orderdetails_id": str(item), "itemid": str(item),
+                              "item_name": f"Item {item}", "item_image": "", "quantity": "1",
+                              "toppingsdetails": []} for item in range(1, 4)],
+        },
+    }
+
+
+class PotlamStub:
+
+    def __init__(self, args):
+        self.args = args
+        self.orders = {}
+        self.statuses = {}
+        self.next_number = 0
+        self.requests = {"print_list": 0, "incremental": 0, "status_updates": 0}
+
+        for _ in range(args.orders):
+            self.add_order()
+
+    def add_order(self):
+        order = make_order(self.next_number, self.args.restaurants)
+        self.orders[order["cloud_print_id"]] = order
+        self.next_number += 1
+
+    def pending(self) -> list:
+        return [order for cloud_print_id, order in self.orders.items() if self.statuses.get(cloud_print_id) != PRINTED]
+
+    async def print_list(self, request: web.Request) -> web.Response:
+        params = json.loads(await request.text() or "{}")
+        self.requests["print_list"] += 1
+
+        orders = self.pending()
+        if len(orders) == 0:
+            return web.Response(text="")
+
+        response = {"status": 1, "message": "Success", "body": orders}
+
+        since = params.get("since_cloud_print_id")
+        if since is not None or params.get("page_size") is not None:
+            self.requests["incremental"] += 1
+
+            page_size = int(params.get("page_size") or 200)
+            after = [order for order in orders if since is None or int(order["cloud_print_id"]) > int(since)]
+
+            response["body"] = after[:page_size]
+            response["has_more"] = len(after) > page_size
+            response["cursor"] = response["body"][-1]["cloud_print_id"] if response["body"] else since
+
+        return web.json_response(response)
+
+    async def status_update(self, request: web.Request) -> web.Response:
+        params = json.loads(await request.text())
+        self.requests["status_updates"] += 1
+
+        for status in params.get("order_list") or [params]:
+            self.statuses[str(status["cloud_print_id"])] = str(status["status"])
+
+        return web.json_response({"status": 1, "message": "Success"})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"orders": len(self.orders), "pending": len(self.pending()), **self.requests})
+
+    async def generate(self):
+        if self.args.rate <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(1 / self.args.rate)
+            self.add_order()
+
+
+async def main():
+    args = parse_args()
+    stub = PotlamStub(args)
+
+    app = web.Application()
+    app.router.add_post(args.print_list, stub.print_list)
+    app.router.add_post(args.status_update, stub.status_update)
+    app.router.add_post(args.multi_status_update, stub.status_update)
+    app.router.add_get("/stub", stub.stats)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    print(f"POTLAM stub listening on http://127.0.0.1:{args.port} with [{args.orders}] pending orders.")
+
+    await stub.generate()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
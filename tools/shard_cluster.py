@@ -0,0 +1,112 @@
+# Runs the service as several local shard nodes, to try sharding on one machine. Each node is a uvicorn
+# process on its own port with its own database; the nodes file lists the members of the ring, edit it
+# (or use --plan) to add or remove nodes while the cluster runs.
+#
+# Usage: python -m tools.shard_cluster [--nodes 3] [--port 8101] [--routing redirect|proxy] [--folder shard]
+#        python -m tools.shard_cluster --plan [--nodes 3] [--restaurants 1000]
+#
+# --plan prints how many restaurants each node owns, and how many move when a node is added or removed.
+# The POTLAM backend and the other constants are read from the environment, e.g. run tools.potlam_stub and
+# set POTLAM_BACKEND_HOST. GET /stats/shard on any node, with "Authorization: Bearer <CLOUDPRINT_STATS_KEY>",
+# returns its view of the ring.
+
+import argparse
+import os
+import secrets
+import signal
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.shard_ring import ShardRing  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local shard nodes of the CloudPrint service")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8101, help="port of the first node")
+    parser.add_argument("--routing", default="redirect", choices=["redirect", "proxy"])
+    parser.add_argument("--folder", default="shard", help="databases, logs and nodes file of the nodes")
+    parser.add_argument("--plan", action="store_true", help="print the partition instead of running the nodes")
+    parser.add_argument("--restaurants", type=int, default=1000)
+    return parser.parse_args()
+
+
+def node_urls(count: int, port: int) -> list[str]:
+    return [f"http://127.0.0.1:{port + number}" for number in range(count)]
+
+
+def partition(nodes: list[str], restaurants: list[str]) -> dict:
+    ring = ShardRing()
+    ShardRing.node = nodes[0]
+    ring.build(nodes)
+
+    return {restaurant_code: ring.owner(restaurant_code) for restaurant_code in restaurants}
+
+
+def plan(args):
+    restaurants = [f"rest{number}" for number in range(args.restaurants)]
+    nodes = node_urls(args.nodes, args.port)
+    owners = partition(nodes, restaurants)
+
+    for node in nodes:
+        print(f"{node}: {sum(1 for owner in owners.values() if owner == node)} restaurants")
+
+    for label, changed in (("added", node_urls(args.nodes + 1, args.port)), ("removed", nodes[:-1])):
+        moved = sum(1 for restaurant_code, owner in partition(changed, restaurants).items()
+                    if owner != owners[restaurant_code])
+        print(f"node {label}: {moved} of {len(restaurants)} restaurants move ({moved / len(restaurants):.1%})")
+
+
+def run(args):
+    os.makedirs(args.folder, exist_ok=True)
+    nodes = node_urls(args.nodes, args.port)
+
+    nodes_file = os.path.abspath(os.path.join(args.folder, "nodes.txt"))
+    with open(nodes_file, "w") as f:
+        f.write("\n".join(nodes) + "\n")
+
+    # The nodes sign the requests they forward to each other with a shared secret.
+    secret = os.getenv("CLOUDPRINT_SHARD_SECRET") or secrets.token_hex(16)
+
+    processes = []
+    for number, node in enumerate(nodes):
+        port = args.port + number
+        folder = os.path.abspath(args.folder)
+
+        environment = dict(os.environ,
+                           CLOUDPRINT_SHARD_SELF=node,
+                           CLOUDPRINT_SHARD_NODES_FILE=nodes_file,
+                           CLOUDPRINT_SHARD_RELOAD_INTERVAL=os.getenv("CLOUDPRINT_SHARD_RELOAD_INTERVAL", "2"),
+                           CLOUDPRINT_SHARD_ROUTING=args.routing,
+                           CLOUDPRINT_SHARD_SECRET=secret,
+                           CLOUDPRINT_DB_URL=f"sqlite:///{folder}/cp_orders_{port}.db",
+                           CLOUDPRINT_LOG=f"{folder}/cloudprint_{port}.log")
+
+        processes.append(subprocess.Popen([sys.executable, "-m", "uvicorn", "print:app", "--host", "127.0.0.1",
+                                           "--port", str(port)], env=environment))
+
+        print(f"Shard node {node} started [pid:{processes[-1].pid}].")
+
+    print(f"Nodes file: {nodes_file}. Ctrl-C stops the nodes.")
+
+    try:
+        for process in processes:
+            process.wait()
+
+    except KeyboardInterrupt:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+
+    if arguments.plan:
+        plan(arguments)
+    else:
+        run(arguments)